@@ -3,81 +3,878 @@ Main interface module containing externally-visible functions. Used by justonce,
 but also potentially available to other programs.
 """
 
-import math
 import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import uuid as uuidlib
 import xor.xor
 
+import justthisonce.asyncpad
+import justthisonce.compression
+import justthisonce.integrity
+import justthisonce.message
 import justthisonce.pad
 
 BLOCKSIZE = 4 * 1024 * 1024
 
+# encryptTree claims pad for up to this many files or bytes at once,
+# committing it (and so writing the pad's metadata) once per batch.
+BATCH_FILES = 256
+BATCH_SIZE = 256 * 1024 * 1024
+
+# Streams are read up to this many blocks ahead of the block being written.
+AHEAD = 2
+
+class Error(Exception):
+  pass
+
+class TreeFailed(Error):
+  """Some files of a tree could not be encrypted or decrypted. args[0] maps
+     their relative paths to the exceptions raised."""
+
+class UnsafePath(Error):
+  """A relative path read from a tree's source, e.g. a message archive entry
+     id, would write outside the output directory."""
+
+def walkTree(path):
+  """Returns (relative path, size) of every regular file under path, in
+     order of path. Symbolic links are not followed."""
+  files = []
+  for (dirpath, dirnames, filenames) in os.walk(path):
+    for filename in filenames:
+      fullpath = os.path.join(dirpath, filename)
+      if os.path.isfile(fullpath) and not os.path.islink(fullpath):
+        files.append((os.path.relpath(fullpath, path),
+                      os.path.getsize(fullpath)))
+  files.sort()
+  return files
+
+def _treePath(outdir, relpath):
+  """Returns the path of relpath under outdir, raising UnsafePath if relpath
+     is absolute or, once normalised, leaves outdir (or names it)."""
+  normal = os.path.normpath(relpath)
+  if (os.path.isabs(normal) or normal in (os.curdir, os.pardir) or
+      normal.startswith(os.pardir + os.sep)):
+    raise UnsafePath(relpath)
+  return os.path.join(outdir, normal)
+
+def _batches(files, batch_files, batch_size):
+  """Splits (relative path, size) pairs into lists of up to batch_files
+     files and batch_size bytes, or a single file if it is larger."""
+  batch = []
+  total = 0
+  for (relpath, size) in files:
+    if batch and (len(batch) == batch_files or total + size > batch_size):
+      yield batch
+      batch = []
+      total = 0
+    batch.append((relpath, size))
+    total += size
+  if batch:
+    yield batch
+
+def _pipeline(items, consume, ahead):
+  """Runs the iterator items in a thread of its own, up to ahead items ahead
+     of consume, which is called with each item in this thread. Reading and
+     writing thus overlap, and a slow source or sink only holds the other
+     back once ahead items are waiting. Raises whatever either side
+     raises.
+
+     The thread is waited for before returning or raising, unless it is
+     still inside items (e.g. blocked reading a pipe), so items should only
+     read: anything with lasting effects, like claiming pad, belongs in
+     consume."""
+  queue = Queue.Queue(ahead)
+  stopped = threading.Event()
+  reading = threading.Event()
+  lock = threading.Lock()
+  failure = []
+
+  def put(item):
+    while not stopped.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def produce():
+    iterator = iter(items)
+    try:
+      while True:
+        # stopped is checked, and reading set, together so that the
+        # consumer knows whether it can wait for us.
+        with lock:
+          if stopped.is_set():
+            return
+          reading.set()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          break
+        finally:
+          with lock:
+            reading.clear()
+        if not put((True, item)):
+          return
+    except BaseException:
+      failure.append(sys.exc_info())
+    put((False, None))
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      more, item = queue.get()
+      if not more:
+        break
+      consume(item)
+  finally:
+    # If consume failed, the producer stops before its next item. It isn't
+    # waited for if it is reading, as it may be blocked on a pipe; it will
+    # stop once the read returns.
+    with lock:
+      stopped.set()
+      blocked = reading.is_set()
+    if not blocked:
+      thread.join()
+  if failure:
+    raise failure[0][0], failure[0][1], failure[0][2]
+
+def _markLast(items):
+  """Yields each of items with whether it is the last, reading one ahead."""
+  items = iter(items)
+  try:
+    previous = next(items)
+  except StopIteration:
+    return
+  for item in items:
+    yield previous, False
+    previous = item
+  yield previous, True
+
+def _readBlocks(source, size, codec):
+  """Yields everything read from source, compressed with codec if given, in
+     blocks of size bytes (the last maybe shorter), each with the seconds
+     spent reading it."""
+  if codec is None:
+    pieces = iter(lambda: source.read(size), "")
+  else:
+    pieces = justthisonce.compression.compressStream(source, codec, size)
+  pending = ""
+  read = 0.0
+  started = time.time()
+  for piece in pieces:
+    read += time.time() - started
+    pending += piece
+    while len(pending) >= size:
+      yield pending[:size], read
+      read = 0.0
+      pending = pending[size:]
+    started = time.time()
+  if pending:
+    yield pending, read
+
+def _writeBlock(output, progress, decompressor, (data, key, read)):
+  """Xors a block of data read in read seconds with its pad and writes it
+     to output, decompressing it first if given a decompressor. What it
+     decompresses to is written a block's length at a time."""
+  started = time.time()
+  data = xor.xor.xorStrings(data, key)
+  xored = time.time()
+  if decompressor is None:
+    output.write(data)
+  else:
+    for piece in justthisonce.compression.decompressPieces(decompressor, data,
+                                                           len(data)):
+      output.write(piece)
+  if progress is not None:
+    progress.update(len(key), read=read, xor=xored - started,
+                    write=time.time() - xored)
+
+class _Reservation(object):
+  """Hands out the pad for a stream a block at a time from batches claimed
+     at once, so the pad's metadata is written once per batch rather than
+     once per block. Each batch is a quarter of the pad handed out so far,
+     from one block up to BATCH_SIZE. The last block is claimed exactly if
+     no batch is left for it; otherwise close gives back the rest of the
+     batch, so the stream uses only the pad it needs."""
+
+  def __init__(self, claim, release, size):
+    """claim and release are OneTimePad._claim and _release, and size the
+       stream's block size."""
+    self._claim = claim
+    self._release = release
+    self._size = size
+    self._batch = None
+    self._used = 0
+    self._total = 0
+
+  def take(self, count, last):
+    """Returns the Allocation for the next count bytes of the stream, last
+       saying whether they are the end of it."""
+    if self._batch is None or self._used == len(self._batch):
+      # Every block but the last is size bytes, so they use up batches of
+      # whole blocks exactly.
+      if last:
+        grant = count
+      else:
+        blocks = min(self._total // 4, BATCH_SIZE) // self._size
+        grant = max(1, blocks) * self._size
+      try:
+        self._batch = self._claim(grant)
+      except justthisonce.pad.OutOfPad:
+        # The pad left may still cover the stream, a block at a time.
+        if grant == count:
+          raise
+        self._batch = self._claim(count)
+      self._used = 0
+    alloc = self._batch.slice(self._used, count)
+    self._used += count
+    self._total += count
+    return alloc
+
+  def close(self):
+    """Gives back the part of the last batch never handed out, whether the
+       stream ended or failed."""
+    if self._batch is not None and self._used < len(self._batch):
+      self._release(self._batch.slice(self._used,
+                                      len(self._batch) - self._used))
+    self._batch = None
+
+def _makedirs(path):
+  """Creates the directory path and its parents, unless it exists."""
+  try:
+    os.makedirs(path)
+  except OSError:
+    if not os.path.isdir(path):
+      raise
+
 class OneTimePad(object):
+  """Encrypts and decrypts with a pad. Calls may be made from several threads
+     at once: pad is allocated and committed, and the pad's metadata read
+     and written, under a lock, while the encryption itself runs
+     concurrently."""
   def __init__(self, path, create=False):
-    """Loads (or creates, if create=True), the pad located at path."""
+    """Loads (or creates, if create=True), the pad located at path. path may
+       also be a list of paths, one per storage device, to stripe the pad
+       across them."""
     self._path = path
+    self._lock = threading.RLock()
     if create:
       self._pad = justthisonce.pad.createPad(path)
     else:
       self._pad = justthisonce.pad.loadPad(path)
 
-  def generatePad(numBytes, numFiles=1, urandom=True):
+    # Padfiles stay open between messages until they move.
+    self._padfiles = xor.xor.PadfileCache()
+    self._pad.addMoveListener(lambda padfile: self._padfiles.invalidate(
+        self._pad.filesystem.realpath(padfile.path)))
+
+  def close(self):
+    """Closes any padfiles held open."""
+    self._padfiles.close()
+
+  def _claim(self, size):
+    """Allocates and commits size bytes of pad, returning the Allocation.
+       Because we don't know whether a partial file may be readable, pad is
+       committed before it is used. The pad allows only one allocation
+       outstanding at a time, so this holds the lock throughout."""
+    with self._lock:
+      alloc = self._pad.getAllocation(size)
+      self._pad.commitAllocation(alloc)
+    return alloc
+
+  def _release(self, alloc):
+    """Returns pad claimed by _claim but never read to the free pad (see
+       Pad.releaseAllocation)."""
+    with self._lock:
+      self._pad.releaseAllocation(alloc)
+
+  def generatePad(self, numBytes, numFiles=1, urandom=True, progress=None):
     """Generates numFiles new pad files each of size numBytes using
        /dev/random (or /dev/urandom if urandom=True). Returns a list of
-       the files created. Note that without specialized hardware /dev/random
-       will be obscenely slow for any non-tiny files, therefore the default
-       is to use urandom, on which a cryptanalytic attack is theoretically
-       possible, though not known in the non-classified literature."""
+       the names of the files created. Note that without specialized
+       hardware /dev/random will be obscenely slow for any non-tiny files,
+       therefore the default is to use urandom, on which a cryptanalytic
+       attack is theoretically possible, though not known in the
+       non-classified literature.
+
+       Each file is written beside the pad's subdirs and only moved into
+       incoming once complete, so pad is never allocated from a partial
+       file. Each block written is reported to progress if given."""
     if numBytes <= 0 or numFiles < 0:
       raise ValueError("Need non-negative number of files of positive size.")
-  
+
     rng = "/dev/urandom" if urandom else "/dev/random"
-    count = math.ceil(numBytes / BLOCKSIZE)
+    fs = self._pad.filesystem
     new_files = []
-    for i in range(numFiles):
-      uuid = uuidlib.uuid4()
-      while os.path.exists("%s/incoming/%s" % (self._path, uuid)):
-        uuid = uuidlib.uuid4()
-      cmd = "dd if=%s of=%s/incoming/%s bs=%i count=%i 2> /dev/null > /dev/null"
-      if 0 != os.system(cmd % (rng, self._path, uuid.uuid4(), BLOCKSIZE, count)):
-        raise IOError("DD error.")
-      new_files.append("%s/incoming/%s" % uuid)
-
-  def encryptFile(infile, outfile, size=None):
+    with open(rng, "rb") as source:
+      for i in xrange(numFiles):
+        with self._lock:
+          filename = str(uuidlib.uuid4())
+          while fs.exists(("incoming", filename)):
+            filename = str(uuidlib.uuid4())
+          path = fs.realpath(("incoming", filename))
+        partial = os.path.join(os.path.dirname(os.path.dirname(path)),
+                               ".%s.partial" % filename)
+        try:
+          with open(partial, "wb") as output:
+            remaining = numBytes
+            while remaining > 0:
+              started = time.time()
+              data = source.read(min(remaining, BLOCKSIZE))
+              if not data:
+                raise IOError("%s ran dry." % rng)
+              read = time.time()
+              output.write(data)
+              remaining -= len(data)
+              if progress is not None:
+                progress.update(len(data), read=read - started,
+                                write=time.time() - read)
+          os.rename(partial, path)
+        except:
+          if os.path.exists(partial):
+            os.unlink(partial)
+          raise
+        new_files.append(filename)
+    return new_files
+
+  def encryptFile(self, infile, outfile, size=None, container=False,
+                  tree=False, threads=None, codec=None, alloc=None,
+                  progress=None):
     """Encrypts the input file at infile using the pad to outfile. Either/both
-       may be None to use stdin/stdout. If encrypting from stdin, size is the
-       block size to use. (Currently, partial blocks are consumed when
-       encrypting from stdin.) Writes the raw bytes out to the outflie and
-       the metadata is returned as a string."""
-    if size < 0:
-      raise ValueError("size must be >= 0.")
+       may be None to use stdin/stdout. stdin is encrypted as by
+       encryptStream, with blocks of size bytes. Writes the raw bytes out to
+       the outflie and the metadata is returned as a string.
+
+       If container, outfile is instead overwritten with a single file
+       holding both the metadata and the raw bytes (see
+       message.readContainer), and the metadata is still returned. The
+       metadata is written first unless encrypting from stdin, compressing
+       or building a tree, in which case it follows the payload, and on
+       stdout so does a message.containerTrailer in place of the preamble.
+
+       If tree, the metadata includes an integrity.HashTree of the raw bytes,
+       hashed by threads threads (default one per core) once written, so
+       outfile must not be stdout.
+
+       If codec names a compression.Codec, the input is compressed with it
+       before encryption, which is recorded in the metadata. Pad is then
+       claimed as compressed data comes out, as by encryptStream, so just
+       what the compressed payload needs is used. The metadata follows
+       the payload in a container.
 
+       alloc, if given, is pad already claimed for the input (such as a
+       slice of pad claimed for several files at once), which must be
+       exactly its size. Only files can be encrypted with it uncompressed.
+
+       Each buffer encrypted is reported to progress (a
+       progress.Progress) if given."""
     if size is None:
       size = BLOCKSIZE
 
+    if size <= 0:
+      raise ValueError("size must be > 0.")
 
-    if infile is None:
-      # TODO: reclaim the non-used portion of the final alloc.
-      data_length = 0
-      total_alloc = alloc = self._pad.getAllocation(size)
-      self._pad.commitAllocation(alloc)
-      count = xor.xor.xorAllocation(alloc, infile, outfile)
-      data_length += count
-      while count == len(alloc):
-        alloc = self._pad.getAllocation(size)
-        self._pad.commitAllocation(alloc)
-        total_alloc.unionUpdate(alloc)
-        count = xor.xor.xorAllocation(alloc, infile, outfile)
-        data_length += count
-      alloc = total_alloc
+    if tree and outfile is None:
+      raise ValueError("A hash tree needs the payload written to a file.")
+
+    if codec is not None:
+      justthisonce.compression.getCodec(codec)
+
+    if alloc is not None and (infile is None or codec is not None):
+      raise ValueError("Pad can only be given for uncompressed files.")
+
+    # The header is only known once the payload has been written if reading
+    # stdin, compressing or hashing the payload, so then it follows the
+    # payload.
+    header_first = infile is not None and not tree and codec is None
+    trailer = container and not header_first and outfile is None
+
+    # Where the payload starts in outfile, as it is appended to.
+    if container and not header_first and not trailer:
+      with open(outfile, "wb") as output:
+        output.write(justthisonce.message.containerPreamble(0, 0, False))
+      base = justthisonce.message.PREAMBLE_SIZE
+    elif outfile is not None and not container and os.path.exists(outfile):
+      base = os.stat(outfile).st_size
+    else:
+      base = 0
+
+    if infile is None or codec is not None:
+      alloc, data_length = self._encryptPiped(infile, outfile, size, codec,
+                                              progress)
     else:
       data_length = os.stat(infile).st_size
-      alloc = self._pad.getAllocation(data_length)
-      self._pad.commitAllocation(alloc)
-      # Because we don't know whether a partial file may be readable, we commit
-      # the allocation before attempting encryption. It may be rolled back later
-      # if the user is sure it is safe to do so.
-      assert xor.xor.xorAllocation(alloc, infile, outfile) == len(alloc)
+      if alloc is None:
+        alloc = self._claim(data_length)
+      elif len(alloc) != data_length:
+        raise xor.xor.AllocationSizeMismatch(data_length, len(alloc))
+      if container and header_first:
+        # The payload is appended straight after the header.
+        header = justthisonce.message.Message(alloc, data_length).toJSON()
+        preamble = justthisonce.message.containerPreamble(len(header),
+                                                          data_length)
+        if outfile is None:
+          sys.stdout.write(preamble + header)
+          sys.stdout.flush()
+        else:
+          with open(outfile, "wb") as output:
+            output.write(preamble + header)
+
+      # Because we don't know whether a partial file may be readable, we
+      # commit the allocation before attempting encryption. It may be rolled
+      # back later if the user is sure it is safe to do so. Large allocations
+      # are striped across devices, so read them in parallel when we can
+      # seek.
+      if outfile is None:
+        count = xor.xor.xorAllocation(alloc, infile, outfile,
+                                      self._pad.filesystem,
+                                      cache=self._padfiles, lock=self._lock,
+                                      progress=progress)
+      else:
+        count = xor.xor.xorAllocationParallel(alloc, infile, outfile,
+                                              self._pad.filesystem,
+                                              cache=self._padfiles,
+                                              lock=self._lock,
+                                              progress=progress)
+      assert count == len(alloc)
+      if container and header_first:
+        return header
+
+    message = justthisonce.message.Message(alloc, data_length)
+    if codec is not None:
+      message.data["codec"] = codec
+    if tree:
+      message.tree = justthisonce.integrity.HashTree.build(
+          outfile, data_length, base, threads=threads)
+    header = message.toJSON()
+
+    if trailer:
+      sys.stdout.write(header + justthisonce.message.containerTrailer(
+          len(header), data_length))
+      sys.stdout.flush()
+    elif container:
+      with open(outfile, "r+b") as output:
+        output.seek(0, os.SEEK_END)
+        output.write(header)
+        output.seek(0)
+        output.write(justthisonce.message.containerPreamble(
+            len(header), data_length, False))
+
+    # Return the decryption message metadata.
+    return header
+
+  def encryptTree(self, indir, outdir, workers=4, tree=False, archive=False,
+                  batch_files=BATCH_FILES, batch_size=BATCH_SIZE,
+                  progress=None):
+    """Encrypts every regular file under indir into a container at the same
+       relative path under outdir or, if archive, into a
+       message.MessageArchive at outdir under its relative path. The tree is
+       walked first so that pad can be claimed for a batch of files at once
+       (up to batch_files of them or batch_size bytes), and the files are
+       encrypted by a pool of workers threads. tree and progress are as for
+       encryptFile.
+
+       Returns a mapping from relative path to metadata. If any file fails,
+       e.g. because it changed size since the walk, the rest are still
+       encrypted and TreeFailed is raised at the end. The pad claimed for
+       those files is used up all the same."""
+    files = walkTree(indir)
+    _makedirs(outdir)
+    store = scratch = None
+    if archive:
+      store = justthisonce.message.MessageArchive(outdir)
+      scratch = tempfile.mkdtemp(dir=outdir)
+    store_lock = threading.Lock()
+
+    executor = justthisonce.asyncpad.Executor(workers)
+    futures = []
+    try:
+      for batch in _batches(files, batch_files, batch_size):
+        total = sum(size for (relpath, size) in batch)
+        claimed = self._claim(total) if total else justthisonce.pad.Allocation()
+        offset = 0
+        for (relpath, size) in batch:
+          args = (indir, outdir, relpath, claimed.slice(offset, size), tree,
+                  store, scratch, store_lock, progress)
+          futures.append((relpath, executor.submit(self._encryptTreeFile,
+                                                   args)))
+          offset += size
+    finally:
+      executor.shutdown()
+      if archive:
+        shutil.rmtree(scratch)
+        store.close()
+
+    headers = {}
+    failures = {}
+    for (relpath, future) in futures:
+      if future.exception() is None:
+        headers[relpath] = future.result()
+      else:
+        failures[relpath] = future.exception()
+    if failures:
+      raise TreeFailed(failures)
+    return headers
+
+  def _encryptTreeFile(self, indir, outdir, relpath, alloc, tree, store,
+                       scratch, store_lock, progress):
+    """Helper for encryptTree. Encrypts one file with the pad given."""
+    infile = os.path.join(indir, relpath)
+    if store is None:
+      outfile = os.path.join(outdir, relpath)
+      _makedirs(os.path.dirname(outfile))
+      return self.encryptFile(infile, outfile, container=True, tree=tree,
+                              threads=1, alloc=alloc, progress=progress)
+
+    fd, outfile = tempfile.mkstemp(dir=scratch)
+    os.close(fd)
+    try:
+      header = self.encryptFile(infile, outfile, container=True, tree=tree,
+                                threads=1, alloc=alloc, progress=progress)
+      with store_lock:
+        with open(outfile, "rb") as container:
+          store.append(relpath, container)
+    finally:
+      os.unlink(outfile)
+    return header
+
+  def decryptTree(self, indir, outdir, workers=4, archive=False,
+                  verify=True, progress=None):
+    """Decrypts the containers under indir, or the messages of the
+       message.MessageArchive at indir if archive, as written by
+       encryptTree, into files at the same relative paths under outdir,
+       using a pool of workers threads. verify and progress are as for
+       decryptFile. Raises TreeFailed at the end if any fail, including
+       archive entries whose ids would be written outside outdir
+       (UnsafePath); the rest are still decrypted."""
+    if archive:
+      store = justthisonce.message.MessageArchive(indir)
+      relpaths = [entry.id for entry in store.entries()]
+    else:
+      store = None
+      relpaths = [relpath for (relpath, size) in walkTree(indir)]
+
+    executor = justthisonce.asyncpad.Executor(workers)
+    try:
+      futures = [(relpath, executor.submit(self._decryptTreeFile,
+                                           (indir, outdir, relpath, store,
+                                            verify, progress)))
+                 for relpath in relpaths]
+    finally:
+      executor.shutdown()
+      if archive:
+        store.close()
+    failures = dict((relpath, future.exception())
+                    for (relpath, future) in futures
+                    if future.exception() is not None)
+    if failures:
+      raise TreeFailed(failures)
+
+  def _decryptTreeFile(self, indir, outdir, relpath, store, verify,
+                       progress):
+    """Helper for decryptTree. Decrypts one message."""
+    outfile = _treePath(outdir, relpath)
+    _makedirs(os.path.dirname(outfile))
+    if store is not None:
+      message, path, base = store.locatePayload(relpath)
+      self.decryptFile(message, path, outfile, base, verify, threads=1,
+                       progress=progress)
+      return
+    infile = os.path.join(indir, relpath)
+    with open(infile, "rb") as fd:
+      message, base, length = justthisonce.message.readContainer(fd)
+    self.decryptFile(message, infile, outfile, base, verify, threads=1,
+                     progress=progress)
+
+  def _encryptPiped(self, infile, outfile, size, codec, progress):
+    """Helper for encryptFile. Appends infile, compressed with codec if
+       given, encrypted to outfile (either may be None for stdin/stdout).
+       Returns the allocation used and the length of the payload."""
+    source = sys.stdin if infile is None else open(infile, "rb")
+    output = sys.stdout if outfile is None else open(outfile, "ab")
+    try:
+      return self._encryptStream(source, output, size, codec, progress,
+                                 AHEAD)
+    finally:
+      if source is not sys.stdin:
+        source.close()
+      if output is not sys.stdout:
+        output.close()
+      else:
+        output.flush()
+
+  def encryptStream(self, source, output, size=None, codec=None,
+                    progress=None, ahead=AHEAD, trailer=False):
+    """Encrypts everything read from the file-like object source to output,
+       compressing it first with codec if given, as for encryptFile. Neither
+       needs to be seekable. Pad is claimed (allocated and committed) in
+       batches of whole blocks of size bytes as data arrives, each a quarter
+       of the stream so far, up to BATCH_SIZE. Whatever is left of the last
+       batch when the stream ends is given back, so the stream uses exactly
+       the pad it needs. Each block is reported to progress if given.
+       Returns the metadata as a string.
+
+       source is read by a thread of its own, up to ahead blocks ahead of
+       the block being written, so reading and writing overlap. Pad is
+       claimed and read in this thread as each block is written, so none is
+       claimed once encryptStream has returned or raised. At most ahead + 3
+       blocks of data, and one of pad, are held at once.
+
+       If trailer, the metadata and a message.containerTrailer follow the
+       payload in output, making it a container."""
+    if size is None:
+      size = BLOCKSIZE
+    if size <= 0:
+      raise ValueError("size must be > 0.")
+    if ahead < 1:
+      raise ValueError("ahead must be > 0.")
+    if codec is not None:
+      justthisonce.compression.getCodec(codec)
+    alloc, data_length = self._encryptStream(source, output, size, codec,
+                                             progress, ahead)
+    message = justthisonce.message.Message(alloc, data_length)
+    if codec is not None:
+      message.data["codec"] = codec
+    header = message.toJSON()
+    if trailer:
+      output.write(header + justthisonce.message.containerTrailer(
+          len(header), data_length))
+    return header
+
+  def _encryptStream(self, source, output, size, codec, progress, ahead):
+    """Helper for encryptStream. Returns the allocation used and the length
+       of the payload."""
+    builder = justthisonce.pad.AllocationBuilder()
+    reservation = _Reservation(self._claim, self._release, size)
+
+    def write(((data, read), last)):
+      started = time.time()
+      alloc = reservation.take(len(data), last)
+      builder.addAllocation(alloc)
+      key = self._readPad(alloc, 0, len(data))
+      _writeBlock(output, progress, None,
+                  (data, key, read + time.time() - started))
+
+    try:
+      _pipeline(_markLast(_readBlocks(source, size, codec)), write, ahead)
+    finally:
+      reservation.close()
+    alloc = builder.build()
+    return alloc, len(alloc)
+
+  def _resolve(self, alloc):
+    """Returns alloc, with the detached padfiles of a message read without a
+       lookup replaced by the pad's own, wherever they are, so that the XOR
+       engines can find them. Raises IOError if one is missing."""
+    if all(padfile.subdir is not None for (ival, padfile) in alloc.iterFiles()):
+      return alloc
+
+    def lookup(filename):
+      padfile = self._pad.findPadfile(filename)
+      if padfile is None:
+        raise IOError("Padfile %s is missing." % filename)
+      return padfile
+    with self._lock:
+      return justthisonce.pad.Allocation.fromSerializationState(
+          alloc.toSerializationState(), lookup)
+
+  def _readPad(self, alloc, offset, length):
+    """Returns the pad behind length bytes of a payload using alloc from
+       offset."""
+    key = []
+    for (padfile, start, count) in alloc.locate(offset, length):
+      # Messages read without a lookup don't know where their padfiles are.
+      if padfile.subdir is None:
+        filename = padfile.filename
+        with self._lock:
+          padfile = self._pad.findPadfile(filename)
+        if padfile is None:
+          raise IOError("Padfile %s is missing." % filename)
+      with self._lock:
+        pad = self._padfiles.checkout(
+            self._pad.filesystem.realpath(padfile.path))
+      try:
+        pad.seek(start)
+        key.append(pad.read(count))
+      except:
+        self._padfiles.discard(pad)
+        raise
+      self._padfiles.checkin(pad)
+      if len(key[-1]) != count:
+        raise IOError("Short read from padfile %s." % padfile.filename)
+    return "".join(key)
+
+  def verify(self, message, payload, base=0, threads=None):
+    """Checks the whole payload of the message, a path or seekable file
+       object in which it starts at base, against the message's hash tree
+       using threads threads (default one per core). Raises
+       integrity.IntegrityError naming the chunks that do not match. Returns
+       False if the message has no tree to check, otherwise True."""
+    tree = message.tree
+    if tree is None:
+      return False
+    tree.verify(payload, base, threads=threads)
+    return True
+
+  def decryptRange(self, message, payload, offset, length, base=0,
+                   verify=True):
+    """Decrypts length bytes of the message's payload from offset, reading
+       only the ciphertext and pad for them. payload is the path of the
+       payload or a seekable file object, in which it starts at base (as in a
+       container). Returns the plaintext. If verify and the message has a
+       hash tree, the chunks holding the range are checked against it
+       first. Ranges of compressed payloads cannot be decrypted on their own;
+       use decryptFile."""
+    if "codec" in message.data:
+      raise ValueError("Cannot decrypt a range of a compressed payload.")
+    if offset < 0 or length < 0 or offset + length > message.length:
+      raise ValueError("Range is outside the %i byte payload." %
+                       message.length)
+
+    fd = open(payload, "rb") if isinstance(payload, basestring) else payload
+    try:
+      tree = message.tree if verify else None
+      if tree is not None:
+        tree.verify(fd, base, offset, length)
+      fd.seek(base + offset)
+      data = fd.read(length)
+      if len(data) != length:
+        raise IOError("Short read while decrypting.")
+      plaintext = xor.xor.xorStrings(
+          data, self._readPad(message.allocation, offset, length))
+    finally:
+      if fd is not payload:
+        fd.close()
+    return plaintext
+
+  def decryptFile(self, message, payload, outfile, base=0, verify=True,
+                  threads=None, progress=None):
+    """Decrypts the message's payload, a path or seekable file object in
+       which it starts at base, to outfile (None for stdout), decompressing
+       it if it was compressed. If verify and the message has a hash tree,
+       the payload is checked against it first by threads threads. Each
+       block decrypted is reported to progress if given.
+
+       An uncompressed payload given by path is decrypted by the XOR engines
+       (reading the pad on each device in parallel if outfile is a file);
+       anything else is decrypted as by decryptStream."""
+    if verify:
+      self.verify(message, payload, base, threads)
+    if "codec" in message.data:
+      justthisonce.compression.getCodec(message.data["codec"])
+    elif isinstance(payload, basestring):
+      alloc = self._resolve(message.allocation)
+      if len(alloc) != message.length:
+        raise justthisonce.message.BadMessage("Allocation does not match "
+                                              "the payload length.")
+      if outfile is None:
+        sys.stdout.flush()
+        xor.xor.xorAllocation(alloc, payload, None, self._pad.filesystem,
+                              cache=self._padfiles, lock=self._lock,
+                              progress=progress, inbase=base)
+      else:
+        # The engines append, so start from an empty file.
+        open(outfile, "wb").close()
+        xor.xor.xorAllocationParallel(alloc, payload, outfile,
+                                      self._pad.filesystem,
+                                      cache=self._padfiles, lock=self._lock,
+                                      progress=progress, inbase=base)
+      return
+
+    fd = open(payload, "rb") if isinstance(payload, basestring) else payload
+    output = sys.stdout if outfile is None else open(outfile, "wb")
+    try:
+      fd.seek(base)
+      self._decryptStream(message, fd, output, progress, BLOCKSIZE, AHEAD)
+    finally:
+      if fd is not payload:
+        fd.close()
+      if output is not sys.stdout:
+        output.close()
+      else:
+        output.flush()
+
+  def decryptStream(self, message, source, output, progress=None, size=None,
+                    ahead=AHEAD):
+    """Decrypts the message's payload, read from the file-like object source
+       (which need not be seekable), to output, decompressing it if it was
+       compressed. The payload is not checked against any hash tree, as
+       that needs to seek; see decryptFile. progress is as for decryptFile,
+       and source is read size bytes at a time, ahead as for
+       encryptStream. What a block decompresses to is written size bytes
+       at a time (see compression.decompressPieces), so memory stays
+       bounded as for encryptStream however much the payload expands."""
+    if size is None:
+      size = BLOCKSIZE
+    if size <= 0 or ahead < 1:
+      raise ValueError("size and ahead must be > 0.")
+    self._decryptStream(message, source, output, progress, size, ahead)
+
+  def _decryptStream(self, message, source, output, progress, size, ahead):
+    """Helper for decryptFile and decryptStream."""
+    codec = message.data.get("codec")
+    decompressor = None
+    if codec is not None:
+      decompressor = justthisonce.compression.getCodec(codec).decompressor()
+
+    def blocks():
+      for offset in xrange(0, message.length, size):
+        count = min(size, message.length - offset)
+        started = time.time()
+        data = source.read(count)
+        if len(data) != count:
+          raise IOError("Short read while decrypting.")
+        yield offset, data, time.time() - started
+
+    def write((offset, data, read)):
+      started = time.time()
+      key = self._readPad(message.allocation, offset, len(data))
+      _writeBlock(output, progress, decompressor,
+                  (data, key, read + time.time() - started))
+
+    _pipeline(blocks(), write, ahead)
+    if decompressor is not None:
+      output.write(decompressor.flush())
+
+  def makeNotification(self, incremental=False):
+    """Returns a pad use notification, as a string, covering all use of the
+       pad or (if incremental) only use since the last one that was marked
+       as synced. Call markSynced with it once it has been delivered."""
+    with self._lock:
+      used = self._pad.makeNotification(incremental)
+      return justthisonce.message.Notification(used, incremental).toJSON()
+
+  def markSynced(self, notification):
+    """Records that the pad use in notification (a string or file, as
+       returned by makeNotification) has been reported to peers. Use since
+       it was made is left for the next incremental notification."""
+    used = justthisonce.message.Notification.fromJSON(notification).extents
+    with self._lock:
+      self._pad.markSynced(used)
+
+  def processNotification(self, string_or_fd):
+    """Marks the pad use reported by a peer's notification as used here.
+       Returns the padfiles named in it that this pad does not have."""
+    notification = justthisonce.message.Notification.fromJSON(string_or_fd)
+    with self._lock:
+      return self._pad.processNotification(notification.extents)
 
-    # Create the decryption message metadata.
-    return justthisonce.Message(alloc, data_length).toJSON()
+  def processNotifications(self, sources):
+    """Marks the pad use reported by any number of notifications or message
+       headers (strings or files) as used here, merging each padfile once and
+       committing once. Returns (unknown, overlaps) as for
+       Pad.processNotifications; overlaps may indicate pad reuse."""
+    used = (justthisonce.message.Notification.read(source).extents
+            for source in sources)
+    used = list(used)
+    with self._lock:
+      return self._pad.processNotifications(used)
@@ -0,0 +1,180 @@
+"""
+A non-blocking interface to OneTimePad for services handling many messages
+at once. Each call is queued for a dedicated pool of worker threads, which do
+the disk and CPU work, and returns a Future straight away. A Future can be
+waited on, or given callbacks to run when it completes, e.g. to hand the
+result back to an event loop.
+
+The queue is bounded, so a caller submitting work faster than the disks can
+keep up is held back in submit (or told so, if it asked not to block) rather
+than queueing without limit. OneTimePad serializes allocating and committing
+pad itself, so the workers never hand out the same pad twice.
+"""
+
+import Queue
+import sys
+import threading
+
+import justthisonce.api
+
+class Error(Exception):
+  """Base error for the asyncpad module."""
+
+class Busy(Error):
+  """The queue is full and the caller asked not to block."""
+
+class Closed(Error):
+  """Work was submitted after shutdown."""
+
+class Timeout(Error):
+  """A Future did not complete in time."""
+
+class Future(object):
+  """The eventual result of a call running on an Executor."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def done(self):
+    """Returns whether the call has completed."""
+    return self._done.is_set()
+
+  def wait(self, timeout=None):
+    """Waits up to timeout seconds (forever if None) for the call to
+       complete. Raises Timeout if it does not."""
+    if not self._done.wait(timeout):
+      raise Timeout()
+
+  def result(self, timeout=None):
+    """Returns the result of the call, waiting as for wait. If the call
+       raised, raises the same exception."""
+    self.wait(timeout)
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    """Returns the exception the call raised, or None, waiting as for
+       wait."""
+    self.wait(timeout)
+    return self._exc_info[1] if self._exc_info is not None else None
+
+  def addDoneCallback(self, callback):
+    """Calls callback with the Future once it has completed, from the worker
+       thread that completed it, or at once if it already has."""
+    with self._lock:
+      if not self._done.is_set():
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  def _complete(self, result, exc_info):
+    """Records the outcome of the call and runs the callbacks."""
+    with self._lock:
+      self._result = result
+      self._exc_info = exc_info
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      try:
+        callback(self)
+      except Exception:
+        # One bad callback must not stop the others or kill the worker.
+        sys.excepthook(*sys.exc_info())
+
+class Executor(object):
+  """A fixed pool of worker threads taking calls from a bounded queue."""
+
+  def __init__(self, workers=4, queue_size=None):
+    """Starts workers threads. At most queue_size calls (default four per
+       worker) wait for a free worker."""
+    if workers < 1:
+      raise ValueError("Need at least one worker.")
+    self._queue = Queue.Queue(queue_size or 4 * workers)
+    self._closed = False
+    self._threads = [threading.Thread(target=self._work)
+                     for i in xrange(workers)]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def submit(self, func, args=(), kw=None, block=True):
+    """Queues func(*args, **kw) and returns its Future. If the queue is full,
+       waits for room, or raises Busy if not block."""
+    if self._closed:
+      raise Closed()
+    future = Future()
+    try:
+      self._queue.put((future, func, args, kw or {}), block)
+    except Queue.Full:
+      raise Busy()
+    return future
+
+  def shutdown(self, wait=True):
+    """Stops accepting calls. The workers finish what is queued and exit; if
+       wait, this returns once they have."""
+    if self._closed:
+      return
+    self._closed = True
+    for thread in self._threads:
+      self._queue.put(None)
+    if wait:
+      for thread in self._threads:
+        thread.join()
+
+  def _work(self):
+    """Body of each worker thread."""
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      future, func, args, kw = item
+      try:
+        result = func(*args, **kw)
+      except BaseException:
+        future._complete(None, sys.exc_info())
+      else:
+        future._complete(result, None)
+
+def _background(name):
+  """Makes a method of AsyncOneTimePad that queues the OneTimePad method
+     called name."""
+  def method(self, *args, **kw):
+    return self._executor.submit(getattr(self._otp, name), args, kw,
+                                 self._block)
+  method.__name__ = name
+  method.__doc__ = "As OneTimePad.%s, but returns a Future of its result." % \
+                   name
+  return method
+
+class AsyncOneTimePad(object):
+  """A OneTimePad whose calls run on an Executor and return Futures. Streams
+     passed to encryptStream and decryptStream are read and written by the
+     worker, so they must not be used until the Future completes."""
+
+  def __init__(self, path, create=False, workers=4, queue_size=None,
+               block=True):
+    """Loads (or creates) the pad at path as OneTimePad does, with an
+       Executor of the given size. If not block, calls raise Busy rather
+       than waiting when the queue is full."""
+    self._otp = justthisonce.api.OneTimePad(path, create)
+    self._executor = Executor(workers, queue_size)
+    self._block = block
+
+  encryptFile = _background("encryptFile")
+  encryptStream = _background("encryptStream")
+  decryptFile = _background("decryptFile")
+  decryptStream = _background("decryptStream")
+  decryptRange = _background("decryptRange")
+  verify = _background("verify")
+  makeNotification = _background("makeNotification")
+  processNotifications = _background("processNotifications")
+
+  def close(self):
+    """Finishes the queued calls and closes the pad."""
+    self._executor.shutdown()
+    self._otp.close()
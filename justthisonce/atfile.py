@@ -0,0 +1,64 @@
+"""
+Wrappers for the directory-relative (*at) family of syscalls, which the os
+module of Python 2 does not provide. These let a Filesystem hold directory
+file descriptors and resolve names relative to them, rather than walking and
+checking full paths on every operation. AVAILABLE is False where the calls
+(or the Linux flag values below) cannot be used.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import sys
+
+# Linux values for flags Python 2 does not export.
+O_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+O_PATH = 0o10000000
+AT_SYMLINK_NOFOLLOW = 0x100
+
+try:
+  _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  _openat = _libc.openat
+  _renameat = _libc.renameat
+  _mkdirat = _libc.mkdirat
+  _faccessat = _libc.faccessat
+except (OSError, AttributeError):
+  AVAILABLE = False
+else:
+  AVAILABLE = sys.platform.startswith("linux")
+  _openat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_int]
+  _renameat.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                        ctypes.c_int, ctypes.c_char_p]
+  _mkdirat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+  _faccessat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                         ctypes.c_int]
+
+def _encode(name):
+  """Converts a name to the bytes the syscalls expect."""
+  if isinstance(name, unicode):
+    return name.encode(sys.getfilesystemencoding())
+  return name
+
+def _check(result, name):
+  """Raises OSError as the os module would if a syscall failed."""
+  if result < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), name)
+  return result
+
+def openat(dirfd, name, flags, mode=0o666):
+  """Opens name relative to the directory dirfd. Returns the new fd."""
+  return _check(_openat(dirfd, _encode(name), flags, mode), name)
+
+def renameat(olddirfd, oldname, newdirfd, newname):
+  """Renames oldname in olddirfd to newname in newdirfd."""
+  _check(_renameat(olddirfd, _encode(oldname), newdirfd, _encode(newname)),
+         oldname)
+
+def mkdirat(dirfd, name, mode=0o777):
+  """Creates the directory name in dirfd."""
+  _check(_mkdirat(dirfd, _encode(name), mode), name)
+
+def exists(dirfd, name):
+  """Returns whether name exists in dirfd, without following symlinks."""
+  return _faccessat(dirfd, _encode(name), os.F_OK, AT_SYMLINK_NOFOLLOW) == 0
@@ -0,0 +1,99 @@
+"""
+Streaming compression of payloads before they are encrypted, so that
+compressible messages use less pad. zlib is always available; lzma and zstd
+are used if their modules are installed. A message records the name of its
+codec, so the receiver must have the same module to decrypt it.
+"""
+
+import collections
+import zlib
+
+class Error(Exception):
+  """Base error for the compression module."""
+
+class UnknownCodec(Error):
+  """The codec is not known or its module is not installed."""
+
+class Codec(object):
+  """A compression format. compressor and decompressor make streaming
+     objects with the interface of zlib's compressobj and decompressobj,
+     including decompress's max_length and unconsumed_tail."""
+  def __init__(self, name, compressor, decompressor):
+    self.name = name
+    self.compressor = compressor
+    self.decompressor = decompressor
+
+class _Flushless(object):
+  """Adapts a decompressor without a flush method, which keeps nothing
+     back, to the zlib interface. Without a way to limit its output, at most
+     max_length bytes of input are decompressed at a time, so the output is
+     bounded by the format's worst expansion of that rather than by
+     max_length itself."""
+  def __init__(self, decompressor):
+    self._decompressor = decompressor
+    self.unconsumed_tail = ""
+
+  def decompress(self, data, max_length=0):
+    if max_length:
+      data, self.unconsumed_tail = data[:max_length], data[max_length:]
+    return self._decompressor.decompress(data)
+
+  def flush(self):
+    return ""
+
+# Mapping from name to Codec of those available.
+CODECS = collections.OrderedDict()
+CODECS["zlib"] = Codec("zlib", zlib.compressobj, zlib.decompressobj)
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+if lzma is not None:
+  CODECS["lzma"] = Codec("lzma", lzma.LZMACompressor,
+                         lambda: _Flushless(lzma.LZMADecompressor()))
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+if zstandard is not None:
+  CODECS["zstd"] = Codec(
+      "zstd", lambda: zstandard.ZstdCompressor().compressobj(),
+      lambda: _Flushless(zstandard.ZstdDecompressor().decompressobj()))
+
+def getCodec(name):
+  """Returns the Codec with the given name. Raises UnknownCodec if it is
+     not available."""
+  try:
+    return CODECS[name]
+  except KeyError:
+    raise UnknownCodec("Unknown or unavailable codec %r." % name)
+
+def decompressPieces(decompressor, data, size):
+  """Yields what decompressor (made by a Codec) produces from data in pieces
+     of at most size bytes, so that data which expands a lot is never held
+     in memory at once."""
+  while data:
+    piece = decompressor.decompress(data, size)
+    data = decompressor.unconsumed_tail
+    if piece:
+      yield piece
+
+def compressStream(fd, name, size):
+  """Reads fd to the end, size bytes at a time, yielding its contents
+     compressed with the named codec in pieces as they are produced."""
+  compressor = getCodec(name).compressor()
+  while True:
+    data = fd.read(size)
+    if not data:
+      break
+    piece = compressor.compress(data)
+    if piece:
+      yield piece
+  piece = compressor.flush()
+  if piece:
+    yield piece
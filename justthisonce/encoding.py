@@ -0,0 +1,147 @@
+"""
+Compact binary encodings shared by messages, notifications and the pad
+metadata. Integers are stored as unsigned LEB128 varints and sorted atoms as
+runs of (gap since the end of the previous atom, length), so the size of an
+encoding depends on how fragmented it is rather than on the offsets involved.
+"""
+
+import zlib
+
+# Version of the allocation encoding. It shares the first byte of an encoded
+# allocation with the flags.
+ALLOCATION_VERSION = 1
+_FLAG_ZLIB = 0x80
+
+class Error(Exception):
+  """Base error for the encoding module."""
+
+class BadEncoding(Error):
+  """The data is truncated or is not a valid encoding."""
+
+def encodeVarint(value):
+  """Encodes a non-negative integer as a varint string."""
+  assert value >= 0
+  out = []
+  while value >= 0x80:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+  return "".join(out)
+
+def decodeVarint(data, pos=0):
+  """Decodes the varint at data[pos:]. Returns (value, position after it)."""
+  value = 0
+  shift = 0
+  while True:
+    if pos >= len(data):
+      raise BadEncoding("Truncated varint.")
+    byte = ord(data[pos])
+    pos += 1
+    value |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return value, pos
+    shift += 7
+
+def encodeAtoms(atoms):
+  """Encodes a sorted sequence of disjoint (start, length) pairs, such as
+     Interval.toAtoms returns, prefixed with their count."""
+  out = [encodeVarint(len(atoms))]
+  end = 0
+  for (start, length) in atoms:
+    assert start >= end and length > 0
+    out.append(encodeVarint(start - end))
+    out.append(encodeVarint(length))
+    end = start + length
+  return "".join(out)
+
+def decodeAtoms(data, pos=0):
+  """Inverse of encodeAtoms. Returns (atoms, position after them)."""
+  count, pos = decodeVarint(data, pos)
+  atoms = []
+  end = 0
+  for i in xrange(count):
+    gap, pos = decodeVarint(data, pos)
+    length, pos = decodeVarint(data, pos)
+    if length == 0:
+      raise BadEncoding("Zero-length atom.")
+    atoms.append((end + gap, length))
+    end += gap + length
+  return atoms, pos
+
+def encodeAllocation(files, compress=False):
+  """Encodes (filename, atoms) pairs, as Allocation.toSerializationState
+     returns. The encoding is a version and flags byte, then a table of the
+     filenames, then the atoms of each file in table order. If compress, all
+     but the first byte is zlib compressed."""
+  files = list(files)
+  body = [encodeVarint(len(files))]
+  for (filename, atoms) in files:
+    if isinstance(filename, unicode):
+      filename = filename.encode("utf-8")
+    body.append(encodeVarint(len(filename)))
+    body.append(filename)
+  for (filename, atoms) in files:
+    body.append(encodeAtoms(atoms))
+  body = "".join(body)
+
+  header = ALLOCATION_VERSION
+  if compress:
+    header |= _FLAG_ZLIB
+    body = zlib.compress(body)
+  return chr(header) + body
+
+def _allocationBody(data):
+  """Helper for decodeAllocation and iterAllocation. Returns the body of the
+     encoded allocation, its filenames, and the position of the atoms."""
+  if not data:
+    raise BadEncoding("Empty allocation.")
+  header = ord(data[0])
+  if header & ~_FLAG_ZLIB != ALLOCATION_VERSION:
+    raise BadEncoding("Unknown allocation encoding %i." % header)
+  body = data[1:]
+  if header & _FLAG_ZLIB:
+    try:
+      body = zlib.decompress(body)
+    except zlib.error:
+      raise BadEncoding("Corrupt compressed allocation.")
+
+  count, pos = decodeVarint(body)
+  filenames = []
+  for i in xrange(count):
+    length, pos = decodeVarint(body, pos)
+    if pos + length > len(body):
+      raise BadEncoding("Truncated filename.")
+    try:
+      filenames.append(body[pos:pos + length].decode("utf-8"))
+    except UnicodeDecodeError:
+      raise BadEncoding("Filename is not UTF-8.")
+    pos += length
+  return body, filenames, pos
+
+def decodeAllocation(data):
+  """Inverse of encodeAllocation. Returns a list of (filename, atoms)."""
+  body, filenames, pos = _allocationBody(data)
+  files = []
+  for filename in filenames:
+    atoms, pos = decodeAtoms(body, pos)
+    files.append((filename, atoms))
+  if pos != len(body):
+    raise BadEncoding("Trailing data after allocation.")
+  return files
+
+def iterAllocation(data):
+  """Yields the atoms of an encoded allocation as (filename, start, length),
+     decoding them as it goes rather than all up front."""
+  body, filenames, pos = _allocationBody(data)
+  for filename in filenames:
+    count, pos = decodeVarint(body, pos)
+    end = 0
+    for i in xrange(count):
+      gap, pos = decodeVarint(body, pos)
+      length, pos = decodeVarint(body, pos)
+      if length == 0:
+        raise BadEncoding("Zero-length atom.")
+      yield filename, end + gap, length
+      end += gap + length
+  if pos != len(body):
+    raise BadEncoding("Trailing data after allocation.")
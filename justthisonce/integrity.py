@@ -0,0 +1,211 @@
+"""
+Chunked hash trees over message payloads. The payload is cut into fixed size
+chunks which are hashed independently, so a payload can be hashed or checked
+by as many threads as there are cores, and a range of it can be checked by
+reading only the chunks it touches. The chunk hashes are the leaves of a
+Merkle tree whose root commits to all of them.
+
+Trees are built over the ciphertext rather than the plaintext: a hash of the
+plaintext sent in the clear would let anyone confirm a guess at it, and a
+tree over the ciphertext can be checked without the pad.
+"""
+
+import base64
+import binascii
+import hashlib
+import multiprocessing
+import sys
+import threading
+
+ALGORITHM = "sha256"
+DIGEST_SIZE = hashlib.new(ALGORITHM).digest_size
+CHUNK_SIZE = 1024 * 1024
+
+# Prefixes keeping leaves and interior nodes from being confused.
+_LEAF = "\x00"
+_NODE = "\x01"
+
+class Error(Exception):
+  """Base error for the integrity module."""
+
+class BadTree(Error):
+  """A recorded tree is malformed or its leaves do not match its root."""
+
+class IntegrityError(Error):
+  """Some chunks of a payload do not match the tree. args are the indices
+     of the bad chunks."""
+
+def hashChunk(data):
+  """Returns the leaf hash of a chunk."""
+  return hashlib.new(ALGORITHM, _LEAF + data).digest()
+
+def merkleRoot(leaves):
+  """Returns the root of the tree over the leaf hashes. A node without a
+     sibling is promoted to the level above unchanged."""
+  level = list(leaves)
+  if not level:
+    return hashlib.new(ALGORITHM, _NODE).digest()
+  while len(level) > 1:
+    paired = [hashlib.new(ALGORITHM, _NODE + level[i] + level[i + 1]).digest()
+              for i in xrange(0, len(level) - 1, 2)]
+    if len(level) % 2:
+      paired.append(level[-1])
+    level = paired
+  return level[0]
+
+def defaultThreads():
+  """Returns the number of threads to hash with: one per core."""
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+class _Reader(object):
+  """Reads chunks of a payload for hashing threads. Given a path, each
+     thread gets its own file. A file object is shared, so only the seek and
+     read are serialized and the hashing still runs in parallel."""
+  def __init__(self, payload, base):
+    self._path = payload if isinstance(payload, basestring) else None
+    self._fd = None if self._path else payload
+    self._base = base
+    self._lock = threading.Lock()
+
+  def open(self):
+    """Returns a file for one thread to read with."""
+    return open(self._path, "rb") if self._path else self._fd
+
+  def close(self, fd):
+    """Closes a file returned by open."""
+    if self._path:
+      fd.close()
+
+  def read(self, fd, offset, length):
+    """Reads length bytes of the payload from offset."""
+    if fd is self._fd:
+      with self._lock:
+        fd.seek(self._base + offset)
+        data = fd.read(length)
+    else:
+      fd.seek(self._base + offset)
+      data = fd.read(length)
+    if len(data) != length:
+      raise IOError("Payload is truncated at offset %i." % offset)
+    return data
+
+def _hashChunks(payload, base, length, chunk_size, indices, threads):
+  """Hashes the chunks of the payload with the given indices, splitting them
+     between up to threads threads. Returns a mapping from index to hash."""
+  reader = _Reader(payload, base)
+  indices = list(indices)
+  threads = max(1, min(threads or defaultThreads(), len(indices)))
+  hashes = {}
+  errors = []
+
+  def worker(share):
+    fd = reader.open()
+    try:
+      for index in share:
+        start = index * chunk_size
+        hashes[index] = hashChunk(reader.read(
+            fd, start, min(chunk_size, length - start)))
+    except BaseException:
+      # Kept whatever it is, so that no chunk goes unhashed unnoticed.
+      errors.append(sys.exc_info())
+    finally:
+      reader.close(fd)
+
+  # Contiguous shares keep each thread reading sequentially.
+  share = -(-len(indices) // threads) if indices else 0
+  workers = [threading.Thread(target=worker,
+                              args=(indices[i * share:(i + 1) * share],))
+             for i in xrange(threads)]
+  if len(workers) == 1:
+    workers[0].run()
+  else:
+    for thread in workers:
+      thread.start()
+    for thread in workers:
+      thread.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return hashes
+
+class HashTree(object):
+  """The chunk hashes of a payload of length bytes, and their root."""
+
+  def __init__(self, length, leaves, chunk_size=CHUNK_SIZE):
+    self.length = length
+    self.chunk_size = chunk_size
+    self.leaves = list(leaves)
+    if len(self.leaves) != -(-length // chunk_size):
+      raise BadTree("%i leaves for %i bytes." % (len(self.leaves), length))
+    self.root = merkleRoot(self.leaves)
+
+  def __eq__(self, other):
+    return isinstance(other, HashTree) and self.length == other.length and \
+           self.chunk_size == other.chunk_size and self.root == other.root
+
+  def __ne__(self, other):
+    return not self == other
+
+  @classmethod
+  def build(klass, payload, length, base=0, chunk_size=CHUNK_SIZE,
+            threads=None):
+    """Hashes length bytes of payload, a path or seekable file object in
+       which the payload starts at base, using threads threads (default one
+       per core)."""
+    count = -(-length // chunk_size)
+    hashes = _hashChunks(payload, base, length, chunk_size, xrange(count),
+                         threads)
+    return klass(length, (hashes[i] for i in xrange(count)), chunk_size)
+
+  def chunks(self, offset, length):
+    """Returns the indices of the chunks holding length bytes from offset."""
+    if length <= 0:
+      return xrange(0)
+    return xrange(offset // self.chunk_size,
+                  (offset + length - 1) // self.chunk_size + 1)
+
+  def verify(self, payload, base=0, offset=0, length=None, threads=None):
+    """Checks the chunks of payload (as for build) holding length bytes from
+       offset, or all of them, against the tree, using threads threads.
+       Raises IntegrityError naming any that do not match."""
+    if length is None:
+      length = self.length - offset
+    if offset < 0 or length < 0 or offset + length > self.length:
+      raise ValueError("Range is outside the %i byte payload." % self.length)
+    indices = self.chunks(offset, length)
+    hashes = _hashChunks(payload, base, self.length, self.chunk_size, indices,
+                         threads)
+    # A chunk that was not hashed at all counts as bad.
+    bad = [index for index in indices
+           if hashes.get(index) != self.leaves[index]]
+    if bad:
+      raise IntegrityError(*bad)
+
+  def toData(self):
+    """Returns the tree as a JSON-compatible dict for a message header."""
+    return {"algorithm": ALGORITHM, "chunk_size": self.chunk_size,
+            "length": self.length,
+            "leaves": base64.b64encode("".join(self.leaves)),
+            "root": binascii.hexlify(self.root)}
+
+  @classmethod
+  def fromData(klass, data):
+    """Inverse of toData. Checks the leaves against the root."""
+    try:
+      if data["algorithm"] != ALGORITHM:
+        raise BadTree("Unknown hash algorithm %r." % data["algorithm"])
+      leaves = base64.b64decode(data["leaves"])
+      if len(leaves) % DIGEST_SIZE or data["chunk_size"] <= 0:
+        raise BadTree("Malformed tree.")
+      self = klass(data["length"],
+                   (leaves[i:i + DIGEST_SIZE]
+                    for i in xrange(0, len(leaves), DIGEST_SIZE)),
+                   data["chunk_size"])
+      root = binascii.unhexlify(data["root"])
+    except (KeyError, TypeError):
+      raise BadTree("Malformed tree.")
+    if self.root != root:
+      raise BadTree("Leaves do not match the root.")
+    return self
@@ -2,17 +2,44 @@
 Provides the Interval class for describing integer intervals on a numberline.
 """
 
+from array import array
+import bisect
+import heapq
+import itertools
+
+import encoding
 import invariant
 
+# Typecode of the arrays holding extents. A C long is 64 bits on the platforms
+# we support, which bounds the size of a padfile.
+_TYPECODE = 'l'
+
+# Unions with at most this many atoms are done by inserting each atom in
+# place; larger ones are merged linearly.
+_INSERT_LIMIT = 16
+
+# Number of extents per chunk of an ExtentSet. Chunks are split when they grow
+# to twice this.
+_CHUNK_LOAD = 256
+
+# Number of points covered by each container of an ExtentBitmap, and the
+# bitmap of a full container.
+_CONTAINER_SIZE = 1 << 16
+_FULL = (1 << _CONTAINER_SIZE) - 1
+
 class Interval(object):
   """Provides the Interval class for describing integer intervals on a
-     numberline."""
+     numberline. The extents are kept sorted in parallel arrays of starts and
+     lengths, which is far more compact than tuples and lets lookups and
+     small unions bisect instead of walking every extent."""
   __metaclass__ = invariant.EnforceInvariant
+  __slots__ = ("_starts", "_lengths", "_size")
 
   def __init__(self):
     """Creates an empty interval"""
     self._size = 0
-    self._extents = ()
+    self._starts = array(_TYPECODE)
+    self._lengths = array(_TYPECODE)
 
   @classmethod
   def fromAtom(klass, start, length):
@@ -20,7 +47,8 @@ class Interval(object):
        of specified start and length. Length must be >= 0."""
     atom = Interval()
     if length != 0:
-      atom._extents = ((start, length),)
+      atom._starts.append(start)
+      atom._lengths.append(length)
     atom._size = length
     atom._checkInvariant()
     return atom
@@ -30,24 +58,69 @@ class Interval(object):
     """Factory method that creates an interval consisting of the specified
        (start, length) pairs. They need not be sorted and zero-length atoms
        are allowed, but all atoms must be disjoint."""
-    atom = Interval()
-    atom._extents = tuple(sorted([a for a in atoms if a[1] != 0]))
-    if not atom._extents:
-      atom._size = 0
-    else:
-      atom._size = sum(zip(*atom._extents)[1])
-
     # We need to canonicalize any adjacent user inputs.
-    atom = atom.union(Interval())
+    atom = klass._coalesce(sorted([tuple(a) for a in atoms if a[1] != 0]))
     atom._checkInvariant()
     return atom
 
+  @classmethod
+  def _coalesce(klass, atoms, allow_overlap=False):
+    """Builds an interval from (start, length) pairs sorted by start, merging
+       adjacent ones. Unless allow_overlap, the pairs must be disjoint."""
+    starts = array(_TYPECODE)
+    lengths = array(_TYPECODE)
+
+    # The current open interval
+    start_cur = 0
+    length_cur = 0
+    for (start, length) in atoms:
+      assert length > 0
+      assert allow_overlap or start >= start_cur + length_cur
+      if length_cur > 0 and start <= start_cur + length_cur:
+        # We can merge this with the current interval.
+        length_cur = max(start_cur + length_cur, start + length) - start_cur
+      else:
+        # There was a skip so we need to save the old current and start
+        # a new one.
+        if length_cur > 0:
+          starts.append(start_cur)
+          lengths.append(length_cur)
+        start_cur, length_cur = start, length
+
+    # Don't forget to push the final interval, if applicable
+    if length_cur > 0:
+      starts.append(start_cur)
+      lengths.append(length_cur)
+
+    rval = Interval()
+    rval._starts = starts
+    rval._lengths = lengths
+    rval._size = sum(lengths)
+    return rval
+
+  def __getstate__(self):
+    return {"_size": self._size, "_starts": self._starts,
+            "_lengths": self._lengths}
+
+  def __setstate__(self, state):
+    if "_extents" in state:
+      # Pickled when extents were a tuple of (start, length) pairs.
+      state = Interval.fromAtoms(state["_extents"]).__getstate__()
+    self._size = state["_size"]
+    self._starts = state["_starts"]
+    self._lengths = state["_lengths"]
+
+  def _checkCheapInvariant(self):
+    assert self._size >= 0
+    assert len(self._starts) == len(self._lengths)
+
   def _checkInvariant(self):
     assert self._size >= 0
-    assert type(self._extents) is tuple
+    assert type(self._starts) is array and type(self._lengths) is array
+    assert len(self._starts) == len(self._lengths)
     ptr = 0
     used = 0
-    for (start, length) in self._extents:
+    for (start, length) in itertools.izip(self._starts, self._lengths):
       assert start >= ptr
       assert length > 0
       used += length
@@ -58,20 +131,28 @@ class Interval(object):
     return self._size
 
   def __eq__(self, other):
-    return self._extents == other._extents
+    return self._starts == other._starts and self._lengths == other._lengths
 
   def __ne__(self, other):
     return not self.__eq__(other)
 
+  def copy(self):
+    """Returns an independent copy of the interval."""
+    rval = Interval()
+    rval._starts = self._starts[:]
+    rval._lengths = self._lengths[:]
+    rval._size = self._size
+    return rval
+
   def toAtoms(self):
     """Converts the interval to a series of (start, length) pairs which are
        guaranteed not to overlap."""
-    return tuple(self._extents)
+    return tuple(itertools.izip(self._starts, self._lengths))
 
   def iterInterior(self):
     """Returns an iterator over chunks of the interval that are "inside" the
        interval, as (start, length) pairs."""
-    return iter(self._extents)
+    return itertools.izip(self._starts, self._lengths)
 
   def iterExterior(self, total_length=None):
     """Returns an iterator over chunks of the interval that are "outside" the
@@ -84,7 +165,7 @@ class Interval(object):
        If given, total_length must be greater than the largest item in the
        interval."""
     ptr = 0
-    for (start, length) in self._extents:
+    for (start, length) in itertools.izip(self._starts, self._lengths):
       if start > ptr:
         yield (ptr, start - ptr)
       ptr = start + length
@@ -93,72 +174,571 @@ class Interval(object):
     if total_length is not None and ptr < total_length:
       yield (ptr, total_length - ptr)
 
+  def _overlapsAtom(self, start, length):
+    """Returns whether the atom shares any point with the interval."""
+    i = bisect.bisect_right(self._starts, start)
+    if i > 0 and self._starts[i - 1] + self._lengths[i - 1] > start:
+      return True
+    return i < len(self._starts) and self._starts[i] < start + length
+
+  def _insertAtom(self, start, length):
+    """Adds the atom in place, merging it with any extents it overlaps or
+       touches. Costs a bisection plus moving the extents after it."""
+    end = start + length
+    lo = hi = bisect.bisect_right(self._starts, start)
+    if lo > 0 and self._starts[lo - 1] + self._lengths[lo - 1] >= start:
+      lo -= 1
+      start = self._starts[lo]
+      end = max(end, start + self._lengths[lo])
+    while hi < len(self._starts) and self._starts[hi] <= end:
+      end = max(end, self._starts[hi] + self._lengths[hi])
+      hi += 1
+
+    self._size += end - start - sum(self._lengths[lo:hi])
+    self._starts[lo:hi] = array(_TYPECODE, (start,))
+    self._lengths[lo:hi] = array(_TYPECODE, (end - start,))
+
+  def unionUpdate(self, other, allow_overlap=False):
+    """Makes this interval the union of itself and other, in place. A small
+       other is inserted atom by atom rather than merged linearly, which
+       makes repeatedly adding a few atoms to a large interval cheap. The
+       arguments must be disjoint unless allow_overlap."""
+    if len(other._starts) > _INSERT_LIMIT:
+      rval = self.union(other, allow_overlap)
+      self._starts, self._lengths, self._size = \
+          rval._starts, rval._lengths, rval._size
+      return
+
+    atoms = other.toAtoms()
+    for (start, length) in atoms:
+      assert start >= 0
+      assert allow_overlap or not self._overlapsAtom(start, length)
+    for (start, length) in atoms:
+      self._insertAtom(start, length)
+
   def union(self, other, allow_overlap=False):
     """Returns a new interval that is the union of the two supplied.
        The arguments must be disjoint."""
-    # Need to merge intervals
-    self_i = other_i = 0
+    small, big = sorted((self, other), key=lambda ival: len(ival._starts))
+    if len(small._starts) <= _INSERT_LIMIT:
+      rval = big.copy()
+      rval.unionUpdate(small, allow_overlap)
+      return rval
+    return Interval._coalesce(heapq.merge(self.iterInterior(),
+                                          other.iterInterior()),
+                              allow_overlap)
 
-    # The current open interval
-    start_cur = 0
-    length_cur = 0
+  def intersection(self, other):
+    """Returns a new interval of the points in both intervals."""
+    atoms = []
+    i = j = 0
+    while i < len(self._starts) and j < len(other._starts):
+      a_start, a_end = self._starts[i], self._starts[i] + self._lengths[i]
+      b_start, b_end = other._starts[j], other._starts[j] + other._lengths[j]
+      start, end = max(a_start, b_start), min(a_end, b_end)
+      if start < end:
+        atoms.append((start, end - start))
+      # Advance whichever extent finishes first.
+      if a_end <= b_end:
+        i += 1
+      if b_end <= a_end:
+        j += 1
+    return Interval._coalesce(atoms)
 
-    merged = []
-    merged_size = 0
-    # Walk all intervals in order of start.
-    while self_i < len(self._extents) or \
-          other_i < len(other._extents):
-      if self_i < len(self._extents) and \
-         (other_i == len(other._extents) or \
-         self._extents[self_i] < other._extents[other_i]):
-        start, length = self._extents[self_i]
-        self_i += 1
+  def difference(self, other):
+    """Returns a new interval of the points in this interval but not in
+       other."""
+    atoms = []
+    j = 0
+    for (start, length) in self.iterInterior():
+      end = start + length
+      # Skip extents of other that end before this one starts.
+      while j < len(other._starts) and \
+            other._starts[j] + other._lengths[j] <= start:
+        j += 1
+      # Cut out every extent of other that overlaps this one.
+      k = j
+      while k < len(other._starts) and other._starts[k] < end:
+        if other._starts[k] > start:
+          atoms.append((start, other._starts[k] - start))
+        start = max(start, other._starts[k] + other._lengths[k])
+        k += 1
+      if start < end:
+        atoms.append((start, end - start))
+      # The last extent cut may extend into the next one of ours.
+      j = max(j, k - 1)
+    return Interval._coalesce(atoms)
+
+  def symmetricDifference(self, other):
+    """Returns a new interval of the points in exactly one of the
+       intervals."""
+    return self.difference(other).union(other.difference(self))
+
+  def contains(self, point):
+    """Returns whether the point is in the interval."""
+    i = bisect.bisect_right(self._starts, point)
+    return i > 0 and point < self._starts[i - 1] + self._lengths[i - 1]
+
+  def overlaps(self, other):
+    """Returns whether the intervals share any point. When one is small its
+       atoms are looked up by bisection, otherwise both are walked."""
+    small, big = sorted((self, other), key=lambda ival: len(ival._starts))
+    if len(small._starts) <= _INSERT_LIMIT:
+      return any(big._overlapsAtom(start, length)
+                 for (start, length) in small.iterInterior())
+    i = j = 0
+    while i < len(self._starts) and j < len(other._starts):
+      a_end = self._starts[i] + self._lengths[i]
+      b_end = other._starts[j] + other._lengths[j]
+      if max(self._starts[i], other._starts[j]) < min(a_end, b_end):
+        return True
+      if a_end <= b_end:
+        i += 1
       else:
-        start, length = other._extents[other_i]
-        other_i += 1
+        j += 1
+    return False
 
-      assert allow_overlap or start >= start_cur + length_cur
+  def slice(self, start, end):
+    """Returns a new interval of the points in the interval within
+       [start, end), found by bisection."""
+    rval = Interval()
+    if end <= start:
+      return rval
+    lo = bisect.bisect_right(self._starts, start)
+    if lo > 0 and self._starts[lo - 1] + self._lengths[lo - 1] > start:
+      lo -= 1
+    hi = bisect.bisect_left(self._starts, end)
+    rval._starts = self._starts[lo:hi]
+    rval._lengths = self._lengths[lo:hi]
+    if lo < hi:
+      # Clip the extents at either end to the window.
+      if rval._starts[0] < start:
+        rval._lengths[0] -= start - rval._starts[0]
+        rval._starts[0] = start
+      if rval._starts[-1] + rval._lengths[-1] > end:
+        rval._lengths[-1] = end - rval._starts[-1]
+    rval._size = sum(rval._lengths)
+    return rval
 
-      # Convert overlapping intervals to equivalent non-overlapping ones.
-      if allow_overlap and start < start_cur + length_cur:
-        # Containment is a no-op.
-        if start + length < start_cur + length_cur:
-          continue
-        length -= start_cur + length_cur - start
-        start = start_cur + length_cur
+  @classmethod
+  def mergeAll(klass, intervals):
+    """Unions any number of intervals, which may overlap, in a single pass
+       over all their extents. Returns (union, overlap), where overlap is the
+       interval covered by more than one of the inputs."""
+    merged = []
+    overlaps = []
+    start_cur = length_cur = 0
+    atoms = heapq.merge(*[ival.iterInterior() for ival in intervals])
+    for (start, length) in atoms:
+      end_cur = start_cur + length_cur
+      if start < end_cur:
+        # Atoms within an interval are disjoint, so this is an overlap between
+        # inputs. Overlaps arrive in order of start, so coalesce them as we go.
+        end = min(start + length, end_cur)
+        if overlaps and start <= sum(overlaps[-1]):
+          ostart, olength = overlaps[-1]
+          overlaps[-1] = (ostart, max(olength, end - ostart))
+        else:
+          overlaps.append((start, end - start))
 
-      if start == start_cur + length_cur:
-        # We can merge this with the current interval.
-        length_cur += length
+      if start <= end_cur and length_cur > 0:
+        length_cur = max(end_cur, start + length) - start_cur
       else:
-        # There was a skip so we need to save the old current and start
-        # a new one.
         if length_cur > 0:
           merged.append((start_cur, length_cur))
         start_cur, length_cur = start, length
-      merged_size += length
 
-    # Don't forget to push the final interval, if applicable
     if length_cur > 0:
       merged.append((start_cur, length_cur))
 
-    rval = Interval()
-    rval._extents = tuple(merged)
-    rval._size = merged_size
-    return rval
- 
+    union = klass._coalesce(merged)
+    overlap = klass._coalesce(overlaps)
+    union._checkInvariant()
+    overlap._checkInvariant()
+    return union, overlap
+
   def min(self):
     """Returns the smallest value in the interval. If the interval is empty,
        returns None."""
-    if not self._extents:
+    if not self._starts:
       return None
     else:
-      return self._extents[0][0]
- 
+      return self._starts[0]
+
   def max(self):
     """Returns the largest value in the interval. If the interval is empty,
        returns None."""
-    if not self._extents:
+    if not self._starts:
       return None
     else:
-      return sum(self._extents[-1]) - 1
+      return self._starts[-1] + self._lengths[-1] - 1
+
+class ExtentSet(object):
+  """A mutable set of disjoint extents, for tracking the used parts of a
+     padfile as allocations are committed to it one by one. The extents are
+     kept sorted in a list of chunks of bounded size, so adding one bisects to
+     its chunk and shifts at most a chunk of entries, rather than rebuilding
+     every extent as Interval.union does. Touching and overlapping extents are
+     coalesced as they are added."""
+  __metaclass__ = invariant.EnforceInvariant
+
+  def __init__(self):
+    """Creates an empty set"""
+    self._size = 0
+    # Chunks of extent starts and of the corresponding ends, and the first
+    # start of each chunk, which is what we bisect to find a chunk.
+    self._starts = []
+    self._ends = []
+    self._firsts = []
+
+  @classmethod
+  def fromAtoms(klass, atoms):
+    """Factory method that creates a set of the given (start, length) pairs,
+       as for Interval.fromAtoms."""
+    return klass.fromInterval(Interval.fromAtoms(atoms))
+
+  @classmethod
+  def fromInterval(klass, ival):
+    """Factory method that creates a set of the points in the interval."""
+    rval = klass()
+    atoms = ival.toAtoms()
+    for i in xrange(0, len(atoms), _CHUNK_LOAD):
+      chunk = atoms[i:i + _CHUNK_LOAD]
+      rval._starts.append([start for (start, length) in chunk])
+      rval._ends.append([start + length for (start, length) in chunk])
+      rval._firsts.append(chunk[0][0])
+    rval._size = len(ival)
+    rval._checkInvariant()
+    return rval
+
+  def __getstate__(self):
+    return {"encoded": encoding.encodeAtoms(self.toAtoms())}
+
+  def __setstate__(self, state):
+    if "encoded" in state:
+      atoms, end = encoding.decodeAtoms(state["encoded"])
+    else:
+      # Pickled as a tuple of atoms.
+      atoms = state["atoms"]
+    self.__dict__.update(ExtentSet.fromAtoms(atoms).__dict__)
+
+  def _checkCheapInvariant(self):
+    assert self._size >= 0
+    assert len(self._starts) == len(self._ends) == len(self._firsts)
+
+  def _checkInvariant(self):
+    assert len(self._starts) == len(self._ends) == len(self._firsts)
+    ptr = 0
+    used = 0
+    for (starts, ends, first) in zip(self._starts, self._ends, self._firsts):
+      assert 0 < len(starts) == len(ends) <= 2 * _CHUNK_LOAD
+      assert first == starts[0]
+      for (start, end) in itertools.izip(starts, ends):
+        # Extents must be disjoint and not touch, or they would be coalesced.
+        assert start > ptr or (start == 0 and used == 0)
+        assert end > start
+        used += end - start
+        ptr = end
+    assert used == self._size
+
+  def __len__(self):
+    return self._size
+
+  def __eq__(self, other):
+    return self.toAtoms() == other.toAtoms()
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def countExtents(self):
+    """Returns the number of disjoint extents in the set."""
+    return sum(len(starts) for starts in self._starts)
+
+  def toAtoms(self):
+    """Converts the set to a tuple of sorted, disjoint (start, length)
+       pairs."""
+    return tuple(self.iterInterior())
+
+  def toInterval(self):
+    """Returns an Interval of the points in the set."""
+    return Interval._coalesce(self.iterInterior())
+
+  def iterInterior(self):
+    """Returns an iterator over the extents in the set, as (start, length)
+       pairs."""
+    for (starts, ends) in itertools.izip(self._starts, self._ends):
+      for (start, end) in itertools.izip(starts, ends):
+        yield (start, end - start)
+
+  def iterExterior(self, total_length=None):
+    """Returns an iterator over the gaps between extents, as (start, length)
+       pairs. See Interval.iterExterior."""
+    ptr = 0
+    for (start, length) in self.iterInterior():
+      if start > ptr:
+        yield (ptr, start - ptr)
+      ptr = start + length
+
+    assert total_length is None or total_length >= ptr
+    if total_length is not None and ptr < total_length:
+      yield (ptr, total_length - ptr)
+
+  def findFree(self, requested, total_length):
+    """Returns an Interval of the lowest points below total_length that are
+       not in the set, stopping once it holds requested points. It holds
+       fewer if there are not that many free. As extents are coalesced, the
+       first gap follows the first extent and every gap visited is returned,
+       so the cost is in the size of the result rather than of the set."""
+    atoms = []
+    for (start, length) in self.iterExterior(total_length):
+      if requested == 0:
+        break
+      length = min(length, requested)
+      atoms.append((start, length))
+      requested -= length
+    return Interval._coalesce(atoms)
+
+  def _find(self, point):
+    """Returns (chunk, index) of the last extent starting at or before the
+       point. The index is -1 if the point is before every extent. There must
+       be at least one chunk."""
+    c = max(bisect.bisect_right(self._firsts, point) - 1, 0)
+    return c, bisect.bisect_right(self._starts[c], point) - 1
+
+  def _overlapsAtom(self, start, length):
+    """Returns whether the atom shares any point with the set."""
+    if not self._starts:
+      return False
+    c, i = self._find(start)
+    if i >= 0 and self._ends[c][i] > start:
+      return True
+    if i + 1 < len(self._starts[c]):
+      following = self._starts[c][i + 1]
+    elif c + 1 < len(self._firsts):
+      following = self._firsts[c + 1]
+    else:
+      return False
+    return following < start + length
+
+  def overlaps(self, ival):
+    """Returns whether the set shares any point with the interval."""
+    return any(self._overlapsAtom(start, length)
+               for (start, length) in ival.iterInterior())
+
+  def add(self, start, length, allow_overlap=False):
+    """Adds the extent to the set, coalescing it with its neighbours. Unless
+       allow_overlap, it must not overlap the set."""
+    assert start >= 0 and length >= 0
+    assert allow_overlap or not self._overlapsAtom(start, length)
+    if length == 0:
+      return
+    end = start + length
+
+    if not self._starts:
+      self._starts.append([start])
+      self._ends.append([end])
+      self._firsts.append(start)
+      self._size = length
+      return
+
+    c, i = self._find(start)
+    starts, ends = self._starts[c], self._ends[c]
+    removed = 0
+
+    # Merge with the preceding extent if it reaches the new one.
+    if i >= 0 and ends[i] >= start:
+      start = starts[i]
+      end = max(end, ends[i])
+    else:
+      i += 1
+
+    # Merge with any following extents the new one reaches.
+    j = i
+    while j < len(starts) and starts[j] <= end:
+      end = max(end, ends[j])
+      removed += ends[j] - starts[j]
+      j += 1
+    starts[i:j] = [start]
+    ends[i:j] = [end]
+    self._firsts[c] = starts[0]
+
+    # They may continue into later chunks, in which case we eat into those.
+    while c + 1 < len(self._firsts) and self._firsts[c + 1] <= end:
+      following_starts, following_ends = self._starts[c + 1], self._ends[c + 1]
+      k = 0
+      while k < len(following_starts) and following_starts[k] <= end:
+        end = max(end, following_ends[k])
+        removed += following_ends[k] - following_starts[k]
+        k += 1
+      ends[i] = end
+      if k == len(following_starts):
+        del self._starts[c + 1], self._ends[c + 1], self._firsts[c + 1]
+      else:
+        del following_starts[:k], following_ends[:k]
+        self._firsts[c + 1] = following_starts[0]
+        break
+
+    self._size += end - start - removed
+
+    # Split the chunk if it has grown too large.
+    if len(starts) > 2 * _CHUNK_LOAD:
+      self._starts.insert(c + 1, starts[_CHUNK_LOAD:])
+      self._ends.insert(c + 1, ends[_CHUNK_LOAD:])
+      self._firsts.insert(c + 1, starts[_CHUNK_LOAD])
+      del starts[_CHUNK_LOAD:], ends[_CHUNK_LOAD:]
+
+  def update(self, ival, allow_overlap=False):
+    """Adds every extent of the interval to the set. Unless allow_overlap, the
+       interval must not overlap the set, and the set is left unchanged if it
+       does."""
+    assert allow_overlap or not self.overlaps(ival)
+    for (start, length) in ival.iterInterior():
+      self.add(start, length, allow_overlap=True)
+
+def _popcount(bits):
+  """Returns the number of set bits."""
+  return bin(bits).count("1")
+
+class ExtentBitmap(ExtentSet):
+  """An ExtentSet stored as a bitmap, for padfiles so fragmented that a list
+     of extents would be larger. Points are grouped into fixed size
+     containers, each a bitmap held as a long, and containers with nothing
+     set are not stored. Memory and the cost of an add are thus bounded by
+     the size of the file rather than by the number of extents."""
+  __metaclass__ = invariant.EnforceInvariant
+
+  # The full invariant counts every bit, so by default only one call in this
+  # many is checked.
+  _invariantSampling = 1024
+
+  def __init__(self):
+    """Creates an empty set"""
+    self._size = 0
+    # Mapping from container number to its bitmap
+    self._containers = {}
+    # Number of the first container that is not full, where findFree starts.
+    self._cursor = 0
+
+  @classmethod
+  def fromInterval(klass, ival):
+    """Factory method that creates a set of the points in the interval."""
+    rval = klass()
+    for (start, length) in ival.iterInterior():
+      rval._set(start, length)
+    rval._checkInvariant()
+    return rval
+
+  def __getstate__(self):
+    return {"size": self._size, "containers": self._containers}
+
+  def __setstate__(self, state):
+    self._size = state["size"]
+    self._containers = state["containers"]
+    self._cursor = 0
+    self._advance()
+
+  def _checkCheapInvariant(self):
+    assert self._size >= 0
+
+  def _checkInvariant(self):
+    assert all(n >= 0 and 0 < bits <= _FULL
+               for (n, bits) in self._containers.iteritems())
+    assert self._size == sum(_popcount(bits)
+                             for bits in self._containers.itervalues())
+
+  def _masks(self, start, length):
+    """Yields (container number, mask, points in mask) covering the atom."""
+    end = start + length
+    while start < end:
+      n, offset = divmod(start, _CONTAINER_SIZE)
+      count = min(end - start, _CONTAINER_SIZE - offset)
+      if count == _CONTAINER_SIZE:
+        yield n, _FULL, count
+      else:
+        yield n, ((1 << count) - 1) << offset, count
+      start += count
+
+  def _set(self, start, length):
+    """Sets the points of the atom, which may already be set."""
+    for (n, mask, count) in self._masks(start, length):
+      bits = self._containers.get(n, 0)
+      self._size += count - _popcount(bits & mask)
+      self._containers[n] = bits | mask
+    self._advance()
+
+  def _advance(self):
+    """Moves the cursor past any containers that have filled up."""
+    while self._containers.get(self._cursor) == _FULL:
+      self._cursor += 1
+
+  def findFree(self, requested, total_length):
+    """Returns an Interval of the lowest points below total_length that are
+       not in the set, stopping once it holds requested points. It holds
+       fewer if there are not that many free. Starts from the first container
+       that is not full rather than from the start of the file."""
+    atoms = []
+    n = self._cursor
+    while requested > 0 and n * _CONTAINER_SIZE < total_length:
+      base = n * _CONTAINER_SIZE
+      free = ~self._containers.get(n, 0) & _FULL
+      if total_length - base < _CONTAINER_SIZE:
+        free &= (1 << (total_length - base)) - 1
+      # Free bits as characters, lowest first, as in iterInterior.
+      text = bin(free)[:1:-1] if free else ""
+      end = 0
+      while requested > 0:
+        start = text.find("1", end)
+        if start < 0:
+          break
+        end = text.find("0", start)
+        if end < 0:
+          end = len(text)
+        length = min(end - start, requested)
+        atoms.append((base + start, length))
+        requested -= length
+      n += 1
+    return Interval._coalesce(atoms)
+
+  def countExtents(self):
+    """Returns the number of disjoint extents in the set."""
+    return sum(1 for atom in self.iterInterior())
+
+  def iterInterior(self):
+    """Returns an iterator over the extents in the set, as (start, length)
+       pairs."""
+    # Runs are found a container at a time, and those reaching the end of
+    # one are held back in case they continue into the next.
+    run_start = run_end = 0
+    for n in sorted(self._containers):
+      base = n * _CONTAINER_SIZE
+      bits = self._containers[n]
+      # Set bits as characters, lowest first, so runs can be found quickly.
+      text = bin(bits)[:1:-1]
+      end = 0
+      while True:
+        start = text.find("1", end)
+        if start < 0:
+          break
+        end = text.find("0", start)
+        if end < 0:
+          end = len(text)
+        if base + start == run_end and run_end > run_start:
+          run_end = base + end
+        else:
+          if run_end > run_start:
+            yield (run_start, run_end - run_start)
+          run_start, run_end = base + start, base + end
+    if run_end > run_start:
+      yield (run_start, run_end - run_start)
+
+  def _overlapsAtom(self, start, length):
+    """Returns whether the atom shares any point with the set."""
+    return any(self._containers.get(n, 0) & mask
+               for (n, mask, count) in self._masks(start, length))
+
+  def add(self, start, length, allow_overlap=False):
+    """Adds the extent to the set. Unless allow_overlap, it must not overlap
+       the set."""
+    assert start >= 0 and length >= 0
+    assert allow_overlap or not self._overlapsAtom(start, length)
+    self._set(start, length)
@@ -8,38 +8,246 @@ Does NOT call for methods that start with _, including builtins like len or
 setitem, as these may be used internally at times when the invariant needs
 to be temporarily violated. You must call _checkInvariant manually in such
 cases if you wish to check invariants.
+
+How much checking is done is set per class at runtime, by setLevel or the
+JUSTTHISONCE_INVARIANTS environment variable:
+
+  OFF    no checks.
+  CHEAP  calls _checkCheapInvariant, which classes may define to check what
+         can be checked in constant time. Classes without one are not checked.
+  FULL   calls _checkInvariant. This is the default.
+
+Checks may also be sampled, so that only one in every N calls is checked, by
+setSampling or the environment variable. Its value is a comma separated list
+of [Class=]level[:N], such as "cheap" or "full:100,Interval=cheap". Entries
+without a class apply to every class without one of its own. Settings for a
+class also apply to its subclasses. A class whose invariant is too costly to
+check on every call may set _invariantSampling to the sampling it should have
+when it has no setting of its own.
+
+As every public method passes through here, this is also a cheap profiler.
+After enableProfiling, the calls, cumulative and maximum wall time, and time
+spent checking invariants of each Class.method are recorded, and may be
+fetched with profile or formatted with profileJSON and profileTable. Calls
+are credited to the class of the object called, not to the class defining
+the method.
 """
 
+import json
+import os
+import threading
+import time
 import types
 
-# This will have weird behavior if you change it while running
+# This will have weird behavior if you change it while running. If False,
+# classes created afterwards are never checked, whatever the level.
 CHECK_INVARIANTS = True
 
-def public(func):
+OFF, CHEAP, FULL = range(3)
+LEVELS = {"off": OFF, "cheap": CHEAP, "full": FULL}
+
+ENVIRONMENT_VARIABLE = "JUSTTHISONCE_INVARIANTS"
+
+class Error(Exception):
+  """Base error for the invariant module."""
+
+class BadSetting(Error):
+  """An invariant setting could not be understood."""
+
+# Mappings from class name (or None, for the default) to level and sampling.
+_levels = {None: FULL}
+_sampling = {None: 1}
+
+# Mapping from class to the [level, sampling, calls] in effect for it, built
+# as needed and reset whenever the settings change.
+_effective = {}
+
+def setLevel(level, klass=None):
+  """Sets the level of checking for the class (a class or its name) and its
+     subclasses, or the default if klass is None. level is OFF, CHEAP or FULL
+     or one of their names."""
+  if isinstance(level, basestring):
+    if level.lower() not in LEVELS:
+      raise BadSetting("Unknown invariant level %r." % level)
+    level = LEVELS[level.lower()]
+  if level not in LEVELS.values():
+    raise BadSetting("Unknown invariant level %r." % level)
+  _levels[_name(klass)] = level
+  _effective.clear()
+
+def setSampling(n, klass=None):
+  """Sets the class (a class or its name) and its subclasses, or the default
+     if klass is None, to be checked on only one in every n calls."""
+  if n < 1:
+    raise BadSetting("Must sample at least 1 in %i calls." % n)
+  _sampling[_name(klass)] = n
+  _effective.clear()
+
+def reset():
+  """Restores the default of checking everything fully."""
+  _levels.clear()
+  _sampling.clear()
+  _levels[None] = FULL
+  _sampling[None] = 1
+  _effective.clear()
+
+def configure(spec):
+  """Applies settings in the format of the environment variable."""
+  for entry in spec.split(","):
+    entry = entry.strip()
+    if not entry:
+      continue
+    klass, _, setting = entry.rpartition("=")
+    level, _, n = setting.partition(":")
+    setLevel(level, klass or None)
+    if n:
+      try:
+        setSampling(int(n), klass or None)
+      except ValueError:
+        raise BadSetting("Bad invariant sampling %r." % n)
+
+# Whether calls are being profiled, and a mapping from "Class.method" to
+# [calls, total time, max time, time checking invariants] of them.
+_profiling = False
+_profile = {}
+_profile_lock = threading.Lock()
+
+def enableProfiling(enabled=True):
+  """Starts (or stops) recording calls to public methods."""
+  global _profiling
+  _profiling = enabled
+
+def resetProfile():
+  """Discards everything recorded so far."""
+  with _profile_lock:
+    _profile.clear()
+
+def profile():
+  """Returns a mapping from "Class.method" to a dict of the number of calls,
+     and the total and max seconds they took and total seconds spent checking
+     invariants during them. Times include any calls they made."""
+  with _profile_lock:
+    return dict((key, dict(zip(("calls", "total", "max", "invariant"), stats)))
+                for (key, stats) in _profile.iteritems())
+
+def profileJSON():
+  """Returns the profile as JSON."""
+  return json.dumps(profile(), sort_keys=True, indent=2)
+
+def profileTable():
+  """Returns the profile as a table, most expensive methods first."""
+  rows = sorted(profile().iteritems(), key=lambda (key, stats): -stats["total"])
+  lines = ["%-40s %10s %12s %12s %12s" % ("method", "calls", "total (s)",
+                                           "max (s)", "invariant (s)")]
+  for (key, stats) in rows:
+    lines.append("%-40s %10i %12.6f %12.6f %12.6f" % (
+        key, stats["calls"], stats["total"], stats["max"], stats["invariant"]))
+  return "\n".join(lines)
+
+def _record(key, elapsed, checking):
+  """Adds a call to the profile."""
+  with _profile_lock:
+    stats = _profile.get(key)
+    if stats is None:
+      stats = _profile[key] = [0, 0.0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    stats[3] += checking
+
+def _profiled(name, func, self, args, kw, before=True):
+  """Calls func, the method called name, with its invariant checks (skipping
+     the one before if not before), recording the call in the profile even if
+     it raises."""
+  start = time.time()
+  checking = 0.0
+  check = _checker(self)
+  try:
+    if check is not None and before:
+      check(self)
+      checking = time.time() - start
+    res = func(self, *args, **kw)
+    if check is not None:
+      returned = time.time()
+      check(self)
+      checking += time.time() - returned
+  finally:
+    _record("%s.%s" % (type(self).__name__, name), time.time() - start,
+            checking)
+  return res
+
+def _name(klass):
+  """Returns the settings key for a class or class name."""
+  if klass is None or isinstance(klass, basestring):
+    return klass
+  return klass.__name__
+
+def _lookup(settings, klass, default=None):
+  """Returns the setting for the class from the nearest class in its MRO
+     with one, or else default if given, or else the default setting."""
+  for base in klass.__mro__:
+    if base.__name__ in settings:
+      return settings[base.__name__]
+  return settings[None] if default is None else default
+
+def _checker(self):
+  """Returns the function to check the invariant of the object, as its class
+     is currently set to, or None if this call should not be checked."""
+  klass = type(self)
+  effective = _effective.get(klass)
+  if effective is None:
+    sampling = _lookup(_sampling, klass,
+                       getattr(klass, "_invariantSampling", None))
+    effective = _effective[klass] = [_lookup(_levels, klass), sampling, 0]
+  level, sampling, calls = effective
+  if level == OFF:
+    return None
+  if sampling > 1:
+    effective[2] = (calls + 1) % sampling
+    if calls:
+      return None
+  if level == FULL:
+    return klass._checkInvariant
+  return getattr(klass, "_checkCheapInvariant", None)
+
+def public(func, name=None):
   def wrapper(self,*__args,**__kw):
-    self._checkInvariant() # check before executing
+    if _profiling:
+      return _profiled(name, func, self, __args, __kw)
+    check = _checker(self)
+    if check is not None:
+      check(self) # check before executing
     res = func(self,*__args,**__kw)
-    self._checkInvariant() # check after executing
+    if check is not None:
+      check(self) # check after executing
     return res
   return wrapper
 
-def constructor(func):
+def constructor(func, name=None):
   def wrapper(self,*__args,**__kw):
+    if _profiling:
+      return _profiled(name, func, self, __args, __kw, before=False)
     func(self,*__args,**__kw)
-    self._checkInvariant() # check after executing constructor
+    check = _checker(self)
+    if check is not None:
+      check(self) # check after executing constructor
   return wrapper
 
 def EnforceInvariant(name, bases, attrs):
   if CHECK_INVARIANTS:
     for k in attrs:
       if k == '__init__':
-        attrs[k] = constructor(attrs[k])
+        attrs[k] = constructor(attrs[k], k)
       # ignore private methods that start with '_' (and of course ignore _checkInvariant itself)
       elif k[0] != '_' and k != '_checkInvariant':
         f = attrs[k]
         if isinstance(f, types.FunctionType):
-          attrs[k] = public(f)
+          attrs[k] = public(f, k)
         elif isinstance(f, property):
-          attrs[k] = property(fset=public(f.fset), fget=public(f.fget), \
-                              fdel=public(f.fdel))
+          attrs[k] = property(fset=public(f.fset, k), \
+                              fget=public(f.fget, k), \
+                              fdel=public(f.fdel, k))
   return type(name, bases, attrs)
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+  configure(os.environ[ENVIRONMENT_VARIABLE])
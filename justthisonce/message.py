@@ -2,16 +2,39 @@
 Code for processing messages themselves (as well as notifications etc).
 """
 
+import base64
+import bisect
+import collections
+import heapq
 import json
+import os
 import pad
+import shutil
 import sha
+import StringIO
+import struct
 
-COMPATIBILITY = 0
+from justthisonce import encoding
+from justthisonce import integrity
+from justthisonce.interval import Interval
+
+# Raised whenever a format changes so that older readers would misread it:
+# 1 for the binary allocation and extent encodings.
+COMPATIBILITY = 1
 MAGIC = "JustThisOnceMessage"
 
 #TODO: make app-wide and agree with pad.py
 VERSION = 0
 
+# A message container is a single file holding a message's header and
+# payload. It starts with a fixed preamble of MAGIC, the container version,
+# and the offset and length of the header and of the payload. A container
+# written to a pipe, which can't go back to fill the preamble in, has the
+# preamble at its end instead (see containerTrailer).
+CONTAINER_VERSION = 1
+_PREAMBLE = struct.Struct("<%isBQQQQ" % len(MAGIC))
+PREAMBLE_SIZE = _PREAMBLE.size
+
 class Error(Exception):
   pass
 
@@ -21,6 +44,110 @@ class BadMessage(Error):
 class FutureMessageFormat(Error):
   pass
 
+class DuplicateMessage(Error):
+  """An archive already holds a message with that id."""
+
+def _writeHeader(data):
+  """Serializes data as length-prefixed JSON."""
+  data = json.dumps(data)
+  return str(len(data)) + "\n" + data
+
+def _readHeader(string_or_fd):
+  """Reads length-prefixed JSON written by _writeHeader from a string or a
+     file-like object."""
+  if isinstance(string_or_fd, basestring):
+    string_or_fd = StringIO.StringIO(string_or_fd)
+  try:
+    return json.loads(string_or_fd.read(int(string_or_fd.readline())))
+  except ValueError:
+    raise BadMessage("Header is not length-prefixed JSON.")
+
+def _readAllocation(value):
+  """Converts the allocation of a message header to (filename, atoms) pairs.
+     It is either base64 of encoding.encodeAllocation or, in older messages,
+     a JSON list of the pairs."""
+  if not isinstance(value, basestring):
+    return [(filename, map(tuple, atoms)) for (filename, atoms) in value]
+  try:
+    return encoding.decodeAllocation(base64.b64decode(value))
+  except (TypeError, encoding.Error):
+    raise BadMessage("Malformed allocation.")
+
+def containerPreamble(header_length, payload_length, header_first=True):
+  """Returns the preamble of a container. If header_first, the header
+     follows it, then the payload. Otherwise the payload comes first, for
+     when its length is only known once it has been written."""
+  if header_first:
+    header_offset = PREAMBLE_SIZE
+    payload_offset = PREAMBLE_SIZE + header_length
+  else:
+    payload_offset = PREAMBLE_SIZE
+    header_offset = PREAMBLE_SIZE + payload_length
+  return _PREAMBLE.pack(MAGIC, CONTAINER_VERSION, header_offset, header_length,
+                        payload_offset, payload_length)
+
+def containerTrailer(header_length, payload_length):
+  """Returns the trailer of a container written in one pass: the payload,
+     then the header, then this. It must end the file."""
+  return _PREAMBLE.pack(MAGIC, CONTAINER_VERSION, payload_length,
+                        header_length, 0, payload_length)
+
+def _unpackPreamble(data):
+  """Unpacks a preamble or trailer, or returns None if data is not one."""
+  try:
+    fields = _PREAMBLE.unpack(data)
+  except struct.error:
+    return None
+  return fields if fields[0] == MAGIC else None
+
+def readContainer(fd, lookup=None, base=0, length=None):
+  """Reads the preamble and header of the container open as fd, which
+     starts at offset base in it. Returns (message, payload offset, payload
+     length), the offset being from the start of the container. fd is left
+     positioned at the payload. It needs to be seekable unless the header
+     comes first. A container with a trailer rather than a preamble must end
+     the file, or, if its length is given, at base + length (as in a
+     MessageArchive segment). lookup is passed to Message.fromJSON."""
+  data = fd.read(PREAMBLE_SIZE)
+  fields = _unpackPreamble(data)
+  if fields is None and len(data) == PREAMBLE_SIZE:
+    try:
+      if length is None:
+        fd.seek(-PREAMBLE_SIZE, os.SEEK_END)
+      else:
+        fd.seek(base + length - PREAMBLE_SIZE)
+      end = fd.tell()
+    except IOError:
+      raise BadMessage("Not a message container, or one with a trailer, "
+                       "which can't be read from a pipe.")
+    fields = _unpackPreamble(fd.read(PREAMBLE_SIZE))
+    if fields is not None and base + fields[2] + fields[3] != end:
+      raise BadMessage("Container trailer is not at the end of the file.")
+  if fields is None:
+    if len(data) < PREAMBLE_SIZE:
+      raise BadMessage("Truncated container preamble.")
+    raise BadMessage("Not a message container.")
+  (magic, version, header_offset, header_length, payload_offset,
+   payload_length) = fields
+  if version > CONTAINER_VERSION:
+    raise FutureMessageFormat(version)
+
+  if header_offset != PREAMBLE_SIZE or payload_offset == 0:
+    try:
+      fd.seek(base + header_offset)
+    except IOError:
+      raise BadMessage("The header follows the payload, so the container "
+                       "can't be read from a pipe.")
+  header = fd.read(header_length)
+  if len(header) != header_length:
+    raise BadMessage("Truncated container header.")
+  message = Message.fromJSON(header, lookup)
+  if message.length != payload_length:
+    raise BadMessage("Container and header disagree on the payload length.")
+  if payload_offset != header_offset + header_length:
+    fd.seek(base + payload_offset)
+  return message, payload_offset, payload_length
+
 class Message(object):
   """Represents all metadata of a message that is not encrypted. We avoid
      pickle for the messages themselves as it trivially allows execution of
@@ -36,23 +163,84 @@ class Message(object):
     self.length = payload_length
     self.hash = payload_hash
     self.data = {} if data is None else data
+    # The data the tree was last parsed from, and the tree.
+    self._tree = None
 
-  def toJSON(self):
-    """Convert to a format suitable for open interchange."""
-    data = {}
+  @property
+  def allocation(self):
+    """The Allocation of the message. For a message read by fromJSON, it is
+       decoded when first used, which may raise BadMessage."""
+    if self._encoded is not None:
+      self._allocation = pad.Allocation.fromSerializationState(
+          _readAllocation(self._encoded), self._lookup)
+      self._encoded = self._lookup = None
+    return self._allocation
+
+  @allocation.setter
+  def allocation(self, alloc):
+    self._allocation = alloc
+    # Until the allocation of a message read by fromJSON is needed, these are
+    # its value from the header and the lookup to resolve its padfiles.
+    self._encoded = self._lookup = None
+
+  @property
+  def tree(self):
+    """The integrity.HashTree over the payload, or None if the message has
+       none. Raises BadMessage if it is malformed. It is parsed when first
+       used and kept until the tree in data is replaced."""
+    if "tree" not in self.data:
+      return None
+    data = self.data["tree"]
+    if self._tree is None or self._tree[0] is not data:
+      try:
+        self._tree = data, integrity.HashTree.fromData(data)
+      except integrity.BadTree, ex:
+        raise BadMessage(*ex.args)
+    return self._tree[1]
+
+  @tree.setter
+  def tree(self, tree):
+    self._tree = None
+    if tree is None:
+      self.data.pop("tree", None)
+    else:
+      self.data["tree"] = tree.toData()
+
+  def iterAllocation(self):
+    """Yields the atoms of the allocation as (filename, start, length), in
+       the order the message uses them. For a message read by fromJSON whose
+       allocation has not been used, they are decoded one at a time without
+       building it."""
+    if isinstance(self._encoded, basestring):
+      try:
+        for atom in encoding.iterAllocation(base64.b64decode(self._encoded)):
+          yield atom
+      except (TypeError, encoding.Error):
+        raise BadMessage("Malformed allocation.")
+    else:
+      for (ival, padfile) in self.allocation.iterFiles():
+        for (start, length) in ival.iterInterior():
+          yield padfile.filename, start, length
+
+  def toJSON(self, compress=False):
+    """Convert to a format suitable for open interchange. The allocation is
+       binary encoded, and zlib compressed if compress. Entries of data are
+       written alongside the fields, as fromJSON reads them back."""
+    data = dict(self.data)
     for key in self._KEYS:
       data[key] = getattr(self, key)
-    data["allocation"] = data["allocation"].toSerializationState()
-    data = json.dumps(data)
-    return str(len(data)) + "\n" + data
+    data["allocation"] = base64.b64encode(encoding.encodeAllocation(
+        self.allocation.toSerializationState(), compress))
+    return _writeHeader(data)
 
   @classmethod
-  def fromJSON(klass, string_or_fd):
-    """Read a message's metadata from disk. Does minimal validation."""
-    self = klass()
-    if isinstance(string_or_fd, basestring):
-      string_or_fd = StringIO.StringIO(string_or_fd)
-    data = json.loads(string_or_fd.read(int(string_or_fd.readline())))
+  def fromJSON(klass, string_or_fd, lookup=None):
+    """Read a message's metadata from disk. Does minimal validation. lookup
+       resolves padfile names, as for Allocation.fromSerializationState. The
+       allocation is only decoded when used, so reading just the other fields
+       is cheap."""
+    self = klass(None, None)
+    data = _readHeader(string_or_fd)
     try:
       self.compatibility = data["compatibility"]
       if self.compatibility > COMPATIBILITY:
@@ -65,4 +253,310 @@ class Message(object):
     except KeyError:
       raise BadMessage("Missing required keys.")
 
-    self.allocation = pad.Allocation.fromSerializationState(data["allocation"])
+    self._encoded = data["allocation"]
+    self._lookup = lookup
+    return self
+
+class Notification(object):
+  """A pad use notification: which regions of which padfiles have been used,
+     for keeping a peer's view of a shared pad consistent with ours. An
+     incremental notification covers only use since the sender's last sync
+     point. Applying a notification is idempotent, so they may overlap. The
+     atoms of each padfile are run-length coded (see encoding.encodeAtoms) so
+     the size depends on the number of extents, not their offsets."""
+  _KEYS = "extents", "compatibility", "version", "incremental"
+
+  def __init__(self, extents, incremental=False):
+    """extents is a mapping from filename to used Interval, as returned by
+       Pad.makeNotification."""
+    self.extents = extents
+    self.compatibility = COMPATIBILITY
+    self.version = VERSION
+    self.incremental = incremental
+
+  def toJSON(self):
+    """Convert to a format suitable for open interchange."""
+    data = {}
+    for key in self._KEYS:
+      data[key] = getattr(self, key)
+    data["extents"] = [(filename,
+                        base64.b64encode(encoding.encodeAtoms(ival.toAtoms())))
+                       for (filename, ival) in sorted(self.extents.iteritems())
+                       if len(ival)]
+    return _writeHeader(data)
+
+  @classmethod
+  def fromJSON(klass, string_or_fd):
+    """Read a notification from a string or file."""
+    return klass._fromData(_readHeader(string_or_fd))
+
+  @classmethod
+  def _fromData(klass, data):
+    """Helper for fromJSON and read. Builds a notification from its decoded
+       header."""
+    try:
+      if data["compatibility"] > COMPATIBILITY:
+        raise FutureMessageFormat(data["compatibility"])
+      self = klass({}, data["incremental"])
+      self.version = data["version"]
+      for (filename, atoms) in data["extents"]:
+        atoms, end = encoding.decodeAtoms(base64.b64decode(atoms))
+        self.extents[filename] = Interval.fromAtoms(atoms)
+    except (KeyError, TypeError, ValueError, encoding.Error):
+      raise BadMessage("Malformed notification.")
+    return self
+
+  @classmethod
+  def read(klass, string_or_fd):
+    """Reads either a notification or a message header, which is converted
+       to a notification of the pad the message used. This avoids building a
+       full Allocation for each message when ingesting many of them."""
+    data = _readHeader(string_or_fd)
+    if "allocation" not in data:
+      return klass._fromData(data)
+
+    try:
+      if data["compatibility"] > COMPATIBILITY:
+        raise FutureMessageFormat(data["compatibility"])
+      extents = {}
+      for (filename, atoms) in _readAllocation(data["allocation"]):
+        extents[filename] = Interval.fromAtoms(atoms)
+    except (KeyError, TypeError, ValueError, AssertionError):
+      raise BadMessage("Malformed message header.")
+    return klass(extents, incremental=True)
+
+# Where a message is kept in an archive. summary is a tuple of (filename,
+# start, length) giving the span of each padfile the message used.
+ArchiveEntry = collections.namedtuple("ArchiveEntry",
+                                      "id segment offset length summary")
+
+class MessageArchive(object):
+  """Stores many message containers in a directory of a few large segment
+     files rather than a file or two apiece. Containers are appended to the
+     newest segment until it reaches segment_size. An index sorted by message
+     id gives the segment, offset and length of each, and a summary of its
+     allocation, so a message is found by bisection without reading any
+     segment. Appends are logged to a journal, which flush merges into the
+     index. In memory, appends are held aside and merged into the sorted
+     index in one pass when it is next needed in order, so appending is not
+     linear in the size of the archive."""
+  SEGMENT_SIZE = 1024 * 1024 * 1024
+
+  def __init__(self, path, segment_size=SEGMENT_SIZE):
+    """Opens the archive in the directory path, creating it if needed."""
+    self._path = path
+    self._segment_size = segment_size
+    if not os.path.isdir(path):
+      os.mkdir(path)
+
+    # Entries sorted by id, and the ids alone to bisect on, and a mapping
+    # from id to each entry not yet merged into them.
+    self._ids = []
+    self._entries = []
+    self._pending = {}
+    for name in ("index", "journal"):
+      if os.path.exists(self._file(name)):
+        with open(self._file(name), "rb") as fd:
+          data = fd.read()
+        end = 0
+        for (entry, end) in self._readIndex(data):
+          # The journal repeats the index if we crashed while flushing.
+          if entry.id not in self:
+            self._insert(entry)
+        if end < len(data):
+          # Drop an entry torn by a crash, so that appends follow the last
+          # good one.
+          with open(self._file(name), "r+b") as fd:
+            fd.truncate(end)
+    self._merge()
+
+    segments = [int(name.split("-")[1]) for name in os.listdir(path)
+                if name.startswith("segment-")]
+    self._segment = max(segments) if segments else 0
+    self._journal = open(self._file("journal"), "ab")
+
+  def _file(self, name):
+    """Returns the path of a file in the archive."""
+    return os.path.join(self._path, name)
+
+  def _segmentFile(self, segment):
+    """Returns the path of a segment."""
+    return self._file("segment-%06i" % segment)
+
+  def _insert(self, entry):
+    """Adds an entry to the in memory index."""
+    if entry.id in self:
+      raise DuplicateMessage(entry.id)
+    self._pending[entry.id] = entry
+
+  def _merge(self):
+    """Merges the pending entries into the sorted ones."""
+    if self._pending:
+      # Entries are tuples led by their unique ids, so they sort by id.
+      self._entries = list(heapq.merge(self._entries,
+                                       sorted(self._pending.itervalues())))
+      self._ids = [entry.id for entry in self._entries]
+      self._pending = {}
+
+  @staticmethod
+  def _writeEntry(entry):
+    """Encodes an index entry."""
+    summary = encoding.encodeAllocation((filename, ((start, length),))
+                                        for (filename, start, length)
+                                        in entry.summary)
+    message_id = entry.id.encode("utf-8")
+    return "".join((encoding.encodeVarint(len(message_id)), message_id,
+                    encoding.encodeVarint(entry.segment),
+                    encoding.encodeVarint(entry.offset),
+                    encoding.encodeVarint(entry.length),
+                    encoding.encodeVarint(len(summary)), summary))
+
+  @staticmethod
+  def _readIndex(data):
+    """Decodes a run of index entries, yielding each with the offset of its
+       end. A truncated final entry, as left by a crash while appending to
+       the journal, is ignored."""
+    pos = 0
+    while pos < len(data):
+      try:
+        length, pos = encoding.decodeVarint(data, pos)
+        if pos + length > len(data):
+          return
+        message_id = data[pos:pos + length].decode("utf-8")
+        pos += length
+        segment, pos = encoding.decodeVarint(data, pos)
+        offset, pos = encoding.decodeVarint(data, pos)
+        size, pos = encoding.decodeVarint(data, pos)
+        length, pos = encoding.decodeVarint(data, pos)
+        if pos + length > len(data):
+          return
+        summary = encoding.decodeAllocation(data[pos:pos + length])
+        pos += length
+      except encoding.BadEncoding:
+        return
+      yield ArchiveEntry(message_id, segment, offset, size,
+                         tuple((filename, start, length)
+                               for (filename, atoms) in summary
+                               for (start, length) in atoms)), pos
+
+  def append(self, message_id, container):
+    """Appends the container, a file-like object positioned at its start,
+       under message_id. Returns its ArchiveEntry."""
+    if message_id in self:
+      raise DuplicateMessage(message_id)
+    message, payload_offset, payload_length = readContainer(container)
+    container.seek(0, os.SEEK_END)
+    length = container.tell()
+
+    segment = self._segmentFile(self._segment)
+    if os.path.exists(segment) and os.path.getsize(segment) > 0 and \
+       os.path.getsize(segment) + length > self._segment_size:
+      self._segment += 1
+      segment = self._segmentFile(self._segment)
+
+    spans = collections.OrderedDict()
+    for (filename, start, count) in message.iterAllocation():
+      first, end = spans.get(filename, (start, start + count))
+      spans[filename] = (min(first, start), max(end, start + count))
+    summary = tuple((filename, first, end - first)
+                    for (filename, (first, end)) in spans.iteritems())
+    with open(segment, "ab") as output:
+      offset = output.tell()
+      container.seek(0)
+      shutil.copyfileobj(container, output)
+    entry = ArchiveEntry(unicode(message_id), self._segment, offset, length,
+                         summary)
+    self._journal.write(self._writeEntry(entry))
+    self._journal.flush()
+    self._insert(entry)
+    return entry
+
+  def __len__(self):
+    return len(self._ids) + len(self._pending)
+
+  def __contains__(self, message_id):
+    if message_id in self._pending:
+      return True
+    i = bisect.bisect_left(self._ids, message_id)
+    return i < len(self._ids) and self._ids[i] == message_id
+
+  def lookup(self, message_id):
+    """Returns the ArchiveEntry for the message. Raises KeyError if there is
+       none."""
+    if message_id in self._pending:
+      return self._pending[message_id]
+    i = bisect.bisect_left(self._ids, message_id)
+    if i == len(self._ids) or self._ids[i] != message_id:
+      raise KeyError(message_id)
+    return self._entries[i]
+
+  def entries(self, start=None, end=None):
+    """Returns the entries with ids in [start, end), in order of id."""
+    self._merge()
+    lo = 0 if start is None else bisect.bisect_left(self._ids, start)
+    hi = len(self._ids) if end is None else bisect.bisect_left(self._ids, end)
+    return self._entries[lo:hi]
+
+  def read(self, message_id, lookup=None):
+    """Returns (message, payload) for the message. lookup is passed to
+       Message.fromJSON."""
+    entry = self.lookup(message_id)
+    with open(self._segmentFile(entry.segment), "rb") as fd:
+      fd.seek(entry.offset)
+      message, offset, length = readContainer(fd, lookup, entry.offset,
+                                              entry.length)
+      return message, fd.read(length)
+
+  def locatePayload(self, message_id, lookup=None):
+    """Returns (message, path, offset) giving the segment file holding the
+       message's payload and where in it the payload starts, to decrypt it
+       without reading it into memory."""
+    entry = self.lookup(message_id)
+    path = self._segmentFile(entry.segment)
+    with open(path, "rb") as fd:
+      fd.seek(entry.offset)
+      message, offset, length = readContainer(fd, lookup, entry.offset,
+                                              entry.length)
+    return message, path, entry.offset + offset
+
+  def iterMessages(self, message_ids=None, lookup=None):
+    """Yields (entry, message, payload) for the given messages, or all of
+       them, in the order they are stored in, so that each segment is read
+       sequentially and opened once. For batch decryption."""
+    if message_ids is None:
+      self._merge()
+      entries = list(self._entries)
+    else:
+      entries = [self.lookup(message_id) for message_id in message_ids]
+    entries.sort(key=lambda entry: (entry.segment, entry.offset))
+
+    fd, segment = None, None
+    try:
+      for entry in entries:
+        if entry.segment != segment:
+          if fd is not None:
+            fd.close()
+          segment = entry.segment
+          fd = open(self._segmentFile(segment), "rb")
+        fd.seek(entry.offset)
+        message, offset, length = readContainer(fd, lookup, entry.offset,
+                                                entry.length)
+        yield entry, message, fd.read(length)
+    finally:
+      if fd is not None:
+        fd.close()
+
+  def flush(self):
+    """Merges the journal into the sorted index."""
+    self._merge()
+    with open(self._file("index.tmp"), "wb") as fd:
+      for entry in self._entries:
+        fd.write(self._writeEntry(entry))
+    os.rename(self._file("index.tmp"), self._file("index"))
+    self._journal.close()
+    self._journal = open(self._file("journal"), "wb")
+
+  def close(self):
+    """Flushes and closes the archive."""
+    self.flush()
+    self._journal.close()
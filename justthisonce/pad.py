@@ -4,16 +4,35 @@ tracking use. The pad directory has three subdirs: incoming, current, and
 spent.
 """
 
+import bisect
 import cPickle
 import os
 import collections
 
-from justthisonce.interval import Interval
+from justthisonce.interval import ExtentBitmap, ExtentSet, Interval
+from justthisonce import atfile
 from justthisonce import invariant
 
 COMPAT = 0
 VERSION = 0
 
+# Subdirectories of the pad dir, in the order padfiles move through them.
+SUBDIRS = ("incoming", "current", "spent")
+
+# Padfiles track their use in a bitmap once they have at least this many
+# extents and on average one every BITMAP_PERIOD bytes or more often, at which
+# point the bitmap is the smaller of the two.
+BITMAP_MIN_EXTENTS = 1024
+BITMAP_PERIOD = 128
+
+# Allocations of at least this many bytes are striped across every storage
+# device holding free pad, so that they can be read in parallel.
+STRIPE_THRESHOLD = 64 * 1024 * 1024
+
+# DirfdFilesystem remembers the validated components of at most this many
+# paths.
+COMPONENT_CACHE_SIZE = 4096
+
 class Error(Exception):
   """Base error for the pad module."""
 
@@ -45,15 +64,23 @@ class File(object):
     self.filename = filename
 
     # Regions of the file in use.
-    self._extents = Interval()
+    self._extents = ExtentSet()
 
     # Subdir the file is currently in.
     self.subdir = subdir
 
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    # Metadata from before ExtentSet holds the extents as an Interval.
+    if isinstance(self._extents, Interval):
+      self._extents = ExtentSet.fromInterval(self._extents)
+
   def _checkInvariant(self):
     assert self.size >= self.used
     assert len(self._extents) == self.used
 
+  _checkCheapInvariant = _checkInvariant
+
   @property
   def free(self):
     return self.size - self.used
@@ -63,6 +90,11 @@ class File(object):
     """Returns the path of the padfile relative to the paddir."""
     return (self.subdir, self.filename)
 
+  @property
+  def extents(self):
+    """Returns the Interval of the file that has been used."""
+    return self._extents.toInterval()
+
   def getAllocation(self, requested):
     """Requests an allocation from the file of the given size. Raises OutOfPad
        if the file is out of space."""
@@ -70,29 +102,45 @@ class File(object):
       raise OutOfPad("File %s has %i bytes but you requested %i." % \
                      (self.filename, self.free, requested))
 
-    alloc = Allocation()
-    for (start, length) in self._extents.iterExterior(self.size):
-      interval = Interval.fromAtom(start, min(requested - len(alloc), length))
-      seg = Allocation(self, interval)
-      alloc.unionUpdate(seg)
-      if len(alloc) >= requested:
-        assert len(alloc) == requested
-        break
-
+    alloc = Allocation(self, self._extents.findFree(requested, self.size))
     assert len(alloc) == requested
     return alloc
 
   def commitAllocation(self, ival):
     """Mark the specified interval as used. Error if overlaps with currently
        used area."""
-    self._extents = self._extents.union(ival)
+    self._extents.update(ival)
     self.used += len(ival)
+    self._compactExtents()
+
+  def releaseAllocation(self, ival):
+    """Mark the specified interval, which must be in use, as free again. See
+       Pad.releaseAllocation."""
+    extents = self._extents.toInterval()
+    assert extents.intersection(ival) == ival
+    self._extents = type(self._extents).fromInterval(extents.difference(ival))
+    self.used -= len(ival)
+
+  def mergeExtents(self, ival):
+    """Mark the specified interval as used, whether or not it overlaps the
+       currently used area. Used to apply pad use reported by a peer."""
+    self._extents.update(ival, allow_overlap=True)
+    self.used = len(self._extents)
+    self._compactExtents()
+
+  def _compactExtents(self):
+    """Switches to tracking use in a bitmap once the file is fragmented
+       enough that the bitmap is smaller than the list of extents."""
+    if type(self._extents) is ExtentSet:
+      count = self._extents.countExtents()
+      if count >= BITMAP_MIN_EXTENTS and count * BITMAP_PERIOD >= self.size:
+        self._extents = ExtentBitmap.fromInterval(self._extents.toInterval())
 
   def consumeEntireFile(self):
     """Mark the entire file as consumed. Used to prevent its use for encryption
        while keeping it around for decryption."""
     self.used = self.size
-    self._extents = Interval.fromAtom(0, self.size)
+    self._extents = ExtentSet.fromAtoms([(0, self.size)])
 
 class Allocation(object):
   """Holds an allocation on the pad, which may contain multiple chunks in
@@ -108,12 +156,19 @@ class Allocation(object):
     self._alloc = collections.OrderedDict()
     self._size = 0
 
+    # Cached by locate: the payload offset at which each atom ends, and the
+    # (padfile, start) of each atom.
+    self._layout = None
+
     if padfile is None or interval is None:
       assert padfile is None and interval is None
     else:
       self._alloc[padfile.filename] = (interval, padfile)
       self._size = len(interval)
 
+  def _checkCheapInvariant(self):
+    assert self._size >= 0
+
   def _checkInvariant(self):
     # Size of an allocation must be the sum of the lengths of its' intervals.
     assert self._size == sum((len(ival) \
@@ -134,6 +189,7 @@ class Allocation(object):
     rval = self.union(other)
     self._alloc = rval._alloc
     self._size = rval._size
+    self._layout = None
 
   def union(self, other):
     """Combines two allocations, merging adjacent intervals in the same file.
@@ -161,6 +217,45 @@ class Allocation(object):
     """Returns an iterator of (interval, file)."""
     return self._alloc.itervalues()
 
+  def locate(self, offset, length):
+    """Maps length bytes of the payload from offset to the pad. Returns a list
+       of (padfile, start, length) segments in payload order. The payload
+       uses the atoms of each file in the order of iterFiles. The prefix sums
+       of their lengths are worked out on first use and cached, so each call
+       only bisects them."""
+    assert offset >= 0 and length >= 0 and offset + length <= self._size
+    if self._layout is None:
+      ends = []
+      atoms = []
+      end = 0
+      for (ival, padfile) in self._alloc.itervalues():
+        for (start, count) in ival.iterInterior():
+          end += count
+          ends.append(end)
+          atoms.append((padfile, start))
+      self._layout = ends, atoms
+    ends, atoms = self._layout
+
+    segments = []
+    i = bisect.bisect_right(ends, offset)
+    while length > 0:
+      padfile, start = atoms[i]
+      skip = offset - (ends[i - 1] if i else 0)
+      count = min(length, ends[i] - offset)
+      segments.append((padfile, start + skip, count))
+      offset += count
+      length -= count
+      i += 1
+    return segments
+
+  def slice(self, offset, length):
+    """Returns the Allocation behind length bytes of the payload from offset,
+       e.g. to split pad claimed at once between several messages."""
+    builder = AllocationBuilder()
+    for (padfile, start, count) in self.locate(offset, length):
+      builder.addAtoms(padfile, [(start, count)])
+    return builder.build()
+
   def toSerializationState(self):
     """Helper for the serialization code. This is a
        compromise between dumping internal logic code into message.py and dumping
@@ -174,12 +269,15 @@ class Allocation(object):
              in self._alloc.iteritems()))
 
   @classmethod
-  def fromSerializationState(klass, state):
-    """See Allocation.toSerializationState"""
-    self = klass()
+  def fromSerializationState(klass, state, lookup=None):
+    """See Allocation.toSerializationState. lookup maps a filename to its
+       File, such as Pad.findPadfile. Without one, each file is represented
+       by a detached File (with no subdir) just large enough to hold its
+       atoms."""
+    builder = AllocationBuilder()
     for (filename, atoms) in state:
-      self.unionUpdate(Allocation(filename, Interval.fromAtoms(atoms)))
-    return self 
+      builder.addAtoms(filename, atoms)
+    return builder.build(lookup)
 
   def __eq__(self, other):
     # Order matters!
@@ -188,6 +286,61 @@ class Allocation(object):
   def __ne__(self, other):
     return not self.__eq__(other)
 
+class AllocationBuilder(object):
+  """Collects the pieces of an allocation and builds it in one pass. Adding
+     a piece just records it; build sorts and coalesces each file's atoms
+     once, rather than copying and re-merging the whole allocation for every
+     piece as a chain of Allocation.unionUpdate does. Files keep the order in
+     which they were first added."""
+
+  def __init__(self):
+    # Mapping from filename to (atoms, padfile)
+    self._pieces = collections.OrderedDict()
+
+  def _atoms(self, padfile):
+    """Returns the atom list for the file, which may be a File or (until it
+       is resolved in build) a filename."""
+    if isinstance(padfile, basestring):
+      filename = padfile
+      padfile = None
+    else:
+      filename = padfile.filename
+    atoms, known = self._pieces.setdefault(filename, ([], padfile))
+    assert padfile is None or known is None or known is padfile
+    if known is None and padfile is not None:
+      self._pieces[filename] = (atoms, padfile)
+    return atoms
+
+  def addAtoms(self, padfile, atoms):
+    """Adds (start, length) atoms of the padfile, which is a File or a
+       filename to resolve when building."""
+    self._atoms(padfile).extend(atoms)
+
+  def addInterval(self, padfile, ival):
+    """Adds the points of the interval in the padfile."""
+    self._atoms(padfile).extend(ival.iterInterior())
+
+  def addAllocation(self, alloc):
+    """Adds every piece of the allocation."""
+    for (ival, padfile) in alloc.iterFiles():
+      self.addInterval(padfile, ival)
+
+  def build(self, lookup=None):
+    """Returns the Allocation of everything added. The pieces must be
+       disjoint. Filenames are resolved as in
+       Allocation.fromSerializationState."""
+    rval = Allocation()
+    for (filename, (atoms, padfile)) in self._pieces.iteritems():
+      ival = Interval.fromAtoms(atoms)
+      if padfile is None and lookup is not None:
+        padfile = lookup(filename)
+      if padfile is None:
+        padfile = File(filename, ival.max() + 1 if len(ival) else 0, None)
+      rval._alloc[filename] = (ival, padfile)
+      rval._size += len(ival)
+    rval._checkInvariant()
+    return rval
+
 class Metadata(object):
   """Represents all metadata of the pad that is saved to disk."""
 
@@ -196,6 +349,11 @@ class Metadata(object):
     self.compatability = COMPAT
     self.version = VERSION
 
+    # Mapping from filename to the Interval used since the last sync point,
+    # i.e. what the next incremental notification must report. Kept here
+    # rather than on File because spent padfiles leave current.
+    self.unsynced = {}
+
 class Filesystem(object):
   """Shim class to abstract interactions with the filesystem. This makes it
      easier to test Pad and also improves flexibility for changes to backend
@@ -252,6 +410,282 @@ class Filesystem(object):
     assert not self._readonly or set("rbU").issuperset(mode)
     return open(self._relpath(path), mode, buffering)
 
+  def realpath(self, path):
+    """Returns the on-disk path of the given path, for handing to code (such as
+       the XOR engines) that cannot go through this class."""
+    return self._relpath(path)
+
+  def device(self, path):
+    """Returns an opaque identifier for the storage device holding path. Paths
+       with equal identifiers share bandwidth."""
+    return self.stat(path).st_dev
+
+class DirfdFilesystem(Filesystem):
+  """Filesystem that holds file descriptors for the directories it uses and
+     resolves names relative to them with the *at syscalls (see atfile).
+     Paths are validated once and cached as components, so operations skip
+     the string work of _relpath and do not walk the full path again. No
+     component is followed if it is a symlink, which is a stronger guarantee
+     against traversal than the prefix check in Filesystem. Only available
+     where atfile.AVAILABLE."""
+
+  def __init__(self, path):
+    """Assumes control of the directory at path. Path may not be root."""
+    # Mapping from directory components to open fds, () being the root, set
+    # up first so that __del__ is always safe.
+    self._dirfds = {}
+    assert atfile.AVAILABLE
+    Filesystem.__init__(self, os.path.normpath(os.path.abspath(path)))
+    assert self.root != "/"
+
+    # Mapping from paths as given to their validated components, least
+    # recently used first.
+    self._components = collections.OrderedDict()
+
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    """Closes all directory descriptors. They are reopened as needed."""
+    for fd in self._dirfds.itervalues():
+      os.close(fd)
+    self._dirfds = {}
+
+  def _split(self, path):
+    """Returns the validated components of path relative to the root. Raises
+       assertion if it is not under the root."""
+    key = path if isinstance(path, basestring) else tuple(path)
+    parts = self._components.pop(key, None)
+    if parts is None:
+      if isinstance(path, basestring):
+        path = path,
+      joined = os.path.normpath(os.path.join(*path))
+      if os.path.isabs(joined):
+        assert joined == self.root or joined.startswith(self.root + "/")
+        joined = joined[len(self.root):].lstrip("/")
+      parts = tuple(part for part in joined.split("/") if part not in ("", "."))
+      assert ".." not in parts
+    self._components[key] = parts
+    if len(self._components) > COMPONENT_CACHE_SIZE:
+      self._components.popitem(last=False)
+    return parts
+
+  def _dirfd(self, parts):
+    """Returns an fd for the directory with the given components, opening
+       (and caching) it and any parents as needed."""
+    fd = self._dirfds.get(parts)
+    if fd is None:
+      if not parts:
+        fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY | atfile.O_CLOEXEC)
+      else:
+        fd = atfile.openat(self._dirfd(parts[:-1]), parts[-1],
+                           os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW |
+                           atfile.O_CLOEXEC)
+      self._dirfds[parts] = fd
+    return fd
+
+  def _forget(self, parts):
+    """Drops cached directory fds at or below parts, e.g. after a rename."""
+    for cached in self._dirfds.keys():
+      if cached[:len(parts)] == parts:
+        os.close(self._dirfds.pop(cached))
+
+  def mkdir(self, path):
+    """Wraps mkdirat relative to the root."""
+    assert not self._readonly
+    parts = self._split(path)
+    if not parts:
+      os.mkdir(self.root)
+    else:
+      atfile.mkdirat(self._dirfd(parts[:-1]), parts[-1])
+
+  def exists(self, path):
+    """Returns whether path exists, without following symlinks."""
+    parts = self._split(path)
+    try:
+      if not parts:
+        return os.path.isdir(self.root)
+      return atfile.exists(self._dirfd(parts[:-1]), parts[-1])
+    except OSError:
+      return False
+
+  def stat(self, path):
+    """Stats path relative to the root, without following symlinks."""
+    parts = self._split(path)
+    if not parts:
+      return os.fstat(self._dirfd(parts))
+    fd = atfile.openat(self._dirfd(parts[:-1]), parts[-1],
+                       atfile.O_PATH | os.O_NOFOLLOW | atfile.O_CLOEXEC)
+    try:
+      return os.fstat(fd)
+    finally:
+      os.close(fd)
+
+  def listdir(self, path):
+    """Lists the directory at path through its held descriptor."""
+    return os.listdir("/proc/self/fd/%i" % self._dirfd(self._split(path)))
+
+  def rename(self, old, new):
+    """Wraps renameat relative to the root."""
+    assert not self._readonly
+    old, new = self._split(old), self._split(new)
+    assert old and new
+    atfile.renameat(self._dirfd(old[:-1]), old[-1], self._dirfd(new[:-1]),
+                    new[-1])
+    self._forget(old)
+    self._forget(new)
+
+  def open(self, path, mode='r', buffering=-1):
+    """Wraps openat relative to the root, refusing to follow symlinks."""
+    assert not self._readonly or set("rbU").issuperset(mode)
+    if '+' in mode:
+      flags = os.O_RDWR
+    elif mode[0] in 'rU':
+      flags = os.O_RDONLY
+    else:
+      flags = os.O_WRONLY
+    if mode[0] == 'w':
+      flags |= os.O_CREAT | os.O_TRUNC
+    elif mode[0] == 'a':
+      flags |= os.O_CREAT | os.O_APPEND
+
+    parts = self._split(path)
+    try:
+      assert parts
+      fd = atfile.openat(self._dirfd(parts[:-1]), parts[-1],
+                         flags | os.O_NOFOLLOW | atfile.O_CLOEXEC)
+    except OSError, ex:
+      raise IOError(ex.errno, ex.strerror, ex.filename)
+    return os.fdopen(fd, mode, buffering)
+
+  def realpath(self, path):
+    return os.path.join(self.root, *self._split(path))
+
+class StripedFilesystem(Filesystem):
+  """Filesystem spanning several roots, typically on separate devices, so that
+     one pad can use the bandwidth of all of them. Every root has its own
+     incoming, current and spent subdirs, and each padfile lives on exactly one
+     root. The first root is the primary and holds the metadata. Operations on
+     the pad dir and its subdirs apply to all roots, operations on padfiles go
+     to the root holding the file and everything else goes to the primary."""
+
+  def __init__(self, paths):
+    """Assumes control of the directories at paths, the first being the
+       primary. None may be root."""
+    assert len(paths) > 0
+    Filesystem.__init__(self, paths[0])
+    self.roots = [Filesystem(path) for path in paths]
+
+    # Mapping from padfile name to index of the root holding it. Filenames
+    # are unique across the pad and renames never change root, so entries
+    # only go stale if a file is removed behind our back.
+    self._located = {}
+
+  def _classify(self, path):
+    """Returns (kind, filename) for the given path, where kind is "dir" for
+       the pad dir or its subdirs, "padfile" for files in the subdirs (whose
+       name is returned) and "other" for anything else."""
+    if isinstance(path, basestring):
+      path = path,
+    parts = [part for part in os.path.normpath(os.path.join(*path)).split("/")
+             if part not in ("", ".")]
+    if not parts or (len(parts) == 1 and parts[0] in SUBDIRS):
+      return "dir", None
+    elif len(parts) == 2 and parts[0] in SUBDIRS:
+      return "padfile", parts[1]
+    else:
+      return "other", None
+
+  def _locate(self, path):
+    """Returns the root holding the padfile at path, or None if there is no
+       such padfile on any root."""
+    kind, filename = self._classify(path)
+    assert kind == "padfile"
+    index = self._located.get(filename)
+    if index is not None and self.roots[index].exists(path):
+      return self.roots[index]
+    for (index, root) in enumerate(self.roots):
+      if root.exists(path):
+        self._located[filename] = index
+        return root
+    return None
+
+  def _route(self, path):
+    """Returns the root a single-root operation on path should use. New
+       padfiles are placed on the root with the most free space."""
+    kind, filename = self._classify(path)
+    if kind != "padfile":
+      return self.roots[0]
+    root = self._locate(path)
+    if root is None:
+      def free((index, root)):
+        stat = os.statvfs(root.root)
+        return stat.f_bavail * stat.f_frsize
+      index, root = max(enumerate(self.roots), key=free)
+      self._located[filename] = index
+    return root
+
+  def setReadonly(self):
+    """Enters readonly mode on all roots."""
+    Filesystem.setReadonly(self)
+    for root in self.roots:
+      root.setReadonly()
+
+  def mkdir(self, path):
+    """Creates the pad dir or a subdir on every root that lacks it. Other
+       directories are created on the primary."""
+    assert not self._readonly
+    if self._classify(path)[0] == "dir":
+      for root in self.roots:
+        if not root.exists(path):
+          root.mkdir(path)
+    else:
+      self.roots[0].mkdir(path)
+
+  def exists(self, path):
+    """The pad dir and its subdirs exist only if they exist on every root."""
+    if self._classify(path)[0] == "dir":
+      return all(root.exists(path) for root in self.roots)
+    elif self._classify(path)[0] == "padfile":
+      return self._locate(path) is not None
+    else:
+      return self.roots[0].exists(path)
+
+  def stat(self, path):
+    """Stats path on the root holding it."""
+    return self._route(path).stat(path)
+
+  def listdir(self, path):
+    """Lists the pad dir or a subdir across all roots. A name present on
+       several roots is listed once per root."""
+    if self._classify(path)[0] == "dir":
+      listing = []
+      for root in self.roots:
+        listing.extend(root.listdir(path))
+      return listing
+    return self._route(path).listdir(path)
+
+  def rename(self, old, new):
+    """Renames within a single root; padfiles never change root."""
+    assert not self._readonly
+    root = self._route(old)
+    if self._classify(new)[0] == "padfile":
+      assert self._classify(old)[0] == "padfile"
+      self._located[self._classify(new)[1]] = self.roots.index(root)
+    return root.rename(old, new)
+
+  def open(self, path, mode='r', buffering=-1):
+    """Opens path on the root holding it (or that should hold it)."""
+    assert not self._readonly or set("rbU").issuperset(mode)
+    return self._route(path).open(path, mode, buffering)
+
+  def realpath(self, path):
+    return self._route(path).realpath(path)
+
+  def device(self, path):
+    """Each root is considered its own device."""
+    return self.roots.index(self._route(path))
+
 class Pad(object):
   """Represents an on-disk pad dir."""
   __metaclass__ = invariant.EnforceInvariant
@@ -260,13 +694,15 @@ class Pad(object):
   def createPad(cls, fs):
     """Creates a new pad on the provided fs. Will not clobber an
        existing non-empty directory."""
-    if fs.exists("."):
-      if fs.listdir("."):
-        raise InvalidPad("Directory exists and is not empty.")
-    else:
+    # A striped pad dir only exists if every root does, so the missing ones
+    # are made first and the listing then covers every root, including one
+    # holding the metadata of an existing pad.
+    if not fs.exists("."):
       fs.mkdir(".")
+    if fs.listdir("."):
+      raise InvalidPad("Directory exists and is not empty.")
 
-    for subdir in "incoming", "current", "spent":
+    for subdir in SUBDIRS:
       fs.mkdir(subdir)
     cPickle.dump(Metadata(), fs.open("metadata.pck", 'w'), -1)
     fs.open("VERSION", 'w').write("%s\n%s" % (COMPAT, VERSION))
@@ -292,10 +728,14 @@ class Pad(object):
       raise InvalidPad("Pad is protocol %i but I only understand up to %i" % \
                        (self.metadata.compatability, COMPAT))
 
+    # Pads from before sync points existed have never been synced.
+    if not hasattr(self.metadata, "unsynced"):
+      self.metadata.unsynced = {}
+
   def _verifyDirStructure(self):
     """Helper for init. Verifies the structure in the paddir is valid."""
     fn = []
-    for subdir in "incoming", "current", "spent":
+    for subdir in SUBDIRS:
       if not self._fs.exists(subdir):
         raise InvalidPad("Directory structure bad")
       fn.extend(self._fs.listdir(subdir))
@@ -352,6 +792,7 @@ class Pad(object):
        the pad if it does not exist."""
     self._fs = fs
     self._uncommitted = 0
+    self._moveListeners = []
     if not self._fs.exists("."):
       raise InvalidPad("No such file or directory.")
     
@@ -376,6 +817,8 @@ class Pad(object):
   def _checkInvariant(self):
     assert self._uncommitted in (0, 1)
 
+  _checkCheapInvariant = _checkInvariant
+
   def flush(self):
     """Flush the pad's current state to disk but do not close it. This will
        not discard uncommitted transactions, but they will not be saved to
@@ -397,38 +840,80 @@ class Pad(object):
        of pad claiming to prevent accidental reuse of the same key material."""
     # Look through the files we are already using first.
     current_free = sum((pad.free for pad in self.metadata.current))
+    striped = requested >= STRIPE_THRESHOLD
 
-    if current_free < requested:
-      # We need more pad. Look through incoming to see if we can service the
-      # request, beginning with the smallest files.
-      can_get = 0
+    new_pads = []
+    if current_free < requested or striped:
+      # We need more pad (or want more devices). Look through incoming to see
+      # if we can service the request, beginning with the smallest files.
       new_pads = [(fn, self._fs.stat(("incoming", fn)).st_size) \
-                  for fn in os.listdir("incoming")]
-      new_pads.sort(lambda (pad, size): size)
+                  for fn in self._fs.listdir("incoming")]
+      new_pads.sort(key=lambda (pad, size): size)
+
+    if striped:
+      # Consider every padfile; the quotas decide which ones get used.
+      new_files = [File(pad, size, "incoming") for (pad, size) in new_pads]
+      quotas = self._stripeQuotas(self.metadata.current + new_files,
+                                  requested)
+    else:
+      can_get = 0
       last_need = -1
-      for last_need, (pad, size) in enumerate(new_pads):
-        can_get += size
-        if can_get + current_free >= requested:
-          break
-      else:
-        raise OutOfPad("Can't allocate %i bytes; %i bytes available" \
-                       % (requested, can_get))
-
-
-    new_files = [File(pad, size, "incoming") \
-                 for (pad, size) in new_pads[:last_need + 1]]
+      if current_free < requested:
+        for last_need, (pad, size) in enumerate(new_pads):
+          can_get += size
+          if can_get + current_free >= requested:
+            break
+        else:
+          raise OutOfPad("Can't allocate %i bytes; %i bytes available" \
+                         % (requested, can_get + current_free))
+      new_files = [File(pad, size, "incoming") \
+                   for (pad, size) in new_pads[:last_need + 1]]
+      quotas = None
 
-    # There is now enough space to actually allocate in current.
+    # There is now enough space to actually allocate.
     needed = requested
-    allocation = Allocation()
+    builder = AllocationBuilder()
     for pad in self.metadata.current + new_files:
-      newb = pad.getAllocation(min(needed - len(allocation), pad.free))
-      allocation.unionUpdate(newb)
-
+      want = min(needed, pad.free)
+      if quotas is not None:
+        device = self._fs.device(pad.path)
+        want = min(want, quotas[device])
+        quotas[device] -= want
+      if want > 0:
+        builder.addAllocation(pad.getAllocation(want))
+        needed -= want
+
+    allocation = builder.build()
     assert len(allocation) == requested
     self._uncommitted += 1
     return allocation
 
+  def _stripeQuotas(self, padfiles, requested):
+    """Splits requested bytes as evenly as possible between the devices
+       holding the given padfiles, respecting how much free pad each device
+       has. Returns a mapping from device to its share. Raises OutOfPad if
+       there is not enough pad in total."""
+    free = collections.defaultdict(int)
+    for padfile in padfiles:
+      free[self._fs.device(padfile.path)] += padfile.free
+
+    if sum(free.itervalues()) < requested:
+      raise OutOfPad("Can't allocate %i bytes; %i bytes available" \
+                     % (requested, sum(free.itervalues())))
+
+    # Fill the devices with the least free pad first so that whatever they
+    # cannot take is spread over the rest.
+    quotas = {}
+    remaining = requested
+    devices = sorted(free, key=free.get)
+    for (i, device) in enumerate(devices):
+      share = -(-remaining // (len(devices) - i))
+      quotas[device] = min(share, free[device])
+      remaining -= quotas[device]
+
+    assert remaining == 0
+    return quotas
+
   def discardUncommitted(self):
     """Releases any outstanding allocations."""
     self._uncommitted = 0
@@ -439,30 +924,198 @@ class Pad(object):
     assert self._uncommitted == 1
     self.discardUncommitted()
 
-    # Move any files in incoming
     for (ival, padfile) in alloc.iterFiles():
+      # Move any files in incoming
       if padfile not in self.metadata.current:
-        assert padfile.subdir == "incoming"
-        os.rename(padfile.path, ("current", padfile.filename))
-        padfile.subdir = "current"
+        self._claimPadfile(padfile)
 
       # Mark used extents as used in file, and move to spent if necessary
-      padfile.markIntervalAsUsed(ival)
+      padfile.commitAllocation(ival)
+      self.metadata.unsynced.setdefault(padfile.filename,
+                                        Interval()).unionUpdate(ival)
       if padfile.free == 0:
-        os.rename(padfile.path, ("spent", padfile.filename))
-      
+        self._retirePadfile(padfile)
+
     # Write out the metadata
     self.flush()
 
+  def releaseAllocation(self, alloc):
+    """Returns committed pad that was never used, such as the rest of a batch
+       claimed ahead for a stream that has ended, to the free pad. Pad that
+       has been read to encrypt anything must never be released, as it would
+       be handed out again. Spent padfiles go back to current."""
+    for (ival, padfile) in alloc.iterFiles():
+      padfile.releaseAllocation(ival)
+      if padfile.subdir == "spent":
+        self._movePadfile(padfile, "current")
+        self.metadata.current.append(padfile)
+      self._discardUnsynced(padfile.filename, ival)
+    self.flush()
+
+  def addMoveListener(self, listener):
+    """Registers listener to be called with each padfile just before it moves
+       to another subdir, e.g. to drop cached handles on its old path."""
+    self._moveListeners.append(listener)
+
+  def _movePadfile(self, padfile, subdir):
+    """Moves a padfile to another subdir, notifying the move listeners."""
+    for listener in self._moveListeners:
+      listener(padfile)
+    self._fs.rename(padfile.path, (subdir, padfile.filename))
+    padfile.subdir = subdir
+
+  def _claimPadfile(self, padfile):
+    """Moves a padfile from incoming to current."""
+    assert padfile.subdir == "incoming"
+    self._movePadfile(padfile, "current")
+    padfile.subdir = "current"
+    self.metadata.current.append(padfile)
+
+  def _retirePadfile(self, padfile):
+    """Moves a fully used padfile from current to spent."""
+    assert padfile.free == 0
+    self._movePadfile(padfile, "spent")
+    self.metadata.current.remove(padfile)
+
+  def makeNotification(self, incremental=False):
+    """Returns a mapping from filename to the Interval of that padfile that
+       has been used. If incremental, only reports use since the last sync
+       point (see markSynced); otherwise reports all use, treating spent
+       padfiles as fully used. The Intervals are copies, so later use does
+       not change a notification already made."""
+    if incremental:
+      return dict((filename, ival.copy())
+                  for (filename, ival) in self.metadata.unsynced.iteritems())
+
+    used = dict((padfile.filename, padfile.extents)
+                for padfile in self.metadata.current if padfile.used)
+    for filename in self._fs.listdir("spent"):
+      size = self._fs.stat(("spent", filename)).st_size
+      used[filename] = Interval.fromAtom(0, size)
+    return used
+
+  def markSynced(self, used):
+    """Records a sync point: the use in used, a notification from
+       makeNotification that has been delivered to peers, need not be
+       reported again. Use committed since it was made is still unsynced."""
+    for (filename, ival) in used.iteritems():
+      self._discardUnsynced(filename, ival)
+    self.flush()
+
+  def _discardUnsynced(self, filename, ival):
+    """Removes ival from the use of the padfile not yet reported to peers."""
+    if filename in self.metadata.unsynced:
+      rest = self.metadata.unsynced[filename].difference(ival)
+      if len(rest):
+        self.metadata.unsynced[filename] = rest
+      else:
+        del self.metadata.unsynced[filename]
+
+  def processNotification(self, used):
+    """Marks the pad reported used by a peer (a mapping from filename to
+       Interval, as from makeNotification) as used here too. Merging is
+       idempotent, so notifications may overlap each other and our own use.
+       Padfiles we have already spent are skipped. Returns the filenames of
+       padfiles we do not have at all."""
+    return self.processNotifications([used])[0]
+
+  def findPadfile(self, filename, current=None):
+    """Returns the File for the named padfile, wherever it is, or None if we
+       do not have it. Files not in current are not tracked, so a File is made
+       for them; spent ones are entirely used. Callers looking up many files
+       may pass current, a mapping from filename to the Files in current (see
+       _currentByName), rather than have it searched each time."""
+    if current is None:
+      current = self._currentByName()
+    if filename in current:
+      return current[filename]
+    for subdir in ("incoming", "spent"):
+      if self._fs.exists((subdir, filename)):
+        padfile = File(filename, self._fs.stat((subdir, filename)).st_size,
+                       subdir)
+        if subdir == "spent":
+          padfile.consumeEntireFile()
+        return padfile
+    return None
+
+  def _currentByName(self):
+    """Returns a mapping from filename to each File in current."""
+    return dict((padfile.filename, padfile)
+                for padfile in self.metadata.current)
+
+  def processNotifications(self, notifications):
+    """As processNotification, but for any number of notifications at once.
+       All use of each padfile is merged with what we already know in a
+       single pass and the metadata is flushed once at the end. Returns
+       (unknown, overlaps) where unknown is a sorted list of padfiles we do
+       not have and overlaps maps filenames to the Interval reported used
+       more than once (by us or the notifications), which may indicate pad
+       reuse."""
+    if self._uncommitted:
+      raise AllocationOutstanding("Cannot merge use with an allocation "
+                                  "outstanding.")
+
+    # Group the use by padfile.
+    reported = collections.defaultdict(list)
+    for used in notifications:
+      for (filename, ival) in used.iteritems():
+        if len(ival):
+          reported[filename].append(ival)
+
+    # Merge and validate everything before touching any padfile.
+    unknown = []
+    overlaps = {}
+    merges = []
+    current = self._currentByName()
+    for (filename, ivals) in sorted(reported.iteritems()):
+      padfile = self.findPadfile(filename, current)
+      if padfile is None:
+        unknown.append(filename)
+        continue
+      elif padfile.subdir == "spent":
+        continue
+
+      merged, overlap = Interval.mergeAll([padfile.extents] + ivals)
+      if merged.max() >= padfile.size:
+        raise InvalidPad("Notification for %s exceeds the padfile." % filename)
+      if len(overlap):
+        overlaps[filename] = overlap
+      merges.append((padfile, merged))
+
+    for (padfile, merged) in merges:
+      if padfile.subdir == "incoming":
+        self._claimPadfile(padfile)
+      padfile.mergeExtents(merged)
+      if padfile.free == 0:
+        self._retirePadfile(padfile)
+
+    self.flush()
+    return unknown, overlaps
+
   @property
   def uncommitted(self):
     return self._uncommitted
 
+  @property
+  def filesystem(self):
+    """The Filesystem the pad lives on, for resolving padfiles."""
+    return self._fs
+
+def _makeFilesystem(path):
+  """Returns a Filesystem for path (a DirfdFilesystem where supported), or a
+     StripedFilesystem if path is a sequence of paths."""
+  if not isinstance(path, basestring):
+    return StripedFilesystem(path)
+  elif atfile.AVAILABLE:
+    return DirfdFilesystem(path)
+  return Filesystem(path)
+
 def createPad(path):
-  """Creates a new empty pad at the specified path."""
-  Pad.createPad(Filesystem(path))
+  """Creates a new empty pad at the specified path (or paths, to stripe the
+     pad across them)."""
+  Pad.createPad(_makeFilesystem(path))
   return loadPad(path)
 
 def loadPad(path):
-  """Loads an existing pad at the given path."""
-  return Pad(Filesystem(path))
+  """Loads an existing pad at the given path (or paths)."""
+  return Pad(_makeFilesystem(path))
@@ -0,0 +1,179 @@
+"""
+Progress reporting for long runs. The XOR engines, the stream paths of
+OneTimePad and the pad generator report each buffer they finish to a
+Progress, along with the time spent reading, xoring and writing it. The
+Progress passes periodic reports to its listeners, such as StderrReporter
+for people and JSONReporter for job schedulers.
+
+The time in each phase tells a slow disk (mostly read or write) from a slow
+engine (mostly xor), and a run whose byte count stops moving from one that
+is merely slow.
+"""
+
+import json
+import sys
+import threading
+import time
+
+PHASES = ("read", "xor", "write")
+
+class Report(object):
+  """A snapshot of a Progress. done and total (None if unknown) are in
+     bytes, elapsed and eta (None if unknown) in seconds, rate is the bytes
+     per second since the last report and average since the start. phases
+     maps each phase to the seconds spent in it, summed over all threads."""
+
+  def __init__(self, done, total, elapsed, rate, average, eta, phases,
+               finished):
+    self.done = done
+    self.total = total
+    self.elapsed = elapsed
+    self.rate = rate
+    self.average = average
+    self.eta = eta
+    self.phases = phases
+    self.finished = finished
+
+  def toData(self):
+    """Returns the report as a JSON-compatible dict."""
+    data = {"done": self.done, "total": self.total,
+            "elapsed": round(self.elapsed, 3), "rate": int(self.rate),
+            "average": int(self.average), "finished": self.finished,
+            "eta": None if self.eta is None else round(self.eta, 1)}
+    for (phase, seconds) in self.phases.iteritems():
+      data[phase] = round(seconds, 3)
+    return data
+
+class Progress(object):
+  """Counts the bytes done by a run, and the time spent in each phase, and
+     passes a Report to every listener at most once per interval seconds and
+     once more when the run finishes. May be updated from several threads;
+     listeners are called by one thread at a time."""
+
+  def __init__(self, total=None, listeners=(), interval=1.0,
+               clock=time.time):
+    self.total = total
+    self.interval = interval
+    self._listeners = list(listeners)
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._notifying = threading.Lock()
+    self._done = 0
+    self._phases = dict((phase, 0.0) for phase in PHASES)
+    self._start = self._last = clock()
+    self._last_done = 0
+    self._finished = False
+
+  def addListener(self, listener):
+    """Calls listener with each Report from now on."""
+    self._listeners.append(listener)
+
+  def update(self, count=0, **phases):
+    """Records count more bytes done, and the seconds spent on them in each
+       phase given as a keyword (read, xor or write). Reports if the interval
+       has passed."""
+    with self._lock:
+      self._done += count
+      for (phase, seconds) in phases.iteritems():
+        self._phases[phase] += seconds
+      now = self._clock()
+      if now - self._last < self.interval:
+        return
+      report = self._report(now)
+    self._notify(report)
+
+  def report(self):
+    """Returns a Report of the progress so far without passing it on."""
+    with self._lock:
+      return self._report(self._clock(), advance=False)
+
+  def finish(self):
+    """Marks the run finished and passes the final Report on. Later calls
+       do nothing."""
+    with self._lock:
+      if self._finished:
+        return
+      self._finished = True
+      report = self._report(self._clock())
+    self._notify(report)
+
+  def _report(self, now, advance=True):
+    """Makes a Report as of now, starting a new interval if advance. Called
+       with the lock held."""
+    elapsed = now - self._start
+    since = now - self._last
+    rate = (self._done - self._last_done) / since if since > 0 else 0.0
+    average = self._done / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if self.total is not None and average > 0:
+      eta = max(0, self.total - self._done) / average
+    if advance:
+      self._last = now
+      self._last_done = self._done
+    return Report(self._done, self.total, elapsed, rate, average, eta,
+                  dict(self._phases), self._finished)
+
+  def _notify(self, report):
+    """Passes report to the listeners, outside the counting lock so a slow
+       listener only holds up the thread that happened to report."""
+    with self._notifying:
+      for listener in self._listeners:
+        listener(report)
+
+def formatSize(count):
+  """Returns a byte count in the largest binary unit it fills."""
+  for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+    if abs(count) < 1024 or unit == "TiB":
+      break
+    count /= 1024.0
+  return ("%i %s" if unit == "B" else "%.1f %s") % (count, unit)
+
+def formatDuration(seconds):
+  """Returns seconds as h:mm:ss."""
+  seconds = int(round(seconds))
+  return "%i:%02i:%02i" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class StderrReporter(object):
+  """Listener keeping a one-line summary of progress up to date on a
+     terminal (stderr by default)."""
+
+  def __init__(self, stream=None):
+    self._stream = stream or sys.stderr
+    self._width = 0
+
+  def __call__(self, report):
+    if report.total:
+      done = "%s / %s (%i%%)" % (formatSize(report.done),
+                                 formatSize(report.total),
+                                 100 * report.done // report.total)
+    else:
+      done = formatSize(report.done)
+    if report.finished:
+      speed = "%.1f MB/s in %s" % (report.average / 1e6,
+                                   formatDuration(report.elapsed))
+    else:
+      speed = "%.1f MB/s" % (report.rate / 1e6)
+      if report.eta is not None:
+        speed += ", ETA %s" % formatDuration(report.eta)
+    busy = sum(report.phases.itervalues())
+    shares = ", ".join("%s %i%%" % (phase, 100 * report.phases[phase] // busy)
+                       for phase in PHASES if busy > 0)
+    line = "  ".join(part for part in (done, speed, shares) if part)
+
+    # Pad out whatever is left of a longer previous line.
+    self._stream.write("\r" + line.ljust(self._width))
+    self._width = len(line)
+    if report.finished:
+      self._stream.write("\n")
+    self._stream.flush()
+
+class JSONReporter(object):
+  """Listener writing each report as a line of JSON (see Report.toData) to
+     a stream, for programs watching a run."""
+
+  def __init__(self, stream):
+    self._stream = stream
+
+  def __call__(self, report):
+    self._stream.write(json.dumps(report.toData(), sort_keys=True) + "\n")
+    self._stream.flush()
@@ -0,0 +1,20 @@
+"""
+Parsing of human-friendly sizes, shared by justonce and the XOR benchmark.
+"""
+
+import argparse
+
+_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parseSize(text):
+  """Parses a size such as 512, 64K, 4M or 10G. Raises
+     argparse.ArgumentTypeError, so it can be used as an argument type."""
+  text = text.strip().upper()
+  suffix = text[-1:] if text[-1:] in _SUFFIXES else ""
+  try:
+    value = int(text[:len(text) - len(suffix)]) * _SUFFIXES[suffix]
+  except ValueError:
+    raise argparse.ArgumentTypeError("Bad size %r." % text)
+  if value <= 0:
+    raise argparse.ArgumentTypeError("Sizes must be positive.")
+  return value
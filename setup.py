@@ -1,19 +1,53 @@
+import sys
+
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
+    from setuptools.command.build_ext import build_ext
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+    from distutils.command.build_ext import build_ext
+from distutils.errors import (CCompilerError, DistutilsExecError,
+                              DistutilsPlatformError)
+
+class optional_build_ext(build_ext):
+    """Builds the native XOR engine if possible. Without a compiler (or on a
+    platform it doesn't support) the pure Python engine is used instead, so
+    a failed build only warns."""
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError as ex:
+            self.warn_native(ex)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError,
+                DistutilsPlatformError) as ex:
+            self.warn_native(ex)
+
+    def warn_native(self, ex):
+        sys.stderr.write("Could not build the native XOR engine (%s); the "
+                         "slow Python one will be used.\n" % ex)
+
+cxor = Extension('xor._cxor',
+                 sources=['xor/_cxormodule.c', 'xor/cxor.c'],
+                 depends=['xor/cxor.h'],
+                 extra_compile_args=['-std=gnu99', '-O3'])
 
 config = {
-    'description': 'My Project',
+    'description': 'Fast one-time pad utility',
     'author': 'Alex Roper',
     'url': '',
     'download_url': '',
     'author_email': 'alexr@ugcs.net',
     'version': '0.1',
-    'install_requires': ['nose'],
-    'packages': ['NAME'],
-    'scripts': [],
-    'name': 'projectname'
+    'packages': ['justthisonce', 'xor'],
+    'ext_modules': [cxor],
+    'cmdclass': {'build_ext': optional_build_ext},
+    'scripts': ['bin/justonce'],
+    'name': 'justthisonce'
 }
 
 setup(**config)
@@ -0,0 +1,443 @@
+import cStringIO
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from justthisonce import api
+from justthisonce.api import OneTimePad
+from justthisonce import compression
+from justthisonce import integrity
+from justthisonce import message
+from justthisonce import progress
+import xor.xor
+
+class test_OneTimePad(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.paddir = os.path.join(self.tmpdir, "pad")
+    rng = random.Random(0)
+    self.otp = OneTimePad(self.paddir, create=True)
+    for i in range(2):
+      data = "".join(chr(rng.randrange(256)) for j in range(2000))
+      open(os.path.join(self.paddir, "incoming", "pad%i" % i), 'w').write(data)
+    self.plaintext = "".join(chr(rng.randrange(256)) for j in range(3000))
+    self.infile = os.path.join(self.tmpdir, "in")
+    open(self.infile, 'w').write(self.plaintext)
+
+  def tearDown(self):
+    self.otp.close()
+    assert self.tmpdir.startswith(tempfile.gettempdir())
+    shutil.rmtree(self.tmpdir)
+
+  def test_decryptRange(self):
+    """Tests decrypting parts of a message that spans padfiles."""
+    outfile = os.path.join(self.tmpdir, "out")
+    msg = message.Message.fromJSON(self.otp.encryptFile(self.infile, outfile))
+    self.assertEqual(len(list(msg.allocation.iterFiles())), 2)
+    for (offset, length) in ((0, 3000), (0, 0), (1990, 20), (2999, 1),
+                             (5, 100)):
+      self.assertEqual(self.otp.decryptRange(msg, outfile, offset, length),
+                       self.plaintext[offset:offset + length])
+    self.assertRaises(ValueError, self.otp.decryptRange, msg, outfile, 2990,
+                      11)
+
+  def test_decryptRange_container(self):
+    """Tests decrypting part of a container."""
+    outfile = os.path.join(self.tmpdir, "out")
+    self.otp.encryptFile(self.infile, outfile, container=True)
+    with open(outfile, "rb") as fd:
+      msg, base, length = message.readContainer(fd)
+      self.assertEqual(self.otp.decryptRange(msg, fd, 100, 50, base),
+                       self.plaintext[100:150])
+
+  def test_tree(self):
+    """Tests payloads can be verified against a tree built while encrypting,
+       whole or in part."""
+    for i in range(2, 4):
+      open(os.path.join(self.paddir, "incoming", "pad%i" % i), 'w').write(
+          os.urandom(4000))
+    for container in (False, True):
+      outfile = os.path.join(self.tmpdir, "out%i" % container)
+      header = self.otp.encryptFile(self.infile, outfile, container=container,
+                                    tree=True)
+      if container:
+        fd = open(outfile, "rb")
+        msg, base, length = message.readContainer(fd)
+        fd.close()
+      else:
+        msg, base = message.Message.fromJSON(header), 0
+      self.assertEqual(msg.tree.length, 3000)
+      self.assertTrue(self.otp.verify(msg, outfile, base, threads=2))
+      self.assertEqual(self.otp.decryptRange(msg, outfile, 10, 20, base),
+                       self.plaintext[10:30])
+
+    # Corruption is caught by ranges that touch it, and only those.
+    msg.tree = integrity.HashTree.build(outfile, 3000, base, chunk_size=100)
+    data = bytearray(open(outfile, "rb").read())
+    data[base + 2500] ^= 1
+    open(outfile, "wb").write(data)
+    with self.assertRaises(integrity.IntegrityError) as cm:
+      self.otp.verify(msg, outfile, base)
+    self.assertEqual(cm.exception.args, (25,))
+    self.assertEqual(self.otp.decryptRange(msg, outfile, 2400, 100, base),
+                     self.plaintext[2400:2500])
+    self.assertRaises(integrity.IntegrityError, self.otp.decryptRange, msg,
+                      outfile, 2450, 100, base)
+    self.otp.decryptRange(msg, outfile, 2450, 100, base, verify=False)
+
+    msg.tree = None
+    self.assertFalse(self.otp.verify(msg, outfile, base))
+    self.assertRaises(ValueError, self.otp.encryptFile, self.infile, None,
+                      tree=True)
+
+  def test_compress(self):
+    """Tests compressed messages use only the pad they need and decrypt."""
+    lines = "".join("line %i of the log\n" % (i % 7) for i in range(1000))
+    open(self.infile, 'w').write(lines)
+    for container in (False, True):
+      outfile = os.path.join(self.tmpdir, "out%i" % container)
+      plain = os.path.join(self.tmpdir, "plain%i" % container)
+      header = self.otp.encryptFile(self.infile, outfile, size=100,
+                                    container=container, codec="zlib")
+      if container:
+        fd = open(outfile, "rb")
+        msg, base, length = message.readContainer(fd)
+        fd.close()
+      else:
+        msg, base = message.Message.fromJSON(header), 0
+      self.assertEqual(msg.data["codec"], "zlib")
+      self.assertTrue(msg.length < len(lines) // 10)
+      self.assertEqual(len(msg.allocation), msg.length)
+      self.assertEqual(os.path.getsize(outfile) - base,
+                       msg.length + (len(header) if container else 0))
+      self.otp.decryptFile(msg, outfile, plain, base)
+      self.assertEqual(open(plain).read(), lines)
+      self.assertRaises(ValueError, self.otp.decryptRange, msg, outfile, 0, 1,
+                        base)
+
+    # Every block was committed: the pad used is exactly the payloads'.
+    self.otp.close()
+    self.otp = OneTimePad(self.paddir)
+    used = self.otp._pad.makeNotification()
+    self.assertEqual(sum(len(ival) for ival in used.itervalues()),
+                     2 * msg.length)
+    self.assertRaises(compression.UnknownCodec, self.otp.encryptFile,
+                      self.infile, os.path.join(self.tmpdir, "bad"),
+                      codec="bogus")
+    self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "bad")))
+
+  def test_decryptFile(self):
+    """Tests decrypting whole payloads checks their tree."""
+    outfile = os.path.join(self.tmpdir, "out")
+    plain = os.path.join(self.tmpdir, "plain")
+    msg = message.Message.fromJSON(self.otp.encryptFile(self.infile, outfile,
+                                                        tree=True))
+    self.otp.decryptFile(msg, outfile, plain)
+    self.assertEqual(open(plain).read(), self.plaintext)
+
+    data = bytearray(open(outfile, "rb").read())
+    data[0] ^= 1
+    open(outfile, "wb").write(data)
+    self.assertRaises(integrity.IntegrityError, self.otp.decryptFile, msg,
+                      outfile, plain)
+    self.otp.decryptFile(msg, outfile, plain, verify=False)
+    self.assertEqual(open(plain).read()[1:], self.plaintext[1:])
+
+  def test_decryptFile_engine(self):
+    """Tests uncompressed payloads are decrypted by the XOR engines, which
+       find the padfiles of messages read without a lookup."""
+    container = os.path.join(self.tmpdir, "container")
+    plain = os.path.join(self.tmpdir, "plain")
+    self.otp.encryptFile(self.infile, container, container=True)
+    with open(container, "rb") as fd:
+      msg, base, length = message.readContainer(fd)
+    open(plain, "w").write("stale")
+    with mock.patch("xor.xor.xorAllocationParallel",
+                    wraps=xor.xor.xorAllocationParallel) as engine:
+      self.otp.decryptFile(msg, container, plain, base)
+    self.assertEqual(engine.call_count, 1)
+    self.assertEqual(open(plain).read(), self.plaintext)
+
+  def _padUsed(self):
+    """Returns how many bytes of pad have been used in all."""
+    return sum(len(ival) for ival in self.otp._pad.makeNotification().values())
+
+  def test_stream_batches(self):
+    """Tests streams claim pad in growing batches rather than per block,
+       using exactly what they need."""
+    encrypted = cStringIO.StringIO()
+    with mock.patch.object(self.otp, "_claim",
+                           wraps=self.otp._claim) as claim:
+      header = self.otp.encryptStream(cStringIO.StringIO(self.plaintext),
+                                      encrypted, size=100)
+    claimed = [call[0][0] for call in claim.call_args_list]
+    self.assertTrue(len(claimed) < 20)
+    self.assertEqual(claimed, sorted(claimed))
+    self.assertTrue(3000 <= sum(claimed) <= 3000 + 3000 // 4)
+    msg = message.Message.fromJSON(header)
+    self.assertEqual(msg.length, 3000)
+    self.assertEqual(self._padUsed(), 3000)
+    decrypted = cStringIO.StringIO()
+    self.otp.decryptStream(msg, cStringIO.StringIO(encrypted.getvalue()),
+                           decrypted)
+    self.assertEqual(decrypted.getvalue(), self.plaintext)
+
+    with mock.patch.object(self.otp, "_claim",
+                           wraps=self.otp._claim) as claim:
+      self.otp.encryptStream(cStringIO.StringIO("x" * 50),
+                             cStringIO.StringIO(), size=100)
+    self.assertEqual(claim.call_args_list, [mock.call(50)])
+    self.assertEqual(self._padUsed(), 3050)
+
+  def test_stream_release(self):
+    """Tests the rest of the last batch is given back, so a compressed
+       stream uses exactly its compressed length, even from a padfile that
+       the batch had spent."""
+    plaintext = "".join(self.plaintext[i:i + 10] * 20
+                        for i in xrange(0, 2200, 10))
+    encrypted = cStringIO.StringIO()
+    header = self.otp.encryptStream(cStringIO.StringIO(plaintext), encrypted,
+                                    size=64, codec="zlib")
+    msg = message.Message.fromJSON(header)
+    self.assertTrue(2000 < msg.length < len(plaintext))
+    self.assertEqual(self._padUsed(), msg.length)
+    self.assertEqual(len(self.otp.makeNotification(True)),
+                     len(message.Notification(
+                         self.otp._pad.makeNotification(), True).toJSON()))
+    decrypted = cStringIO.StringIO()
+    self.otp.decryptStream(msg, cStringIO.StringIO(encrypted.getvalue()),
+                           decrypted)
+    self.assertEqual(decrypted.getvalue(), plaintext)
+
+    # Released pad is handed out again, a block at a time once a batch no
+    # longer fits.
+    self.otp.encryptStream(cStringIO.StringIO(os.urandom(4000 - msg.length)),
+                           cStringIO.StringIO(), size=64)
+    self.assertEqual(self._padUsed(), 4000)
+
+  def test_progress(self):
+    """Tests encrypting and decrypting streams report every byte."""
+    for codec in (None, "zlib"):
+      encrypted = cStringIO.StringIO()
+      meter = progress.Progress()
+      header = self.otp.encryptStream(cStringIO.StringIO(self.plaintext[:1000]),
+                                      encrypted, size=300, codec=codec,
+                                      progress=meter)
+      msg = message.Message.fromJSON(header)
+      self.assertEqual(meter.report().done, msg.length)
+
+      meter = progress.Progress()
+      plain = cStringIO.StringIO()
+      self.otp.decryptStream(msg, cStringIO.StringIO(encrypted.getvalue()),
+                             plain, progress=meter)
+      self.assertEqual(plain.getvalue(), self.plaintext[:1000])
+      self.assertEqual(meter.report().done, msg.length)
+
+  def test_filter(self):
+    """Tests streams encrypt to self-contained containers from stdin and
+       with trailers, and decrypt from pipes."""
+    outfile = os.path.join(self.tmpdir, "out")
+    with mock.patch("sys.stdin", cStringIO.StringIO(self.plaintext)):
+      self.otp.encryptFile(None, outfile, size=1000, container=True)
+    with open(outfile, "rb") as fd:
+      msg, base, length = message.readContainer(fd)
+      self.assertEqual(self.otp.decryptRange(msg, fd, 0, 3000, base),
+                       self.plaintext)
+
+    for ahead in (1, 3):
+      encrypted = cStringIO.StringIO()
+      self.otp.generatePad(1000)
+      header = self.otp.encryptStream(cStringIO.StringIO(self.plaintext[:900]),
+                                      encrypted, size=100, ahead=ahead,
+                                      trailer=True)
+      encrypted.seek(0)
+      msg, base, length = message.readContainer(encrypted)
+      self.assertEqual(msg.toJSON(), header)
+      plain = cStringIO.StringIO()
+      self.otp.decryptStream(msg, encrypted, plain, size=70, ahead=ahead)
+      self.assertEqual(plain.getvalue(), self.plaintext[:900])
+
+  def test_decompression_bound(self):
+    """Tests a payload that expands a lot is written a block at a time."""
+    data = "\0" * (1024 * 1024)
+    encrypted = cStringIO.StringIO()
+    header = self.otp.encryptStream(cStringIO.StringIO(data), encrypted,
+                                    size=100, codec="zlib")
+    msg = message.Message.fromJSON(header)
+    self.assertTrue(msg.length < 4000)
+    output = mock.Mock()
+    self.otp.decryptStream(msg, cStringIO.StringIO(encrypted.getvalue()),
+                           output, size=100)
+    writes = [call[0][0] for call in output.write.call_args_list]
+    self.assertEqual("".join(writes), data)
+    self.assertTrue(max(map(len, writes)) <= 100)
+
+  def test_filter_errors(self):
+    """Tests failures on either side of a stream surface rather than
+       hang."""
+    class Broken(object):
+      def read(self, size):
+        raise IOError("Broken input.")
+      write = read
+    threads = threading.active_count()
+    claim = mock.Mock(wraps=self.otp._claim)
+    with mock.patch.object(self.otp, "_claim", claim):
+      self.assertRaises(IOError, self.otp.encryptStream, Broken(),
+                        cStringIO.StringIO(), size=100)
+      self.assertRaises(IOError, self.otp.encryptStream,
+                        cStringIO.StringIO(self.plaintext), Broken(),
+                        size=100, ahead=1)
+    self.assertRaises(ValueError, self.otp.encryptStream,
+                      cStringIO.StringIO(), cStringIO.StringIO(), ahead=0)
+    # The reader is waited for, and only the block that was written claimed
+    # pad.
+    self.assertEqual(threading.active_count(), threads)
+    self.assertEqual(claim.call_count, 1)
+
+  def test_filter_blocked(self):
+    """Tests a reader blocked on its source is left behind, claiming no
+       pad, when the output fails."""
+    release = threading.Event()
+    class Stalled(object):
+      def __init__(self):
+        self.reads = 0
+      def read(self, size):
+        self.reads += 1
+        if self.reads > 3:
+          release.wait(10)
+          return ""
+        return "x" * size
+    class Broken(object):
+      def write(self, data):
+        raise IOError("Broken output.")
+    threads = threading.active_count()
+    claim = mock.Mock(wraps=self.otp._claim)
+    with mock.patch.object(self.otp, "_claim", claim):
+      self.assertRaises(IOError, self.otp.encryptStream, Stalled(), Broken(),
+                        size=100, ahead=1)
+      release.set()
+      for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+          thread.join(10)
+    self.assertEqual(threading.active_count(), threads)
+    self.assertEqual(claim.call_count, 1)
+
+  def test_markSynced(self):
+    """Tests marking a notification synced keeps use committed since it was
+       made."""
+    for (i, size) in enumerate((100, 50)):
+      open(self.infile, "w").write(self.plaintext[:size])
+      self.otp.encryptFile(self.infile, os.path.join(self.tmpdir, "out%i" % i))
+      if i == 0:
+        sent = self.otp.makeNotification(True)
+    self.otp.markSynced(sent)
+    delta = message.Notification.fromJSON(self.otp.makeNotification(True))
+    self.assertEqual(sum(len(ival) for ival in delta.extents.itervalues()), 50)
+    self.assertEqual(len(message.Notification.fromJSON(sent).extents["pad0"]),
+                     100)
+
+  def test_generatePad(self):
+    """Tests generated padfiles land whole in incoming and can be used."""
+    meter = progress.Progress()
+    created = self.otp.generatePad(5000, 2, progress=meter)
+    self.assertEqual(len(created), 2)
+    self.assertEqual(meter.report().done, 10000)
+    incoming = os.listdir(os.path.join(self.paddir, "incoming"))
+    for filename in created:
+      self.assertTrue(filename in incoming)
+      self.assertEqual(os.path.getsize(os.path.join(self.paddir, "incoming",
+                                                    filename)), 5000)
+    self.assertFalse([name for name in os.listdir(self.paddir)
+                      if name.endswith(".partial")])
+    self.assertRaises(ValueError, self.otp.generatePad, 0)
+
+    # The original padfiles only hold 4000 bytes.
+    open(self.infile, 'w').write(os.urandom(9000))
+    self.otp.encryptFile(self.infile, os.path.join(self.tmpdir, "out"))
+
+  def _tree(self):
+    """Makes a small tree of files to encrypt, returning its path and a
+       mapping from relative path to contents."""
+    indir = os.path.join(self.tmpdir, "tree")
+    contents = {}
+    for (i, relpath) in enumerate(["empty", "b/c", "b/d/e", "b/f", "z"]):
+      path = os.path.join(indir, relpath)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      contents[relpath] = self.plaintext[:i * 200]
+      open(path, "w").write(contents[relpath])
+    return indir, contents
+
+  def test_encryptTree(self):
+    """Tests trees are encrypted in batches and decrypt to the same files."""
+    indir, contents = self._tree()
+    self.assertEqual(api.walkTree(indir),
+                     sorted((relpath, len(data))
+                            for (relpath, data) in contents.iteritems()))
+    for archive in (False, True):
+      outdir = os.path.join(self.tmpdir, "enc%i" % archive)
+      decdir = os.path.join(self.tmpdir, "dec%i" % archive)
+      claim = mock.Mock(wraps=self.otp._claim)
+      with mock.patch.object(self.otp, "_claim", claim):
+        headers = self.otp.encryptTree(indir, outdir, workers=3,
+                                       tree=archive, archive=archive,
+                                       batch_files=2)
+      self.assertEqual(claim.call_count, 3)
+      self.assertEqual(sorted(headers), sorted(contents))
+      self.otp.decryptTree(outdir, decdir, workers=2, archive=archive)
+      for (relpath, data) in contents.iteritems():
+        self.assertEqual(open(os.path.join(decdir, relpath)).read(), data)
+
+    # Each file has its own pad.
+    used = [(filename, point) for header in headers.itervalues()
+            for (filename, start, length)
+            in message.Message.fromJSON(header).iterAllocation()
+            for point in xrange(start, start + length)]
+    self.assertEqual(len(set(used)), sum(map(len, contents.itervalues())))
+
+  def test_tree_failure(self):
+    """Tests a file that fails does not stop the rest."""
+    indir, contents = self._tree()
+    walk = api.walkTree(indir)
+    walk[1] = (walk[1][0], walk[1][1] + 1)
+    outdir = os.path.join(self.tmpdir, "enc")
+    with mock.patch("justthisonce.api.walkTree", return_value=walk):
+      with self.assertRaises(api.TreeFailed) as cm:
+        self.otp.encryptTree(indir, outdir, batch_size=500)
+    self.assertEqual(cm.exception.args[0].keys(), [walk[1][0]])
+    self.assertEqual(len(api.walkTree(outdir)), len(contents) - 1)
+
+  def test_unsafe_archive(self):
+    """Tests archive ids that would leave outdir are failed, not written."""
+    indir, contents = self._tree()
+    outdir = os.path.join(self.tmpdir, "enc")
+    self.otp.encryptTree(indir, outdir, archive=True)
+    open(self.infile, "w").write("escaped")
+    container = os.path.join(self.tmpdir, "container")
+    self.otp.encryptFile(self.infile, container, container=True)
+    store = message.MessageArchive(outdir)
+    unsafe = ["../escape", "b/../../escape", os.path.abspath("escape"), "."]
+    for message_id in unsafe:
+      with open(container, "rb") as fd:
+        store.append(message_id, fd)
+    store.close()
+
+    decdir = os.path.join(self.tmpdir, "dec", "out")
+    with self.assertRaises(api.TreeFailed) as cm:
+      self.otp.decryptTree(outdir, decdir, archive=True)
+    failures = cm.exception.args[0]
+    self.assertEqual(sorted(failures), sorted(unsafe))
+    for exc in failures.itervalues():
+      self.assertTrue(isinstance(exc, api.UnsafePath))
+    self.assertEqual(os.listdir(os.path.join(self.tmpdir, "dec")), ["out"])
+    self.assertFalse(os.path.exists(os.path.abspath("escape")))
+    for (relpath, data) in contents.iteritems():
+      self.assertEqual(open(os.path.join(decdir, relpath)).read(), data)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+import cStringIO
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from justthisonce.asyncpad import *
+from justthisonce import message
+
+class test_Executor(unittest.TestCase):
+  def test_submit(self):
+    """Tests results and exceptions reach the Future and its callbacks."""
+    executor = Executor(2)
+    done = []
+    future = executor.submit(sum, ([1, 2, 3],))
+    self.assertEqual(future.result(5), 6)
+    future.addDoneCallback(done.append)
+    self.assertEqual(done, [future])
+
+    failed = executor.submit(int, ("x",))
+    self.assertRaises(ValueError, failed.result, 5)
+    self.assertTrue(isinstance(failed.exception(), ValueError))
+    executor.shutdown()
+    self.assertRaises(Closed, executor.submit, sum, ([],))
+
+  def test_backpressure(self):
+    """Tests a full queue holds callers back."""
+    executor = Executor(1, queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+    def blocker():
+      started.set()
+      release.wait()
+      return "released"
+    first = executor.submit(blocker)
+    started.wait()
+    second = executor.submit(blocker)
+    self.assertRaises(Busy, executor.submit, blocker, block=False)
+    self.assertRaises(Timeout, first.result, 0.01)
+
+    done = []
+    second.addDoneCallback(lambda future: done.append(future.result()))
+    release.set()
+    self.assertEqual(first.result(5), "released")
+    executor.shutdown()
+    self.assertEqual(done, ["released"])
+
+class test_AsyncOneTimePad(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.paddir = os.path.join(self.tmpdir, "pad")
+    self.otp = AsyncOneTimePad(self.paddir, create=True, workers=4)
+    for i in range(3):
+      open(os.path.join(self.paddir, "incoming", "pad%i" % i), 'w').write(
+          os.urandom(10000))
+
+  def tearDown(self):
+    self.otp.close()
+    assert self.tmpdir.startswith(tempfile.gettempdir())
+    shutil.rmtree(self.tmpdir)
+
+  def test_concurrent(self):
+    """Tests concurrent messages get disjoint pad and decrypt."""
+    rng = random.Random(0)
+    plaintexts = ["".join(chr(rng.randrange(256)) for j in range(rng.randrange(
+        1, 2000))) for i in range(12)]
+    futures = []
+    for (i, plaintext) in enumerate(plaintexts):
+      if i % 2:
+        output = cStringIO.StringIO()
+        futures.append((output, self.otp.encryptStream(
+            cStringIO.StringIO(plaintext), output, size=300)))
+      else:
+        infile = os.path.join(self.tmpdir, "in%i" % i)
+        open(infile, 'w').write(plaintext)
+        output = os.path.join(self.tmpdir, "out%i" % i)
+        futures.append((output, self.otp.encryptFile(infile, output)))
+
+    used = []
+    for ((output, future), plaintext) in zip(futures, plaintexts):
+      msg = message.Message.fromJSON(future.result(10))
+      used.extend((filename, point) for (filename, start, length)
+                  in msg.iterAllocation()
+                  for point in xrange(start, start + length))
+      if isinstance(output, basestring):
+        source = open(output, "rb")
+      else:
+        source = cStringIO.StringIO(output.getvalue())
+      plain = cStringIO.StringIO()
+      self.otp.decryptStream(msg, source, plain).result(10)
+      source.close()
+      self.assertEqual(plain.getvalue(), plaintext)
+    self.assertEqual(len(used), sum(map(len, plaintexts)))
+    self.assertEqual(len(set(used)), len(used))
+
+if __name__ == '__main__':
+  unittest.main()
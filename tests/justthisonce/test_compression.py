@@ -0,0 +1,50 @@
+import cStringIO
+import unittest
+
+from justthisonce import compression
+from justthisonce.compression import *
+
+class test_compression(unittest.TestCase):
+  def test_roundtrip(self):
+    """Tests every available codec streams data back unchanged."""
+    data = "".join("entry %i\n" % (i % 13) for i in range(5000))
+    self.assertIn("zlib", CODECS)
+    for name in CODECS:
+      pieces = list(compressStream(cStringIO.StringIO(data), name, 1000))
+      self.assertTrue(len("".join(pieces)) < len(data) // 10)
+      decompressor = getCodec(name).decompressor()
+      out = [decompressor.decompress(piece) for piece in pieces]
+      out.append(decompressor.flush())
+      self.assertEqual("".join(out), data)
+
+  def test_decompressPieces(self):
+    """Tests data that expands a lot is decompressed in bounded pieces."""
+    data = "\0" * (1024 * 1024)
+    for name in CODECS:
+      compressed = "".join(compressStream(cStringIO.StringIO(data), name,
+                                          len(data)))
+      self.assertTrue(len(compressed) < 10000)
+      decompressor = getCodec(name).decompressor()
+      pieces = list(decompressPieces(decompressor, compressed, 1000))
+      pieces.append(decompressor.flush())
+      self.assertEqual("".join(pieces), data)
+      if name == "zlib":
+        self.assertEqual(max(map(len, pieces)), 1000)
+
+    # Decompressors that can't limit their output take their input a piece
+    # at a time.
+    class Echo(object):
+      def decompress(self, data):
+        return data
+    decompressor = compression._Flushless(Echo())
+    self.assertEqual(list(decompressPieces(decompressor, "abcdefg", 3)),
+                     ["abc", "def", "g"])
+
+  def test_unknown(self):
+    """Tests unknown codecs are refused."""
+    self.assertRaises(UnknownCodec, getCodec, "bogus")
+    self.assertRaises(UnknownCodec, list,
+                      compressStream(cStringIO.StringIO(""), "bogus", 10))
+
+if __name__ == '__main__':
+  unittest.main()
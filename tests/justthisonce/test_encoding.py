@@ -0,0 +1,64 @@
+import random
+import unittest
+
+from justthisonce.encoding import *
+
+class test_encoding(unittest.TestCase):
+  def test_varint(self):
+    """Tests varints round trip and are compact."""
+    for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 + 5):
+      data = encodeVarint(value)
+      self.assertEqual(decodeVarint(data), (value, len(data)))
+      self.assertEqual(decodeVarint("xx" + data + "yy", 2),
+                       (value, len(data) + 2))
+    self.assertEqual(len(encodeVarint(127)), 1)
+    self.assertEqual(len(encodeVarint(128)), 2)
+    self.assertRaises(AssertionError, encodeVarint, -1)
+    self.assertRaises(BadEncoding, decodeVarint, "")
+    self.assertRaises(BadEncoding, decodeVarint, encodeVarint(300)[:-1])
+
+  def test_atoms(self):
+    """Tests atom runs round trip."""
+    rng = random.Random(0)
+    for count in (0, 1, 2, 100):
+      atoms = []
+      end = 0
+      for i in range(count):
+        start = end + rng.randrange(0, 2 ** rng.randrange(1, 40))
+        atoms.append((start, rng.randrange(1, 2 ** rng.randrange(1, 40))))
+        end = sum(atoms[-1])
+      data = encodeAtoms(atoms)
+      self.assertEqual(decodeAtoms(data), (atoms, len(data)))
+
+    # Size depends on the gaps and lengths, not the offsets.
+    self.assertEqual(len(encodeAtoms([(2 ** 40, 1), (2 ** 40 + 2, 1)])),
+                     len(encodeAtoms([(2 ** 40, 1)])) + 2)
+
+    self.assertRaises(AssertionError, encodeAtoms, [(5, 2), (6, 1)])
+    self.assertRaises(BadEncoding, decodeAtoms, encodeAtoms([(5, 2)])[:-1])
+    self.assertRaises(BadEncoding, decodeAtoms, "\x01\x00\x00")
+
+  def test_allocation(self):
+    """Tests allocations round trip, compressed or not."""
+    files = [(u"a", [(0, 5), (10, 5)]), (u"b\xe9", []),
+             (u"c", [(i * 10, 3) for i in range(1000)])]
+    for compress in (False, True):
+      data = encodeAllocation(files, compress)
+      self.assertEqual(decodeAllocation(data), files)
+      self.assertEqual(list(iterAllocation(data)),
+                       [(filename, start, length)
+                        for (filename, atoms) in files
+                        for (start, length) in atoms])
+    self.assertTrue(len(encodeAllocation(files, True)) <
+                    len(encodeAllocation(files)))
+    self.assertEqual(decodeAllocation(encodeAllocation([])), [])
+
+  def test_allocation_bad(self):
+    """Tests malformed allocations are rejected."""
+    data = encodeAllocation([("a", [(0, 5)])])
+    for bad in ("", "\x00" + data[1:], data[:-1], data + "\x00",
+                chr(ord(data[0]) | 0x80) + data[1:]):
+      self.assertRaises(BadEncoding, decodeAllocation, bad)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+import cStringIO
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from justthisonce.integrity import *
+
+class test_HashTree(unittest.TestCase):
+  def setUp(self):
+    rng = random.Random(0)
+    self.payload = "".join(chr(rng.randrange(256)) for i in range(1000))
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "payload")
+    open(self.path, "wb").write("header" + self.payload)
+
+  def tearDown(self):
+    assert self.tmpdir.startswith(tempfile.gettempdir())
+    shutil.rmtree(self.tmpdir)
+
+  def test_build(self):
+    """Tests trees agree however they are built, and with the definition."""
+    leaves = [hashChunk(self.payload[i:i + 64]) for i in range(0, 1000, 64)]
+    self.assertEqual(len(leaves), 16)
+    for threads in (1, 3, 100):
+      for source in (self.path, cStringIO.StringIO("header" + self.payload)):
+        tree = HashTree.build(source, 1000, 6, 64, threads)
+        self.assertEqual(tree.leaves, leaves)
+        self.assertEqual(tree, HashTree(1000, leaves, 64))
+    self.assertNotEqual(tree, HashTree(1000, leaves[:-1] + [leaves[0]], 64))
+    self.assertEqual(HashTree.build(self.path, 0, 6, 64).leaves, [])
+    self.assertRaises(BadTree, HashTree, 1000, leaves[:-1], 64)
+
+  def test_root(self):
+    """Tests the root over odd and even numbers of leaves."""
+    leaves = [chr(i) * DIGEST_SIZE for i in range(3)]
+    self.assertEqual(merkleRoot(leaves[:1]), leaves[0])
+    pair = merkleRoot(leaves[:2])
+    self.assertNotIn(pair, leaves)
+    self.assertEqual(merkleRoot(leaves), merkleRoot([pair, leaves[2]]))
+    self.assertNotEqual(merkleRoot(leaves[::-1]), merkleRoot(leaves))
+
+  def test_verify(self):
+    """Tests corruption is found, and only in the chunks checked."""
+    tree = HashTree.build(self.path, 1000, 6, 64)
+    tree.verify(self.path, 6)
+    self.assertEqual(list(tree.chunks(60, 10)), [0, 1])
+    self.assertEqual(list(tree.chunks(60, 0)), [])
+
+    corrupt = list("header" + self.payload)
+    for offset in (100, 900, 901):
+      corrupt[6 + offset] = chr(ord(corrupt[6 + offset]) ^ 1)
+    open(self.path, "wb").write("".join(corrupt))
+    with self.assertRaises(IntegrityError) as cm:
+      tree.verify(self.path, 6, threads=4)
+    self.assertEqual(cm.exception.args, (1, 14))
+    tree.verify(self.path, 6, 128, 700)
+    self.assertRaises(IntegrityError, tree.verify, self.path, 6, 127, 1)
+    self.assertRaises(ValueError, tree.verify, self.path, 6, 990, 11)
+
+    # Truncation is an I/O error, not corruption.
+    open(self.path, "wb").write("header" + self.payload[:-1])
+    self.assertRaises(IOError, tree.verify, self.path, 6)
+
+  def test_worker_failure(self):
+    """Tests anything a hashing thread raises reaches the caller, and chunks
+       left unhashed fail verification."""
+    tree = HashTree.build(self.path, 1000, 6, 64)
+    with mock.patch("justthisonce.integrity.hashChunk",
+                    side_effect=AssertionError("Broken worker.")):
+      self.assertRaises(AssertionError, tree.verify, self.path, 6, threads=4)
+    with mock.patch("justthisonce.integrity._hashChunks",
+                    return_value={0: tree.leaves[0], 2: tree.leaves[2]}):
+      with self.assertRaises(IntegrityError) as cm:
+        tree.verify(self.path, 6, 0, 200)
+    self.assertEqual(cm.exception.args, (1, 3))
+
+  def test_data(self):
+    """Tests trees survive serialization and tampering is caught."""
+    tree = HashTree.build(self.path, 1000, 6, 64)
+    data = tree.toData()
+    self.assertEqual(HashTree.fromData(data), tree)
+    for (key, value) in (("root", "00" * DIGEST_SIZE), ("algorithm", "md5"),
+                         ("leaves", data["leaves"][:-4]), ("chunk_size", 32),
+                         ("length", "x")):
+      bad = dict(data)
+      bad[key] = value
+      self.assertRaises(BadTree, HashTree.fromData, bad)
+    del data["root"]
+    self.assertRaises(BadTree, HashTree.fromData, data)
+
+if __name__ == '__main__':
+  unittest.main()
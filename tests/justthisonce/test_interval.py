@@ -1,8 +1,13 @@
+import collections
+import cPickle
 import itertools
+import random
 import sys
 import unittest
 
-from justthisonce.interval import Interval
+from justthisonce import encoding
+from justthisonce import interval
+from justthisonce.interval import ExtentBitmap, ExtentSet, Interval
 
 def _union_multi(ivals):
   """Unions all args pairwise left-associative."""
@@ -14,6 +19,19 @@ def _union_multi(ivals):
       acc = acc.union(ival)
     return acc
 
+def _points(ival):
+  """Returns the set of integers in the interval, for brute force checks."""
+  return set(i for (start, length) in ival.iterInterior()
+             for i in xrange(start, start + length))
+
+def _from_points(points):
+  """Inverse of _points."""
+  return Interval.fromAtoms([(i, 1) for i in points])
+
+def _random_interval(rng, universe=60):
+  """Returns a random interval within [0, universe)."""
+  return _from_points(i for i in xrange(universe) if rng.random() < 0.4)
+
 class test_Interval(unittest.TestCase):
   def test_union_empty(self):
     """Test that empty intervals are well behaved."""
@@ -269,5 +287,194 @@ class test_Interval(unittest.TestCase):
     b = Interval.fromAtoms([(0, 8), (28, 82)])
     self.assertEqual(a.union(b, True), Interval.fromAtoms([(0, 15), (20, 90)]))
 
+  def test_mergeAll(self):
+    """Test multi-way merging against brute force."""
+    self.assertEqual(Interval.mergeAll([]), (Interval(), Interval()))
+    a = Interval.fromAtoms([(0, 5), (10, 5)])
+    self.assertEqual(Interval.mergeAll([a]), (a, Interval()))
+    self.assertEqual(Interval.mergeAll([a, a]), (a, a))
+    self.assertEqual(Interval.mergeAll([a, Interval.fromAtom(5, 5)]),
+                     (Interval.fromAtom(0, 15), Interval()))
+
+    rng = random.Random(0)
+    for trial in range(200):
+      ivals = [_random_interval(rng) for i in range(rng.randrange(1, 6))]
+      union, overlap = Interval.mergeAll(ivals)
+      counts = collections.Counter()
+      for ival in ivals:
+        counts.update(_points(ival))
+      self.assertEqual(union, _from_points(counts))
+      self.assertEqual(union, reduce(lambda a, b: a.union(b, True), ivals))
+      self.assertEqual(overlap,
+                       _from_points(i for (i, n) in counts.iteritems() if n > 1))
+
+  def test_unionUpdate(self):
+    """Test in-place union against brute force, for both small and large
+       arguments."""
+    rng = random.Random(1)
+    for trial in range(200):
+      a = _random_interval(rng, 200)
+      b = _from_points(_points(a) ^ set(xrange(200)))
+      b = _from_points(i for i in _points(b) if rng.random() < 0.3)
+      expected = _from_points(_points(a) | _points(b))
+      c = a.copy()
+      c.unionUpdate(b)
+      self.assertEqual(c, expected)
+      self.assertEqual(len(c), len(expected))
+      self.assertEqual(a.union(b), expected)
+      self.assertEqual(b.union(a), expected)
+
+      c = b.copy()
+      c.unionUpdate(_random_interval(rng, 200), allow_overlap=True)
+      c._checkInvariant()
+
+  def test_unionUpdate_overlap(self):
+    """Test that a rejected in-place union leaves the interval untouched."""
+    a = Interval.fromAtoms([(0, 5), (10, 5)])
+    if __debug__:
+      self.assertRaises(AssertionError, a.unionUpdate,
+                        Interval.fromAtoms([(5, 5), (14, 1)]))
+    self.assertEqual(a, Interval.fromAtoms([(0, 5), (10, 5)]))
+    a.unionUpdate(Interval.fromAtoms([(5, 5), (15, 1)]))
+    self.assertEqual(a, Interval.fromAtom(0, 16))
+
+  def test_pickle(self):
+    """Test pickling, including of intervals pickled as tuples of extents."""
+    a = Interval.fromAtoms([(0, 5), (10, 5)])
+    self.assertEqual(cPickle.loads(cPickle.dumps(a, 2)), a)
+    legacy = Interval.__new__(Interval)
+    legacy.__setstate__({"_size": 10, "_extents": ((0, 5), (10, 5))})
+    self.assertEqual(legacy, a)
+    self.assertEqual(len(legacy), 10)
+
+  def test_algebra(self):
+    """Test intersection, difference and friends against brute force."""
+    rng = random.Random(2)
+    for trial in range(300):
+      # Vary fragmentation so both the bisecting and walking paths run.
+      a = _random_interval(rng, rng.choice([10, 60, 200]))
+      b = _random_interval(rng, rng.choice([10, 60, 200]))
+      pa, pb = _points(a), _points(b)
+      self.assertEqual(a.intersection(b), _from_points(pa & pb))
+      self.assertEqual(a.difference(b), _from_points(pa - pb))
+      self.assertEqual(a.symmetricDifference(b), _from_points(pa ^ pb))
+      self.assertEqual(a.overlaps(b), bool(pa & pb))
+      self.assertEqual(b.overlaps(a), bool(pa & pb))
+      for point in (-1, 0, 5, 59, 60, 199, 200):
+        self.assertEqual(a.contains(point), point in pa)
+      start = rng.randrange(-5, 205)
+      end = rng.randrange(-5, 205)
+      self.assertEqual(a.slice(start, end),
+                       _from_points(i for i in pa if start <= i < end))
+
+  def test_algebra_empty(self):
+    """Test set operations involving empty intervals."""
+    a = Interval.fromAtoms([(0, 5), (10, 5)])
+    empty = Interval()
+    self.assertEqual(a.intersection(empty), empty)
+    self.assertEqual(a.difference(empty), a)
+    self.assertEqual(empty.difference(a), empty)
+    self.assertEqual(a.symmetricDifference(empty), a)
+    self.assertFalse(a.overlaps(empty))
+    self.assertFalse(empty.contains(0))
+    self.assertEqual(a.slice(3, 12), Interval.fromAtoms([(3, 2), (10, 2)]))
+    self.assertEqual(a.slice(5, 10), empty)
+
+class test_ExtentSet(unittest.TestCase):
+  klass = ExtentSet
+
+  def setUp(self):
+    # Use tiny chunks so that splitting and merging across chunks is tested.
+    self.load = interval._CHUNK_LOAD
+    interval._CHUNK_LOAD = 2
+
+  def tearDown(self):
+    interval._CHUNK_LOAD = self.load
+
+  def test_add(self):
+    """Test adding random extents against brute force."""
+    rng = random.Random(3)
+    for trial in range(100):
+      extents = self.klass()
+      points = set()
+      for i in range(rng.randrange(1, 40)):
+        start = rng.randrange(200)
+        length = rng.randrange(1, 10)
+        new = set(xrange(start, start + length))
+        if new & points:
+          if __debug__:
+            self.assertRaises(AssertionError, extents.add, start, length)
+          extents.add(start, length, allow_overlap=True)
+        else:
+          extents.add(start, length)
+        points |= new
+        extents._checkInvariant()
+        self.assertEqual(extents.countExtents(), len(_from_points(points)
+                                                     .toAtoms()))
+        self.assertEqual(extents.toInterval(), _from_points(points))
+        self.assertEqual(len(extents), len(points))
+
+  def test_update(self):
+    """Test adding intervals and querying for overlap and free space."""
+    rng = random.Random(4)
+    for trial in range(100):
+      a = _random_interval(rng, 100)
+      b = _random_interval(rng, 100).difference(a)
+      extents = self.klass.fromInterval(a)
+      self.assertEqual(extents, self.klass.fromAtoms(a.toAtoms()))
+      self.assertEqual(extents.overlaps(b), False)
+      self.assertEqual(extents.overlaps(a), len(a) > 0)
+      extents.update(b)
+      self.assertEqual(extents.toInterval(), a.union(b))
+      self.assertEqual(list(extents.iterExterior(120)),
+                       list(a.union(b).iterExterior(120)))
+
+      free = extents.findFree(10, 120)
+      gaps = sorted(set(xrange(120)) - _points(a) - _points(b))
+      self.assertEqual(free, _from_points(gaps[:10]))
+
+  def test_pickle(self):
+    """Test that sets pickle as their encoded atoms, and load from plain
+       atoms."""
+    atoms = ((0, 5), (10, 5), (20, 1), (30, 2))
+    extents = ExtentSet.fromAtoms(atoms)
+    self.assertEqual(extents.__getstate__(),
+                     {"encoded": encoding.encodeAtoms(atoms)})
+    self.assertEqual(cPickle.loads(cPickle.dumps(extents, 2)), extents)
+    legacy = ExtentSet.__new__(ExtentSet)
+    legacy.__setstate__({"atoms": atoms})
+    self.assertEqual(legacy, extents)
+
+class test_ExtentBitmap(test_ExtentSet):
+  klass = ExtentBitmap
+
+  def setUp(self):
+    # Use tiny containers so that runs crossing containers are tested.
+    self.size = interval._CONTAINER_SIZE, interval._FULL
+    interval._CONTAINER_SIZE = 8
+    interval._FULL = 0xff
+
+  def tearDown(self):
+    interval._CONTAINER_SIZE, interval._FULL = self.size
+
+  def test_pickle(self):
+    """Test that bitmaps pickle."""
+    extents = ExtentBitmap.fromAtoms([(0, 5), (7, 10), (20, 1)])
+    self.assertEqual(cPickle.loads(cPickle.dumps(extents, 2)), extents)
+    self.assertEqual(len(cPickle.loads(cPickle.dumps(extents, 2))), 16)
+
+  def test_cursor(self):
+    """Test free space is searched for from the first container that is not
+       full."""
+    extents = ExtentBitmap.fromAtoms([(0, 20), (22, 2)])
+    self.assertEqual(extents._cursor, 2)
+    self.assertEqual(cPickle.loads(cPickle.dumps(extents, 2))._cursor, 2)
+    self.assertEqual(extents.findFree(4, 100),
+                     Interval.fromAtoms([(20, 2), (24, 2)]))
+    self.assertEqual(extents.findFree(4, 21), Interval.fromAtoms([(20, 1)]))
+    extents.add(20, 2)
+    self.assertEqual(extents._cursor, 3)
+    self.assertEqual(extents.findFree(100, 30), Interval.fromAtoms([(24, 6)]))
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,4 +1,5 @@
 import itertools
+import json
 import sys
 import unittest
 
@@ -46,7 +47,19 @@ class Simple(object):
     if self._has_number:
       self._number = val
 
+class Cheap(Simple):
+  """Simple with a cheap check of only part of its invariant."""
+  __metaclass__ = justthisonce.invariant.EnforceInvariant
+
+  def _checkCheapInvariant(self):
+    assert self._has_number == True
+
 class test_Invariant(unittest.TestCase):
+  def tearDown(self):
+    justthisonce.invariant.reset()
+    justthisonce.invariant.enableProfiling(False)
+    justthisonce.invariant.resetProfile()
+
   def test_invariant(self):
     # Invariants must hold after ctor
     a = Simple(2)
@@ -83,6 +96,108 @@ class test_Invariant(unittest.TestCase):
     a.number
     b.getNum()
 
+  def test_levels(self):
+    """Tests that checks can be turned down per class."""
+    invariant = justthisonce.invariant
+    a = Simple(2)
+    c = Cheap(2)
+    a._number = c._number = 5
+    invariant.setLevel(invariant.OFF, Simple)
+    a.getNum()
+    # Settings apply to subclasses.
+    c.getNum()
+
+    # Cheap checks skip the expensive part, or everything if there is none.
+    invariant.setLevel("cheap")
+    c.getNum()
+    invariant.setLevel("cheap", "Simple")
+    a.getNum()
+    with self.assertRaises(AssertionError): del c.number
+    self.assertRaises(AssertionError, c.getNum)
+
+    invariant.setLevel(invariant.FULL, Simple)
+    self.assertRaises(AssertionError, a.getNum)
+    self.assertRaises(invariant.BadSetting, invariant.setLevel, "bogus")
+
+  def test_sampling(self):
+    """Tests that sampled checks run once every N calls."""
+    invariant = justthisonce.invariant
+    invariant.setSampling(3, Simple)
+    a = Simple(2)
+    a._number = 5
+    failures = 0
+    for i in range(9):
+      try:
+        a.getNum()
+      except AssertionError:
+        failures += 1
+    self.assertEqual(failures, 3)
+    self.assertRaises(invariant.BadSetting, invariant.setSampling, 0)
+
+    # Classes may ask to be sampled unless they are set otherwise.
+    class Sampled(Simple):
+      _invariantSampling = 4
+    invariant.reset()
+    b = Sampled(2)
+    b._number = 5
+    failures = 0
+    for i in range(8):
+      try:
+        b.getNum()
+      except AssertionError:
+        failures += 1
+    self.assertEqual(failures, 2)
+    invariant.setSampling(1, Sampled)
+    self.assertRaises(AssertionError, b.getNum)
+
+  def test_configure(self):
+    """Tests the environment variable format."""
+    invariant = justthisonce.invariant
+    invariant.configure("cheap:10, Simple=off")
+    self.assertEqual(invariant._lookup(invariant._levels, Cheap),
+                     invariant.OFF)
+    self.assertEqual(invariant._lookup(invariant._sampling, Cheap), 10)
+    self.assertEqual(invariant._lookup(invariant._levels, int),
+                     invariant.CHEAP)
+    self.assertRaises(invariant.BadSetting, invariant.configure, "full:x")
+
+  def test_profile(self):
+    """Tests that calls are counted and timed when profiling."""
+    invariant = justthisonce.invariant
+    Simple(2).getNum()
+    self.assertEqual(invariant.profile(), {})
+
+    invariant.enableProfiling()
+    a = Simple(2)
+    c = Cheap(4)
+    for i in range(3):
+      a.getNum()
+    a.number = 6
+    c.getNum()
+    a._number = 5
+    self.assertRaises(AssertionError, a.setNum, 4)
+
+    # Inherited methods are credited to the class of the object.
+    stats = invariant.profile()
+    self.assertEqual(sorted(stats), ["Cheap.__init__", "Cheap.getNum",
+                                     "Simple.__init__", "Simple.getNum",
+                                     "Simple.number", "Simple.setNum"])
+    self.assertEqual(stats["Simple.__init__"]["calls"], 1)
+    self.assertEqual(stats["Cheap.__init__"]["calls"], 1)
+    self.assertEqual(stats["Simple.getNum"]["calls"], 3)
+    self.assertEqual(stats["Cheap.getNum"]["calls"], 1)
+    self.assertEqual(stats["Simple.setNum"]["calls"], 1)
+    for entry in stats.itervalues():
+      self.assertTrue(0 <= entry["invariant"] <= entry["total"])
+      self.assertTrue(entry["max"] <= entry["total"])
+
+    self.assertEqual(json.loads(invariant.profileJSON()), stats)
+    table = invariant.profileTable().splitlines()
+    self.assertEqual(len(table), 7)
+
+    invariant.resetProfile()
+    self.assertEqual(invariant.profile(), {})
+
 if __name__ == '__main__':
   unittest.main()
 
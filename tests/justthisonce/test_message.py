@@ -0,0 +1,266 @@
+import cStringIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from justthisonce.interval import Interval
+from justthisonce.message import *
+from justthisonce import integrity
+from justthisonce import pad
+
+class test_Message(unittest.TestCase):
+  def test_roundtrip(self):
+    """Tests messages survive serialization, in either allocation format."""
+    a = pad.File("a", 1000, "current")
+    alloc = pad.Allocation(a, Interval.fromAtoms([(i * 10, 3)
+                                                  for i in range(50)]))
+    for compress in (False, True):
+      text = Message(alloc, 150).toJSON(compress)
+      # Older messages hold the allocation as JSON lists.
+      data = json.loads(text.split("\n", 1)[1])
+      self.assertEqual(data["compatibility"], COMPATIBILITY)
+      data["allocation"] = list(alloc.toSerializationState())
+      data["compatibility"] = 0
+      legacy = json.dumps(data)
+      self.assertTrue(len(text) < len(legacy))
+      for source in (text, "%i\n%s" % (len(legacy), legacy)):
+        message = Message.fromJSON(source, {"a": a}.get)
+        self.assertEqual(message.allocation, alloc)
+        self.assertEqual(message.length, 150)
+
+      # Readers reject messages in formats newer than they know.
+      data["compatibility"] = COMPATIBILITY + 1
+      future = json.dumps(data)
+      self.assertRaises(FutureMessageFormat, Message.fromJSON,
+                        "%i\n%s" % (len(future), future))
+
+  def test_tree(self):
+    """Tests the hash tree is parsed once and replaced when set."""
+    a = pad.File("a", 1000, "current")
+    message = Message(pad.Allocation(a, Interval.fromAtom(0, 10)), 10)
+    self.assertEqual(message.tree, None)
+    message.tree = integrity.HashTree(10, [integrity.hashChunk("x" * 10)])
+    message = Message.fromJSON(message.toJSON(), {"a": a}.get)
+    tree = message.tree
+    self.assertEqual(tree.length, 10)
+    self.assertTrue(message.tree is tree)
+    message.tree = integrity.HashTree(5, [integrity.hashChunk("y" * 5)])
+    self.assertEqual(message.tree.length, 5)
+    message.data["tree"] = {}
+    self.assertRaises(BadMessage, getattr, message, "tree")
+
+  def test_lazy(self):
+    """Tests the allocation is only decoded when needed."""
+    a = pad.File("a", 1000, "current")
+    b = pad.File("b", 1000, "current")
+    alloc = pad.Allocation(a, Interval.fromAtoms([(0, 5), (10, 5)])).union(
+        pad.Allocation(b, Interval.fromAtom(50, 1)))
+    text = Message(alloc, 11).toJSON()
+    message = Message.fromJSON(text, {"a": a, "b": b}.get)
+    self.assertEqual(message.length, 11)
+    self.assertEqual(list(message.iterAllocation()),
+                     [("a", 0, 5), ("a", 10, 5), ("b", 50, 1)])
+    self.assertEqual(message.allocation, alloc)
+    self.assertEqual(list(message.iterAllocation()),
+                     [("a", 0, 5), ("a", 10, 5), ("b", 50, 1)])
+
+    # A bad allocation is only noticed when it is used.
+    data = json.loads(text.split("\n", 1)[1])
+    data["allocation"] = data["allocation"][:-4]
+    data = json.dumps(data)
+    message = Message.fromJSON("%i\n%s" % (len(data), data))
+    self.assertEqual(message.length, 11)
+    self.assertRaises(BadMessage, getattr, message, "allocation")
+    self.assertRaises(BadMessage, list, message.iterAllocation())
+
+  def test_container(self):
+    """Tests containers can be read with the header before or after the
+       payload."""
+    a = pad.File("a", 1000, "current")
+    alloc = pad.Allocation(a, Interval.fromAtom(10, 7))
+    header = Message(alloc, 7).toJSON()
+    payload = "payload"
+    for header_first in (True, False):
+      preamble = containerPreamble(len(header), len(payload), header_first)
+      self.assertEqual(len(preamble), PREAMBLE_SIZE)
+      if header_first:
+        data = preamble + header + payload
+      else:
+        data = preamble + payload + header
+      fd = cStringIO.StringIO(data)
+      message, offset, length = readContainer(fd, {"a": a}.get)
+      self.assertEqual(message.allocation, alloc)
+      self.assertEqual((offset, length), (data.index(payload), 7))
+      self.assertEqual(fd.read(length), payload)
+
+    data = containerPreamble(len(header), len(payload)) + header + payload
+    for bad in ("x" + data[1:], data[:10], data[:PREAMBLE_SIZE + 5],
+                containerPreamble(len(header), 6) + header + payload):
+      self.assertRaises(BadMessage, readContainer, cStringIO.StringIO(bad))
+
+    # Containers written in one pass end with their preamble.
+    data = payload + header + containerTrailer(len(header), len(payload))
+    fd = cStringIO.StringIO(data)
+    message, offset, length = readContainer(fd, {"a": a}.get)
+    self.assertEqual((message.allocation, offset, length), (alloc, 0, 7))
+    self.assertEqual(fd.read(length), payload)
+    self.assertRaises(BadMessage, readContainer,
+                      cStringIO.StringIO(data + "x"))
+
+class test_MessageArchive(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.join(tempfile.mkdtemp(), "archive")
+    self.padfile = pad.File("a", 1000, "current")
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self.path))
+
+  def _container(self, start, payload):
+    """Returns a container of a message with the payload."""
+    alloc = pad.Allocation(self.padfile,
+                           Interval.fromAtom(start, len(payload)))
+    header = Message(alloc, len(payload)).toJSON()
+    return cStringIO.StringIO(containerPreamble(len(header), len(payload)) +
+                              header + payload)
+
+  def test_trailer(self):
+    """Tests containers written in one pass can be read back from the middle
+       of a segment."""
+    archive = MessageArchive(self.path)
+    for (i, payload) in enumerate(("first", "second", "third")):
+      alloc = pad.Allocation(self.padfile,
+                             Interval.fromAtom(i * 10, len(payload)))
+      header = Message(alloc, len(payload)).toJSON()
+      archive.append("msg%i" % i, cStringIO.StringIO(
+          payload + header + containerTrailer(len(header), len(payload))))
+    self.assertEqual(len(set(entry.segment for entry in archive.entries())), 1)
+    lookup = {"a": self.padfile}.get
+    self.assertEqual(archive.read("msg0", lookup)[1], "first")
+    message, path, offset = archive.locatePayload("msg1", lookup)
+    self.assertEqual(open(path, "rb").read()[offset:offset + 6], "second")
+    self.assertEqual([payload for (entry, message, payload)
+                      in archive.iterMessages(lookup=lookup)],
+                     ["first", "second", "third"])
+    archive.close()
+
+  def test_archive(self):
+    """Tests messages can be stored, found and read back in bulk."""
+    archive = MessageArchive(self.path, segment_size=1000)
+    ids = ["msg%03i" % i for i in range(20)]
+    for (i, message_id) in enumerate(reversed(ids)):
+      entry = archive.append(message_id,
+                             self._container(i * 10, "payload%02i" % i))
+      self.assertEqual(entry.summary, (("a", i * 10, 9),))
+    self.assertRaises(DuplicateMessage, archive.append, ids[0],
+                      self._container(0, "x"))
+    self.assertTrue(len(os.listdir(self.path)) > 3)
+
+    self.assertEqual(len(archive), 20)
+    self.assertTrue("msg005" in archive)
+    self.assertFalse("msg100" in archive)
+    self.assertRaises(KeyError, archive.lookup, "msg100")
+    self.assertEqual([entry.id for entry in archive.entries("msg005",
+                                                            "msg008")],
+                     ["msg005", "msg006", "msg007"])
+    message, payload = archive.read("msg019")
+    self.assertEqual(payload, "payload00")
+    self.assertEqual(message.length, 9)
+    message, path, offset = archive.locatePayload("msg019")
+    with open(path, "rb") as fd:
+      fd.seek(offset)
+      self.assertEqual(fd.read(message.length), "payload00")
+
+    batch = list(archive.iterMessages(["msg001", "msg018"]))
+    self.assertEqual([payload for (entry, message, payload) in batch],
+                     ["payload01", "payload18"])
+    stored = list(archive.iterMessages())
+    self.assertEqual(sorted(payload for (entry, message, payload) in stored),
+                     ["payload%02i" % i for i in range(20)])
+
+    # Unflushed appends survive in the journal, and flushed ones in the index.
+    archive._journal.close()
+    for i in range(2):
+      archive = MessageArchive(self.path, segment_size=1000)
+      self.assertEqual(archive.lookup("msg003"),
+                       MessageArchive(self.path).lookup("msg003"))
+      self.assertEqual(len(archive), 20 + i)
+      archive.append("new%i" % i, self._container(500 + i, "x"))
+      archive.close()
+    self.assertEqual(len(MessageArchive(self.path)), 22)
+
+  def test_entry_length(self):
+    """Tests entries record the size of the whole container."""
+    archive = MessageArchive(self.path)
+    alloc = pad.Allocation(self.padfile,
+                           Interval.fromAtoms([(0, 100), (200, 50)]))
+    header = Message(alloc, 150).toJSON()
+    container = cStringIO.StringIO(containerPreamble(len(header), 150) +
+                                   header + "x" * 150)
+    entry = archive.append("m", container)
+    self.assertEqual(entry.length, len(container.getvalue()))
+    self.assertEqual(entry.summary, (("a", 0, 250),))
+    archive.close()
+    self.assertEqual(MessageArchive(self.path).lookup("m"), entry)
+
+  def test_torn_journal(self):
+    """Tests appends after a crash mid-append follow the last good entry."""
+    archive = MessageArchive(self.path)
+    archive.append("m1", self._container(0, "one"))
+    archive._journal.write("\x05ab")
+    archive._journal.close()
+    archive = MessageArchive(self.path)
+    self.assertEqual(len(archive), 1)
+    archive.append("m2", self._container(10, "two"))
+    archive._journal.close()
+    archive = MessageArchive(self.path)
+    self.assertEqual([entry.id for entry in archive.entries()], ["m1", "m2"])
+    self.assertEqual(archive.read("m2")[1], "two")
+
+class test_Notification(unittest.TestCase):
+  def test_roundtrip(self):
+    """Tests notifications survive serialization."""
+    extents = {"foo": Interval.fromAtoms([(0, 5), (10, 2 ** 40)]),
+               "bar": Interval.fromAtom(7, 1),
+               "empty": Interval()}
+    for incremental in (True, False):
+      text = Notification(extents, incremental).toJSON()
+      for source in (text, cStringIO.StringIO(text + "trailing")):
+        notification = Notification.fromJSON(source)
+        self.assertEqual(notification.incremental, incremental)
+        self.assertEqual(sorted(notification.extents), ["bar", "foo"])
+        for filename in ("foo", "bar"):
+          self.assertEqual(notification.extents[filename], extents[filename])
+
+  def test_bad(self):
+    """Tests malformed notifications are rejected."""
+    self.assertRaises(BadMessage, Notification.fromJSON, "garbage")
+    self.assertRaises(BadMessage, Notification.fromJSON, "2\n{}")
+    text = Notification({"foo": Interval.fromAtom(0, 5)}).toJSON()
+    self.assertRaises(BadMessage, Notification.fromJSON,
+                      text.replace('"foo", "', '"foo", "A'))
+    future = text.replace('"compatibility": %i' % COMPATIBILITY,
+                          '"compatibility": %i' % (COMPATIBILITY + 1))
+    self.assertNotEqual(future, text)
+    self.assertRaises(FutureMessageFormat, Notification.fromJSON, future)
+
+  def test_read(self):
+    """Tests messages can be read as notifications."""
+    a = pad.File("a", 100, "current")
+    b = pad.File("b", 100, "current")
+    alloc = pad.Allocation(a, Interval.fromAtoms([(0, 5), (10, 5)])).union(
+        pad.Allocation(b, Interval.fromAtom(50, 1)))
+    notification = Notification.read(Message(alloc, 11).toJSON())
+    self.assertEqual(notification.extents,
+                     {"a": Interval.fromAtoms([(0, 5), (10, 5)]),
+                      "b": Interval.fromAtom(50, 1)})
+
+    text = Notification({"a": Interval.fromAtom(3, 4)}).toJSON()
+    self.assertEqual(Notification.read(text).extents,
+                     {"a": Interval.fromAtom(3, 4)})
+    self.assertRaises(BadMessage, Notification.read,
+                      '23\n{"allocation": [["a"]]}')
+
+if __name__ == '__main__':
+  unittest.main()
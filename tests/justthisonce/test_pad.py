@@ -1,6 +1,7 @@
 import itertools
 import mock
 import shutil
+import stat
 import sys
 import tempfile
 import unittest
@@ -9,6 +10,7 @@ from cStringIO import StringIO
 import cPickle as pickle
 
 from justthisonce.pad import *
+from justthisonce import atfile
 
 def sideEffect(**kw):
   """Returns a side effect function for mocks. Will return K:V for given. As a
@@ -93,6 +95,39 @@ class test_File(unittest.TestCase):
                                                     fi, 5))
     self.assertEqual(fi.free, 0)
 
+  def test_pickle(self):
+    """Tests that files pickle, including those pickled with Interval
+       extents."""
+    fi = File("myfile", 50, "current")
+    fi.commitAllocation(Interval.fromAtoms([(0, 5), (10, 5)]))
+    fi2 = pickle.loads(pickle.dumps(fi, 2))
+    self.assertEqual(fi2.extents, fi.extents)
+    self.assertEqual(fi2.free, 40)
+
+    legacy = File.__new__(File)
+    legacy.__setstate__({"size": 50, "used": 10, "filename": "myfile",
+                         "subdir": "current",
+                         "_extents": Interval.fromAtoms([(0, 5), (10, 5)])})
+    self.assertEqual(legacy.extents, fi.extents)
+    legacy.commitAllocation(legacy.getAllocation(5).iterFiles().next()[0])
+    self.assertEqual(legacy.extents, Interval.fromAtoms([(0, 15)]))
+
+  def test_bitmap(self):
+    """Tests that heavily fragmented files switch to a bitmap."""
+    fi = File("myfile", 4096, "current")
+    for i in range(0, 4096, 4):
+      fi.commitAllocation(Interval.fromAtom(i, 1))
+      self.assertEqual(type(fi._extents) is ExtentBitmap,
+                       i // 4 + 1 >= BITMAP_MIN_EXTENTS)
+    self.assertEqual(fi.used, 1024)
+    self.assertEqual(fi.extents,
+                     Interval.fromAtoms((i, 1) for i in range(0, 4096, 4)))
+    alloc = fi.getAllocation(6)
+    self.assertEqual(list(alloc.iterFiles())[0][0],
+                     Interval.fromAtoms([(1, 3), (5, 3)]))
+    fi.mergeExtents(Interval.fromAtom(0, 4096))
+    self.assertEqual(fi.free, 0)
+
 class test_Allocation(unittest.TestCase):
   def setUp(self):
     self._next_uuid = 0
@@ -227,6 +262,77 @@ class test_Allocation(unittest.TestCase):
     self.assertEqual(len(b), 64)
     self.assertEqual(len(a), 64)
 
+  def test_locate(self):
+    """Tests mapping payload ranges to the pad against brute force."""
+    a = File("a", 100, "current")
+    b = File("b", 100, "current")
+    alloc = Allocation(a, Interval.fromAtoms([(10, 5), (20, 3)])).union(
+        Allocation(b, Interval.fromAtoms([(0, 2), (50, 10)])))
+    # The pad byte behind each payload byte.
+    key = [(padfile, i) for (ival, padfile) in alloc.iterFiles()
+           for (start, length) in ival.iterInterior()
+           for i in xrange(start, start + length)]
+    for offset in xrange(len(alloc) + 1):
+      for length in xrange(len(alloc) - offset + 1):
+        segments = alloc.locate(offset, length)
+        self.assertEqual(sum(count for (padfile, start, count) in segments),
+                         length)
+        self.assertEqual([(padfile, i) for (padfile, start, count) in segments
+                          for i in xrange(start, start + count)],
+                         key[offset:offset + length])
+    self.assertRaises(AssertionError, alloc.locate, 19, 2)
+
+    alloc.unionUpdate(Allocation(a, Interval.fromAtom(0, 1)))
+    self.assertEqual(alloc.locate(0, 2), [(a, 0, 1), (a, 10, 1)])
+
+    # Slices of consecutive ranges add up to the whole.
+    pieces = [alloc.slice(offset, length) for (offset, length)
+              in ((0, 3), (3, 0), (3, 17), (20, 1))]
+    self.assertEqual([len(piece) for piece in pieces], [3, 0, 17, 1])
+    self.assertEqual(pieces[0], Allocation(a, Interval.fromAtoms([(0, 1),
+                                                                  (10, 2)])))
+    self.assertEqual(reduce(Allocation.union, pieces), alloc)
+
+  def test_builder(self):
+    """Tests that building an allocation matches a chain of unions."""
+    a = File("a", 100, "current")
+    b = File("b", 100, "current")
+    pieces = [(a, (10, 5)), (b, (0, 5)), (a, (0, 10)), (b, (50, 1)),
+              (a, (20, 5))]
+    builder = AllocationBuilder()
+    expected = Allocation()
+    for (padfile, (start, length)) in pieces:
+      builder.addAtoms(padfile, [(start, length)])
+      expected.unionUpdate(Allocation(padfile, Interval.fromAtom(start,
+                                                                 length)))
+    alloc = builder.build()
+    self.assertEqual(alloc, expected)
+    self.assertEqual([padfile for (ival, padfile) in alloc.iterFiles()],
+                     [a, b])
+    self.assertEqual(list(alloc.iterFiles())[0][0],
+                     Interval.fromAtoms([(0, 15), (20, 5)]))
+
+    builder = AllocationBuilder()
+    builder.addAllocation(alloc)
+    builder.addInterval(b, Interval.fromAtom(60, 1))
+    self.assertEqual(len(builder.build()), len(alloc) + 1)
+
+    builder.addAtoms(b, [(0, 1)])
+    self.assertRaises(AssertionError, builder.build)
+
+  def test_fromSerializationState(self):
+    """Tests resolving filenames when deserializing."""
+    a = File("a", 100, "current")
+    alloc = Allocation(a, Interval.fromAtoms([(0, 5), (10, 5)]))
+    state = list(alloc.toSerializationState())
+    self.assertEqual(Allocation.fromSerializationState(state, {"a": a}.get),
+                     alloc)
+
+    (ival, detached), = Allocation.fromSerializationState(state).iterFiles()
+    self.assertEqual(ival, Interval.fromAtoms([(0, 5), (10, 5)]))
+    self.assertEqual((detached.filename, detached.size, detached.subdir),
+                     ("a", 15, None))
+
 class test_Filesystem(unittest.TestCase):
   def test_sanity(self):
     """Simple sanity checks."""
@@ -366,6 +472,334 @@ class test_Filesystem(unittest.TestCase):
     self.assertRaises(AssertionError, self.fs.open, ("current", "food"), 'w')
     self.assertEqual(self.fs.open(("current", "foo")).read(), "Hello")
 
+@unittest.skipUnless(atfile.AVAILABLE, "No *at syscalls.")
+class test_DirfdFilesystem(test_Filesystem):
+  """Runs the Filesystem tests against DirfdFilesystem, plus its own."""
+  def setUp(self):
+    test_Filesystem.setUp(self)
+    self.fs = DirfdFilesystem(self.fsdir)
+
+  def tearDown(self):
+    self.fs.close()
+    test_Filesystem.tearDown(self)
+
+  def test_sanity(self):
+    """Simple sanity checks."""
+    self.assertRaises(AssertionError, DirfdFilesystem, "/")
+    self.assertRaises(AssertionError, DirfdFilesystem, "/tmp/..")
+
+  def test_traversal(self):
+    """Tests paths outside the root are rejected."""
+    for path in ("/", "..", ("..", "etc"), "../etc/shadow", "/etc/shadow",
+                 ("/", "etc", "shadow"), u"/etc/shadow", ("a", "../../b"),
+                 self.fsdir + "x"):
+      self.assertRaises(AssertionError, self.fs.exists, path)
+      self.assertRaises(AssertionError, self.fs.open, path)
+    self.assertEqual(self.fs.realpath(("a", "..", "b")),
+                     os.path.join(self.fsdir, "b"))
+
+  def test_component_cache(self):
+    """Tests the cache of validated paths is bounded."""
+    with mock.patch("justthisonce.pad.COMPONENT_CACHE_SIZE", 2):
+      for name in ("a", "b", "c", "b"):
+        self.fs.exists(name)
+    self.assertEqual(self.fs._components.keys(), ["c", "b"])
+
+  def test_universal_newlines(self):
+    """Tests "U" modes open for reading."""
+    self._populate()
+    self.assertEqual(self.fs.open(("current", "cpad"), "U").read(),
+                     open(os.path.join(self.fsdir, "current", "cpad")).read())
+
+  def test_symlinks(self):
+    """Tests symlinks are never followed."""
+    self._populate()
+    target = tempfile.mkdtemp()
+    try:
+      open(os.path.join(target, "secret"), 'w').write("secret")
+      os.symlink(target, os.path.join(self.fsdir, "link"))
+      os.symlink(os.path.join(target, "secret"),
+                 os.path.join(self.fsdir, "current", "secret"))
+      self.assertRaises(IOError, self.fs.open, ("link", "secret"))
+      self.assertRaises(IOError, self.fs.open, ("current", "secret"))
+      self.assertRaises(OSError, self.fs.listdir, "link")
+      self.assertFalse(self.fs.exists(("link", "secret")))
+      self.assertTrue(self.fs.exists(("current", "secret")))
+      self.assertTrue(stat.S_ISLNK(self.fs.stat(("current", "secret")).st_mode))
+    finally:
+      shutil.rmtree(target)
+
+  def test_held_directories(self):
+    """Tests operations keep using the directories they opened."""
+    self._populate()
+    self.assertEqual(self.fs.listdir("current"), ["cpad"])
+    os.rename(os.path.join(self.fsdir, "current"),
+              os.path.join(self.fsdir, "moved"))
+    os.mkdir(os.path.join(self.fsdir, "current"))
+    self.assertEqual(self.fs.listdir("current"), ["cpad"])
+    self.fs.close()
+    self.assertEqual(self.fs.listdir("current"), [])
+
+class test_StripedFilesystem(unittest.TestCase):
+  def setUp(self):
+    """Creates an empty filesystem over three roots."""
+    self.fsdirs = [tempfile.mkdtemp() for i in range(3)]
+    self.fs = StripedFilesystem(self.fsdirs)
+
+  def tearDown(self):
+    """Cleans up the generated files."""
+    for fsdir in self.fsdirs:
+      assert fsdir.startswith(tempfile.gettempdir())
+      shutil.rmtree(fsdir)
+
+  def test_dirs(self):
+    """Tests the pad dir and subdirs exist on every root."""
+    self.assertTrue(self.fs.exists("."))
+    self.assertFalse(self.fs.exists("current"))
+    os.mkdir(os.path.join(self.fsdirs[1], "current"))
+    self.assertFalse(self.fs.exists("current"))
+    self.fs.mkdir("current")
+    self.assertTrue(self.fs.exists("current"))
+    for fsdir in self.fsdirs:
+      self.assertTrue(os.path.isdir(os.path.join(fsdir, "current")))
+
+  def test_padfiles(self):
+    """Tests padfiles are found on whichever root holds them."""
+    for subdir in SUBDIRS:
+      self.fs.mkdir(subdir)
+    for (i, fsdir) in enumerate(self.fsdirs):
+      open(os.path.join(fsdir, "incoming", "pad%i" % i), 'w').write("x" * i)
+
+    self.assertEqual(sorted(self.fs.listdir("incoming")),
+                     ["pad0", "pad1", "pad2"])
+    for i in range(3):
+      path = ("incoming", "pad%i" % i)
+      self.assertTrue(self.fs.exists(path))
+      self.assertEqual(self.fs.stat(path).st_size, i)
+      self.assertEqual(self.fs.device(path), i)
+      self.assertEqual(self.fs.open(path).read(), "x" * i)
+      self.assertEqual(self.fs.realpath(path),
+                       os.path.join(self.fsdirs[i], "incoming", "pad%i" % i))
+
+    # Padfiles stay on their root when moved between subdirs.
+    self.fs.rename(("incoming", "pad2"), ("current", "pad2"))
+    self.assertFalse(self.fs.exists(("incoming", "pad2")))
+    self.assertTrue(os.path.exists(os.path.join(self.fsdirs[2], "current",
+                                                "pad2")))
+    self.assertEqual(self.fs.device(("current", "pad2")), 2)
+
+    # Metadata lives on the primary.
+    self.fs.open("VERSION", 'w').write("0\n0")
+    self.assertTrue(os.path.exists(os.path.join(self.fsdirs[0], "VERSION")))
+    self.assertFalse(self.fs.exists(("current", "VERSION")))
+
+    self.fs.setReadonly()
+    self.assertRaises(AssertionError, self.fs.rename, ("current", "pad2"),
+                      ("spent", "pad2"))
+    self.assertRaises(AssertionError, self.fs.open, ("current", "pad3"), 'w')
+
+  def test_striped_allocation(self):
+    """Tests large allocations are spread evenly over the devices."""
+    Pad.createPad(self.fs)
+    sizes = (100, 300, 1000)
+    for (i, fsdir) in enumerate(self.fsdirs):
+      open(os.path.join(fsdir, "incoming", "pad%i" % i), 'w').write(
+          "x" * sizes[i])
+    pad = Pad(self.fs)
+
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 200):
+      # Small allocations come from the smallest padfile.
+      alloc = pad.getAllocation(50)
+      self.assertEqual([padfile.filename for (_, padfile) in alloc.iterFiles()],
+                       ["pad0"])
+      pad.discardUncommitted()
+
+      # The smallest device can only take what it has; the rest is even.
+      alloc = pad.getAllocation(650)
+      self.assertEqual(dict((padfile.filename, len(ival))
+                            for (ival, padfile) in alloc.iterFiles()),
+                       {"pad0": 100, "pad1": 275, "pad2": 275})
+      pad.commitAllocation(alloc)
+
+    # Committing moved the padfiles within their roots, spending pad0.
+    self.assertTrue(os.path.exists(os.path.join(self.fsdirs[0], "spent",
+                                                "pad0")))
+    for i in (1, 2):
+      self.assertTrue(os.path.exists(os.path.join(self.fsdirs[i], "current",
+                                                  "pad%i" % i)))
+    self.assertEqual(sorted(padfile.filename
+                            for padfile in pad.metadata.current),
+                     ["pad1", "pad2"])
+    self.assertRaises(OutOfPad, pad.getAllocation, 751)
+
+  def test_createPad_existing(self):
+    """Tests a pad is not recreated over by adding a root to it."""
+    Pad.createPad(StripedFilesystem(self.fsdirs[:1]))
+    open(os.path.join(self.fsdirs[0], "incoming", "f1"), 'w').write("x" * 200)
+    pad = Pad(StripedFilesystem(self.fsdirs[:1]))
+    pad.commitAllocation(pad.getAllocation(100))
+    used = pad.makeNotification()
+
+    for paths in ([self.fsdirs[0], self.fsdirs[1] + "/new"],
+                  [self.fsdirs[1] + "/new", self.fsdirs[0]],
+                  self.fsdirs[:2]):
+      self.assertRaises(InvalidPad, Pad.createPad, StripedFilesystem(paths))
+    self.assertEqual(Pad(StripedFilesystem(self.fsdirs[:1])).makeNotification(),
+                     used)
+
+class test_PadNotifications(unittest.TestCase):
+  def setUp(self):
+    """Creates two pads (peers) sharing the same padfiles."""
+    self.fsdirs = [tempfile.mkdtemp() for i in range(2)]
+    self.pads = []
+    for fsdir in self.fsdirs:
+      fs = Filesystem(fsdir)
+      Pad.createPad(fs)
+      for (filename, size) in (("a", 10), ("b", 100)):
+        fs.open(("incoming", filename), 'w').write("x" * size)
+      self.pads.append(Pad(fs))
+
+  def tearDown(self):
+    for fsdir in self.fsdirs:
+      assert fsdir.startswith(tempfile.gettempdir())
+      shutil.rmtree(fsdir)
+
+  def _use(self, pad, requested):
+    alloc = pad.getAllocation(requested)
+    pad.commitAllocation(alloc)
+    return alloc
+
+  def test_findPadfile(self):
+    """Tests padfiles can be found wherever they are."""
+    pad = self.pads[0]
+    self.assertEqual(pad.findPadfile("a").path, ("incoming", "a"))
+    self._use(pad, 20)
+    self.assertEqual(pad.findPadfile("b"), pad.metadata.current[0])
+    spent = pad.findPadfile("a")
+    self.assertEqual((spent.path, spent.free), (("spent", "a"), 0))
+    self.assertEqual(pad.findPadfile("c"), None)
+
+    # The lookup of current files is built once per batch of notifications.
+    with mock.patch.object(pad, "_currentByName",
+                           wraps=pad._currentByName) as lookup:
+      self.assertEqual(pad.findPadfile("b", {"b": "found"}), "found")
+      self.assertEqual(lookup.call_count, 0)
+      pad.processNotifications([{"a": Interval.fromAtom(0, 1),
+                                 "b": Interval.fromAtom(0, 1),
+                                 "c": Interval.fromAtom(0, 1)}])
+      self.assertEqual(lookup.call_count, 1)
+
+  def test_incremental(self):
+    """Tests incremental notifications report only use since the sync point."""
+    me, peer = self.pads
+    self.assertEqual(me.makeNotification(incremental=True), {})
+    self._use(me, 15)
+    self.assertEqual(me.makeNotification(incremental=True),
+                     {"a": Interval.fromAtom(0, 10),
+                      "b": Interval.fromAtom(0, 5)})
+    me.markSynced(me.makeNotification(incremental=True))
+    self.assertEqual(me.makeNotification(incremental=True), {})
+    self._use(me, 3)
+    self._use(me, 4)
+    delta = me.makeNotification(incremental=True)
+    self.assertEqual(delta, {"b": Interval.fromAtom(5, 7)})
+
+    # The sync point survives reloading the pad.
+    me = Pad(Filesystem(self.fsdirs[0]))
+    self.assertEqual(me.makeNotification(incremental=True), delta)
+
+    # Full notifications report everything, spent files included.
+    self.assertEqual(me.makeNotification(),
+                     {"a": Interval.fromAtom(0, 10),
+                      "b": Interval.fromAtom(0, 12)})
+
+  def test_release(self):
+    """Tests released pad is free again, and no longer reported, even from
+       a padfile that had been spent."""
+    me = self.pads[0]
+    alloc = self._use(me, 30)
+    self.assertEqual(me.findPadfile("a").subdir, "spent")
+    me.releaseAllocation(alloc.slice(5, 25))
+    self.assertEqual(me.makeNotification(incremental=True),
+                     {"a": Interval.fromAtom(0, 5)})
+    self.assertEqual(sorted((padfile.filename, padfile.free)
+                            for padfile in me.metadata.current),
+                     [("a", 5), ("b", 100)])
+    self.assertTrue(os.path.exists(os.path.join(self.fsdirs[0], "current",
+                                                "a")))
+
+    # It survives reloading, and is handed out again.
+    me = Pad(Filesystem(self.fsdirs[0]))
+    self.assertEqual(len(self._use(me, 105)), 105)
+    self.assertRaises(OutOfPad, me.getAllocation, 1)
+
+  def test_sync_race(self):
+    """Tests use committed between making a notification and marking it
+       synced is reported next time, and does not change the one made."""
+    me = self.pads[0]
+    self._use(me, 100)
+    sent = me.makeNotification(incremental=True)
+    self._use(me, 5)
+    self.assertEqual(sent, {"a": Interval.fromAtom(0, 10),
+                            "b": Interval.fromAtom(0, 90)})
+    me.markSynced(sent)
+    self.assertEqual(me.makeNotification(incremental=True),
+                     {"b": Interval.fromAtom(90, 5)})
+
+    # A full notification covers everything.
+    me.markSynced(me.makeNotification())
+    self.assertEqual(me.makeNotification(incremental=True), {})
+
+  def test_process(self):
+    """Tests a peer's use can be merged, idempotently."""
+    me, peer = self.pads
+    self._use(peer, 2)
+    self._use(me, 15)
+    used = me.makeNotification()
+    self.assertEqual(peer.processNotification(used), [])
+    self.assertEqual(peer.processNotification(used), [])
+    self.assertEqual(peer.makeNotification(), used)
+
+    # The peer's file a is now spent, so it stops using it.
+    alloc = self._use(peer, 5)
+    self.assertEqual([(ival.toAtoms(), padfile.filename)
+                      for (ival, padfile) in alloc.iterFiles()],
+                     [(((5, 5),), "b")])
+
+    # Unknown padfiles are reported, and sizes are checked.
+    self.assertEqual(peer.processNotification({"c": Interval.fromAtom(0, 1)}),
+                     ["c"])
+    self.assertRaises(InvalidPad, peer.processNotification,
+                      {"b": Interval.fromAtom(0, 101)})
+
+    # Use cannot be merged while an allocation is outstanding.
+    peer.getAllocation(1)
+    self.assertRaises(AllocationOutstanding, peer.processNotification, used)
+
+  def test_process_bulk(self):
+    """Tests many notifications are merged at once, reporting overlaps."""
+    me, peer = self.pads
+    self._use(me, 3)
+    notifications = [{"b": Interval.fromAtom(i, 1)} for i in range(50)]
+    notifications.append({"a": Interval.fromAtom(2, 4),
+                          "c": Interval.fromAtom(0, 1)})
+    notifications.append({"b": Interval.fromAtom(40, 20)})
+    unknown, overlaps = me.processNotifications(iter(notifications))
+    self.assertEqual(unknown, ["c"])
+    self.assertEqual(overlaps, {"a": Interval.fromAtom(2, 1),
+                                "b": Interval.fromAtom(40, 10)})
+    self.assertEqual(me.makeNotification(),
+                     {"a": Interval.fromAtom(0, 6),
+                      "b": Interval.fromAtom(0, 60)})
+
+    # A bad notification leaves the pad untouched.
+    self.assertRaises(InvalidPad, me.processNotifications,
+                      [{"b": Interval.fromAtom(70, 1)},
+                       {"a": Interval.fromAtom(20, 1)}])
+    self.assertEqual(me.makeNotification(),
+                     {"a": Interval.fromAtom(0, 6),
+                      "b": Interval.fromAtom(0, 60)})
+
 class test_Pad(unittest.TestCase):
   def setUp(self):
     self.fs = mock.create_autospec(Filesystem)
@@ -404,16 +838,15 @@ class test_Pad(unittest.TestCase):
     # Should work if the dir is empty OR does not exist. Must make if does not
     # exist, must check empty if does.
     fs.exists.return_value = False
-    fs.listdir.side_effect = OSError
+    fs.listdir.return_value = []
     verify_created(fs)
     fs.mkdir.assert_any_call(".")
 
     fs.reset_mock()
     fs.exists.return_value = True
-    fs.listdir.side_effect = None
-    fs.listdir.return_value = []
     verify_created(fs)
     fs.listdir.assert_called_with(".")
+    self.assertFalse(mock.call(".") in fs.mkdir.call_args_list)
 
   def test_createPad_error(self):
     """Tests some failure modes of createPad."""
@@ -0,0 +1,117 @@
+import cStringIO
+import json
+import threading
+import unittest
+
+from justthisonce.progress import *
+
+class Clock(object):
+  """A clock that only moves when told to."""
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+class test_Progress(unittest.TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    self.reports = []
+    self.progress = Progress(1000, [self.reports.append], interval=1.0,
+                             clock=self.clock)
+
+  def test_interval(self):
+    """Tests reports are made at most once per interval, and finish makes a
+       final one."""
+    self.progress.update(100, read=0.25)
+    self.assertEqual(self.reports, [])
+    self.clock.now += 2
+    self.progress.update(300, xor=0.5, write=0.25)
+    self.assertEqual(len(self.reports), 1)
+    report = self.reports[0]
+    self.assertEqual((report.done, report.total, report.elapsed),
+                     (400, 1000, 2.0))
+    self.assertEqual(report.rate, 200.0)
+    self.assertEqual(report.eta, 3.0)
+    self.assertEqual(report.phases, {"read": 0.25, "xor": 0.5,
+                                     "write": 0.25})
+    self.assertFalse(report.finished)
+
+    # The rate is since the last report, the average since the start.
+    self.clock.now += 0.5
+    self.progress.update(100)
+    self.clock.now += 0.5
+    self.progress.update(0)
+    self.assertEqual(len(self.reports), 2)
+    self.assertEqual(self.reports[1].rate, 100.0)
+    self.assertEqual(self.reports[1].average, 500 / 3.0)
+
+    self.progress.finish()
+    self.progress.finish()
+    self.assertEqual(len(self.reports), 3)
+    self.assertTrue(self.reports[2].finished)
+    self.assertEqual(self.progress.report().done, 500)
+
+  def test_unknown_total(self):
+    """Tests there is no ETA without a total."""
+    self.progress.total = None
+    self.clock.now += 1
+    self.progress.update(10)
+    self.assertEqual(self.reports[0].eta, None)
+
+  def test_threads(self):
+    """Tests updates from several threads are all counted."""
+    def work():
+      for i in range(1000):
+        self.progress.update(1, xor=0.001)
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.progress.report().done, 4000)
+    self.assertAlmostEqual(self.progress.report().phases["xor"], 4.0)
+
+class test_reporters(unittest.TestCase):
+  def setUp(self):
+    self.report = Report(3 * 1024 * 1024, 4 * 1024 * 1024, 10.0, 2e6, 3e5,
+                         3.3, {"read": 1.0, "xor": 2.0, "write": 1.0}, False)
+
+  def test_stderr(self):
+    """Tests the terminal line is overwritten in place and ended when the
+       run finishes."""
+    stream = cStringIO.StringIO()
+    reporter = StderrReporter(stream)
+    reporter(self.report)
+    self.assertEqual(stream.getvalue(),
+                     "\r3.0 MiB / 4.0 MiB (75%)  2.0 MB/s, ETA 0:00:03  "
+                     "read 25%, xor 50%, write 25%")
+    self.report.finished = True
+    reporter(self.report)
+    last = stream.getvalue().split("\r")[-1]
+    self.assertTrue(last.endswith("\n"))
+    self.assertEqual(last.rstrip(), "3.0 MiB / 4.0 MiB (75%)  0.3 MB/s in "
+                                    "0:00:10  read 25%, xor 50%, write 25%")
+
+  def test_json(self):
+    """Tests a line of JSON is written per report."""
+    stream = cStringIO.StringIO()
+    reporter = JSONReporter(stream)
+    reporter(self.report)
+    self.report.finished = True
+    reporter(self.report)
+    lines = stream.getvalue().splitlines()
+    self.assertEqual(len(lines), 2)
+    data = json.loads(lines[1])
+    self.assertEqual(data["done"], 3 * 1024 * 1024)
+    self.assertEqual(data["xor"], 2.0)
+    self.assertTrue(data["finished"])
+
+  def test_format(self):
+    self.assertEqual(formatSize(512), "512 B")
+    self.assertEqual(formatSize(1536), "1.5 KiB")
+    self.assertEqual(formatSize(5 * 1024 ** 5), "5120.0 TiB")
+    self.assertEqual(formatDuration(3725.4), "1:02:05")
+
+if __name__ == '__main__':
+  unittest.main()
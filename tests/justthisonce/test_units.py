@@ -0,0 +1,15 @@
+import unittest
+
+from justthisonce.units import parseSize
+
+class test_units(unittest.TestCase):
+  def test_parseSize(self):
+    """Tests sizes with and without suffixes."""
+    self.assertEqual(parseSize("512"), 512)
+    self.assertEqual(parseSize("64k"), 64 * 1024)
+    self.assertEqual(parseSize("10G"), 10 * 1024 ** 3)
+    for bad in ("", "G", "1.5M", "0"):
+      self.assertRaises(Exception, parseSize, bad)
+
+if __name__ == '__main__':
+  unittest.main()
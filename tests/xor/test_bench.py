@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import xor.bench
+
+class test_bench(unittest.TestCase):
+  def setUp(self):
+    self.dirs = [tempfile.mkdtemp() for i in range(2)]
+
+  def tearDown(self):
+    for path in self.dirs:
+      assert path.startswith(tempfile.gettempdir())
+      shutil.rmtree(path)
+
+  def test_benchmark(self):
+    """Tests every case is run and the scratch files are removed."""
+    seen = []
+    document = xor.bench.benchmark(self.dirs, [1000, 5000], [256, 4096],
+                                   [1, 7, 5000], repeat=1,
+                                   engines=["Python", "parallel"],
+                                   progress=seen.append)
+    results = document["results"]
+    self.assertEqual(results, seen)
+    # The parallel engine only varies the buffer without the native engine.
+    buffers = 2 + (2 if xor.bench.ENGINES["parallel"][1] else 1)
+    self.assertEqual(len(results), 2 * 3 * buffers)
+    self.assertEqual(sorted(set(result["fragments"] for result in results)),
+                     [1, 7, 1000, 5000])
+    self.assertTrue(all(result["throughput"] > 0 for result in results))
+    self.assertEqual(document["version"], xor.bench.RESULTS_VERSION)
+    json.dumps(document)
+    for path in self.dirs:
+      self.assertEqual(os.listdir(path), ["current"])
+      self.assertEqual(os.listdir(os.path.join(path, "current")), [])
+
+  def test_compare(self):
+    """Tests regressions are found against a baseline."""
+    def result(engine, throughput):
+      return {"engine": engine, "size": 1, "buffer": None, "fragments": 1,
+              "cache": "warm", "throughput": throughput}
+    baseline = {"version": xor.bench.RESULTS_VERSION,
+                "results": [result("C", 100.0), result("Python", 100.0)]}
+    document = {"results": [result("C", 95.0), result("Python", 50.0),
+                            result("parallel", 10.0)]}
+    regressions = xor.bench.compare(document, baseline, 0.1)
+    self.assertEqual(regressions, [document["results"][1]])
+    self.assertEqual(document["results"][0]["ratio"], 0.95)
+    self.assertNotIn("ratio", document["results"][2])
+    self.assertRaises(xor.bench.BadBaseline, xor.bench.compare, document,
+                      {"version": 0})
+
+  def test_main(self):
+    """Tests the command line saves results and fails on regressions."""
+    output = os.path.join(self.dirs[0], "results.json")
+    args = ["--dir", self.dirs[1], "--sizes", "1K", "--buffers", "1K",
+            "--fragments", "1", "--cache", "warm", "--repeat", "1", "-q"]
+    self.assertEqual(xor.bench.main(args + ["--output", output]), 0)
+    document = json.load(open(output))
+    for result in document["results"]:
+      result["throughput"] *= 100
+    json.dump(document, open(output, "w"))
+    self.assertEqual(xor.bench.main(args + ["--baseline", output,
+                                            "--output", output]), 1)
+
+if __name__ == '__main__':
+  unittest.main()
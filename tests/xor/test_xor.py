@@ -0,0 +1,258 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from justthisonce.pad import Pad, StripedFilesystem
+from justthisonce.progress import Progress
+import xor.xor
+
+class test_xor(unittest.TestCase):
+  def setUp(self):
+    """Creates a pad striped over two roots with one padfile each."""
+    self.fsdirs = [tempfile.mkdtemp() for i in range(2)]
+    self.tmpdir = tempfile.mkdtemp()
+    self.fs = StripedFilesystem(self.fsdirs)
+    Pad.createPad(self.fs)
+    rng = random.Random(0)
+    self.padfiles = {}
+    for (i, fsdir) in enumerate(self.fsdirs):
+      data = "".join(chr(rng.randrange(256)) for j in range(5000))
+      open(os.path.join(fsdir, "incoming", "pad%i" % i), 'w').write(data)
+      self.padfiles["pad%i" % i] = data
+    self.pad = Pad(self.fs)
+
+    self.plaintext = "".join(chr(rng.randrange(256)) for j in range(3000))
+    self.infile = os.path.join(self.tmpdir, "in")
+    open(self.infile, 'w').write(self.plaintext)
+
+  def tearDown(self):
+    for path in self.fsdirs + [self.tmpdir]:
+      assert path.startswith(tempfile.gettempdir())
+      shutil.rmtree(path)
+
+  def _expected(self, alloc):
+    """XORs the plaintext with the allocation the slow way."""
+    key = "".join(self.padfiles[padfile.filename][start:start + length]
+                  for (ival, padfile) in alloc.iterFiles()
+                  for (start, length) in ival.toAtoms())
+    return "".join(chr(ord(a) ^ ord(b)) for (a, b) in zip(self.plaintext, key))
+
+  def test_xorStrings(self):
+    """Tests string xor against the obvious implementation."""
+    self.assertEqual(xor.xor.xorStrings("", ""), "")
+    self.assertEqual(xor.xor.xorStrings("\x00\xff\x0f", "\xff\xff\xf0"),
+                     "\xff\x00\xff")
+    self.assertRaises(AssertionError, xor.xor.xorStrings, "a", "")
+
+  def test_xorAllocation(self):
+    """Tests both ways of xoring a striped allocation agree and append."""
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    self.assertEqual(len(list(alloc.iterFiles())), 2)
+    expected = self._expected(alloc)
+
+    serial = os.path.join(self.tmpdir, "serial")
+    parallel = os.path.join(self.tmpdir, "parallel")
+    open(parallel, 'w').write("header")
+    self.assertEqual(xor.xor.xorAllocation(alloc, self.infile, serial,
+                                           self.fs, impl="Python"),
+                     len(alloc))
+    self.assertEqual(xor.xor.xorAllocationParallel(alloc, self.infile,
+                                                   parallel, self.fs),
+                     len(alloc))
+    self.assertEqual(open(serial).read(), expected)
+    self.assertEqual(open(parallel).read(), "header" + expected)
+
+  @unittest.skipIf(xor.xor._cxor is None, "Native engine not built.")
+  def test_native(self):
+    """Tests the native engine agrees with the Python one, and how it
+       reports errors."""
+    _cxor = xor.xor._cxor
+    self.assertEqual(_cxor.xor_buffers(self.plaintext, bytearray(3000)),
+                     self.plaintext)
+    self.assertRaises(ValueError, _cxor.xor_buffers, "a", "")
+
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    out = os.path.join(self.tmpdir, "out")
+    open(out, 'w').write("header")
+    self.assertEqual(xor.xor.xorAllocation(alloc, self.infile, out, self.fs,
+                                           impl="C"),
+                     len(alloc))
+    self.assertEqual(open(out).read(), "header" + self._expected(alloc))
+
+    # The pad ends before the requested length.
+    with open(self.infile) as inputs:
+      with open(os.path.join(self.fsdirs[0], "incoming", "pad0")) as pad:
+        with open(out, 'w') as output:
+          self.assertRaises(EOFError, _cxor.xor_fds, inputs.fileno(),
+                            pad.fileno(), output.fileno(), 4000, 2000)
+          self.assertRaises(xor.xor.CXORError, xor.xor._xorNative,
+                            inputs.fileno(), pad.fileno(), output.fileno(),
+                            4000, 2000, 0, 0, None)
+
+  def test_python_fallback(self):
+    """Tests xoring without the native engine."""
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    out = os.path.join(self.tmpdir, "out")
+    with mock.patch("xor.xor._cxor", None):
+      self.assertEqual(xor.xor.xorStrings("\x00\xff", "\xff\xff"),
+                       "\xff\x00")
+      xor.xor.xorAllocationParallel(alloc, self.infile, out, self.fs)
+    self.assertEqual(open(out).read(), self._expected(alloc))
+
+  def test_inbase(self):
+    """Tests the input may be read from an offset in a larger file."""
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    expected = self._expected(alloc)
+    embedded = os.path.join(self.tmpdir, "embedded")
+    open(embedded, 'w').write("header" + self.plaintext + "trailer")
+    for (i, engine) in enumerate((xor.xor.xorAllocation,
+                                  xor.xor.xorAllocationParallel)):
+      out = os.path.join(self.tmpdir, "out%i" % i)
+      engine(alloc, embedded, out, self.fs, inbase=6)
+      self.assertEqual(open(out).read(), expected)
+    out = os.path.join(self.tmpdir, "python")
+    xor.xor.xorAllocation(alloc, embedded, out, self.fs, impl="Python",
+                          inbase=6)
+    self.assertEqual(open(out).read(), expected)
+    self.assertRaises(xor.xor.AllocationSizeMismatch, xor.xor.xorAllocation,
+                      alloc, embedded, out, self.fs, inbase=20)
+
+  def test_cache(self):
+    """Tests xoring through a padfile cache, which survives between calls."""
+    cache = xor.xor.PadfileCache()
+    self.pad.addMoveListener(
+        lambda padfile: cache.invalidate(self.fs.realpath(padfile.path)))
+    expected = []
+    outputs = []
+    for impl in ("Python", "C"):
+      for i in range(3):
+        alloc = self.pad.getAllocation(len(self.plaintext) // 3)
+        self.pad.commitAllocation(alloc)
+        infile = os.path.join(self.tmpdir, "in%s%i" % (impl, i))
+        open(infile, 'w').write(self.plaintext[:len(alloc)])
+        outfile = os.path.join(self.tmpdir, "out%s%i" % (impl, i))
+        xor.xor.xorAllocation(alloc, infile, outfile, self.fs, impl=impl,
+                              cache=cache)
+        expected.append(self._expected(alloc)[:len(alloc)])
+        outputs.append(open(outfile).read())
+    self.assertEqual(outputs, expected)
+
+    # Only the padfiles at their final paths are still open.
+    self.assertEqual(sorted(cache._idle),
+                     sorted([self.fs.realpath(("spent", "pad0")),
+                             self.fs.realpath(("current", "pad1"))]))
+
+    # Nothing is left checked out, and closing closes everything.
+    idle = cache._idle.values()
+    self.assertEqual(cache._lent, {})
+    cache.close()
+    self.assertTrue(all(padfile.closed for padfile in idle))
+
+  def test_cache_lru(self):
+    """Tests the cache is bounded, LRU and can be invalidated."""
+    paths = []
+    for i in range(4):
+      paths.append(os.path.join(self.tmpdir, "pad%i" % i))
+      open(paths[-1], 'w').write(str(i))
+    cache = xor.xor.PadfileCache(capacity=2)
+    first = [cache.checkout(path) for path in paths[:3]]
+    for padfile in first:
+      cache.checkin(padfile)
+    self.assertTrue(first[0].closed)
+    self.assertEqual(cache._idle.keys(), paths[1:3])
+
+    # Checking out reuses the open file; checking in makes it most recent.
+    padfile = cache.checkout(paths[1])
+    self.assertIs(padfile, first[1])
+    cache.checkin(padfile)
+    self.assertEqual(cache._idle.keys(), [paths[2], paths[1]])
+
+    # Invalidated files are closed, even if checked out at the time.
+    lent = cache.checkout(paths[2])
+    cache.invalidate(paths[2])
+    cache.invalidate(paths[1])
+    self.assertTrue(first[1].closed)
+    self.assertFalse(lent.closed)
+    cache.checkin(lent)
+    self.assertTrue(lent.closed)
+    self.assertEqual(cache._idle.keys(), [])
+
+    # Discarded files are closed too.
+    padfile = cache.checkout(paths[3])
+    cache.discard(padfile)
+    self.assertTrue(padfile.closed)
+    self.assertEqual(cache._lent, {})
+
+  def test_move_invalidates(self):
+    """Tests padfiles moving out of current are dropped from the cache."""
+    cache = xor.xor.PadfileCache()
+    moved = []
+    def listener(padfile):
+      moved.append(padfile.path)
+      cache.invalidate(self.fs.realpath(padfile.path))
+    self.pad.addMoveListener(listener)
+
+    alloc = self.pad.getAllocation(4000)
+    (ival, padfile), = alloc.iterFiles()
+    self.pad.commitAllocation(alloc)
+    self.assertEqual(moved, [("incoming", padfile.filename)])
+    path = self.fs.realpath(padfile.path)
+    cache.checkin(cache.checkout(path))
+
+    alloc = self.pad.getAllocation(1000)
+    self.pad.commitAllocation(alloc)
+    self.assertEqual(moved[1], ("current", padfile.filename))
+    self.assertEqual(cache._idle.keys(), [])
+
+  def test_size_mismatch(self):
+    """Tests the allocation must match the input."""
+    alloc = self.pad.getAllocation(len(self.plaintext) - 1)
+    out = os.path.join(self.tmpdir, "out")
+    self.assertRaises(xor.xor.AllocationSizeMismatch,
+                      xor.xor.xorAllocationParallel, alloc, self.infile, out,
+                      self.fs)
+
+  def test_worker_failure(self):
+    """Tests anything a parallel worker raises reaches the caller."""
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    out = os.path.join(self.tmpdir, "out")
+    segments = xor.xor._xorSegments
+    def broken(*args):
+      if args[0][0][0]:
+        raise AssertionError("Broken worker.")
+      return segments(*args)
+    with mock.patch("xor.xor._xorSegments", side_effect=broken):
+      self.assertRaises(AssertionError, xor.xor.xorAllocationParallel, alloc,
+                        self.infile, out, self.fs)
+    with mock.patch("xor.xor._xorSegments", side_effect=IOError("Broken.")):
+      self.assertRaises(xor.xor.CXORError, xor.xor.xorAllocationParallel,
+                        alloc, self.infile, out, self.fs)
+
+  def test_progress(self):
+    """Tests both ways of xoring report every byte and where the time
+       went."""
+    with mock.patch("justthisonce.pad.STRIPE_THRESHOLD", 1000):
+      alloc = self.pad.getAllocation(len(self.plaintext))
+    for (i, engine) in enumerate((xor.xor.xorAllocation,
+                                  xor.xor.xorAllocationParallel)):
+      progress = Progress(interval=0)
+      reports = []
+      progress.addListener(reports.append)
+      engine(alloc, self.infile, os.path.join(self.tmpdir, "out%i" % i),
+             self.fs, progress=progress)
+      self.assertEqual(progress.report().done, len(alloc))
+      self.assertEqual([report.done for report in reports],
+                       sorted(report.done for report in reports))
+      self.assertEqual(sorted(reports[-1].phases), ["read", "write", "xor"])
+
+if __name__ == '__main__':
+  unittest.main()
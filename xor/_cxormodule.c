@@ -0,0 +1,199 @@
+/* CPython extension exposing the XOR kernels of cxor.c to xor.py. Data is
+ * taken through the buffer protocol and files as descriptors, and the GIL is
+ * released while reading, xoring and writing, so several threads can encrypt
+ * at once. */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <errno.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "cxor.h"
+
+/* Buffers shorter than this are xored without releasing the GIL, which
+ * would cost more than it saves. */
+#define RELEASE_THRESHOLD (64 * 1024)
+
+static double now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Reads up to length bytes from fd into buf, from offset with pread if it is
+ * not negative, otherwise from the current position. Retries interrupted
+ * and partial reads. Returns the number of bytes read, which is short only at
+ * end of file, or -1 with errno set. */
+static ssize_t read_full(int fd, char* buf, size_t length,
+                         PY_LONG_LONG offset) {
+  size_t done = 0;
+  while (done < length) {
+    ssize_t n = offset < 0 ? read(fd, buf + done, length - done)
+                           : pread(fd, buf + done, length - done,
+                                   offset + done);
+    if (n < 0 && errno == EINTR) {
+      continue;
+    } else if (n < 0) {
+      return -1;
+    } else if (n == 0) {
+      break;
+    }
+    done += n;
+  }
+  return done;
+}
+
+/* As read_full, but writes all of buf. Returns 0 or -1 with errno set. */
+static int write_full(int fd, const char* buf, size_t length,
+                      PY_LONG_LONG offset) {
+  size_t done = 0;
+  while (done < length) {
+    ssize_t n = offset < 0 ? write(fd, buf + done, length - done)
+                           : pwrite(fd, buf + done, length - done,
+                                    offset + done);
+    if (n < 0 && errno == EINTR) {
+      continue;
+    } else if (n < 0) {
+      return -1;
+    }
+    done += n;
+  }
+  return 0;
+}
+
+PyDoc_STRVAR(xor_buffers_doc,
+"xor_buffers(a, b) -> str\n\n"
+"Returns the bytewise xor of two equal-length buffers.");
+
+static PyObject* cxor_xor_buffers(PyObject* self, PyObject* args) {
+  Py_buffer a, b;
+  PyObject* result = NULL;
+  if (!PyArg_ParseTuple(args, "s*s*:xor_buffers", &a, &b)) {
+    return NULL;
+  }
+
+  if (a.len != b.len) {
+    PyErr_SetString(PyExc_ValueError, "Buffers differ in length.");
+  } else if ((result = PyString_FromStringAndSize(NULL, a.len))) {
+    char* out = PyString_AS_STRING(result);
+    if (a.len < RELEASE_THRESHOLD) {
+      memcpy(out, a.buf, a.len);
+      xor_buffers(out, b.buf, a.len);
+    } else {
+      Py_BEGIN_ALLOW_THREADS
+      memcpy(out, a.buf, a.len);
+      xor_buffers(out, b.buf, a.len);
+      Py_END_ALLOW_THREADS
+    }
+  }
+
+  PyBuffer_Release(&a);
+  PyBuffer_Release(&b);
+  return result;
+}
+
+PyDoc_STRVAR(xor_fds_doc,
+"xor_fds(infd, padfd, outfd, pad_offset, length, in_offset=-1,\n"
+"        out_offset=-1) -> (read, xor, write)\n\n"
+"Xors length bytes read from infd with the pad read from padfd at\n"
+"pad_offset, writing the result to outfd. The input is read from in_offset\n"
+"and the output written at out_offset if they are not negative, otherwise\n"
+"at the descriptors' current positions, so pipes may be used. The pad is\n"
+"always read by offset and its descriptor's position is not changed.\n\n"
+"Returns the seconds spent reading, xoring and writing. Raises IOError on\n"
+"errors and EOFError if the input or pad ends early.");
+
+static PyObject* cxor_xor_fds(PyObject* self, PyObject* args) {
+  int infd, padfd, outfd;
+  PY_LONG_LONG pad_offset, in_offset = -1, out_offset = -1;
+  Py_ssize_t length;
+  char* buf[2] = {NULL, NULL};
+  double times[3] = {0, 0, 0};
+  int error = 0, eof = 0;
+
+  if (!PyArg_ParseTuple(args, "iiiLn|LL:xor_fds", &infd, &padfd, &outfd,
+                        &pad_offset, &length, &in_offset, &out_offset)) {
+    return NULL;
+  }
+  if (pad_offset < 0 || length < 0) {
+    PyErr_SetString(PyExc_ValueError, "Negative pad offset or length.");
+    return NULL;
+  }
+  if (length == 0) {
+    return Py_BuildValue("(ddd)", 0.0, 0.0, 0.0);
+  }
+
+  size_t size = length < BUFFER_LENGTH ? length : BUFFER_LENGTH;
+  if (posix_memalign((void**) &buf[0], 32, size) ||
+      posix_memalign((void**) &buf[1], 32, size)) {
+    free(buf[0]);
+    return PyErr_NoMemory();
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  size_t remaining = length;
+  while (remaining > 0) {
+    size_t count = remaining < size ? remaining : size;
+    double started = now();
+    ssize_t got = read_full(infd, buf[0], count, in_offset);
+    ssize_t pad = got < 0 ? 0 : read_full(padfd, buf[1], count, pad_offset);
+    if (got < 0 || pad < 0) {
+      error = errno;
+      break;
+    } else if ((size_t) got != count || (size_t) pad != count) {
+      eof = 1;
+      break;
+    }
+    double fetched = now();
+
+    xor_buffers(buf[0], buf[1], count);
+    double xored = now();
+
+    if (write_full(outfd, buf[0], count, out_offset)) {
+      error = errno;
+      break;
+    }
+    times[0] += fetched - started;
+    times[1] += xored - fetched;
+    times[2] += now() - xored;
+
+    remaining -= count;
+    pad_offset += count;
+    if (in_offset >= 0) {
+      in_offset += count;
+    }
+    if (out_offset >= 0) {
+      out_offset += count;
+    }
+  }
+  Py_END_ALLOW_THREADS
+
+  free(buf[0]);
+  free(buf[1]);
+  if (error) {
+    errno = error;
+    return PyErr_SetFromErrno(PyExc_IOError);
+  } else if (eof) {
+    PyErr_SetString(PyExc_EOFError, "Input or pad ended early.");
+    return NULL;
+  }
+  return Py_BuildValue("(ddd)", times[0], times[1], times[2]);
+}
+
+static PyMethodDef cxor_methods[] = {
+  {"xor_buffers", cxor_xor_buffers, METH_VARARGS, xor_buffers_doc},
+  {"xor_fds", cxor_xor_fds, METH_VARARGS, xor_fds_doc},
+  {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC init_cxor(void) {
+  PyObject* module = Py_InitModule3("_cxor", cxor_methods,
+                                    "Native XOR engine; see xor.py.");
+  if (module) {
+    PyModule_AddIntConstant(module, "BUFFER_LENGTH", BUFFER_LENGTH);
+  }
+}
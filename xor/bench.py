@@ -0,0 +1,335 @@
+"""
+Throughput benchmark for the XOR engines. Each engine encrypts payloads of
+several sizes through allocations broken into several numbers of atoms, with
+several read buffer sizes, starting from a cold or a warm page cache, and the
+best of a few runs is reported in bytes per second. Results are JSON, and may
+be compared with a baseline from an earlier run to catch regressions or to
+choose settings for a host. Run with python -m xor.bench --help.
+
+Scratch pads are made in the given directories, and each run needs about
+four times the payload size free across them, so the 10G size needs room.
+"""
+
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from justthisonce.interval import Interval
+from justthisonce.pad import Allocation, File, StripedFilesystem
+from justthisonce.units import parseSize
+import xor
+
+RESULTS_VERSION = 1
+
+# Key identifying a result across runs.
+RESULT_KEY = ("engine", "size", "buffer", "fragments", "cache")
+
+# Bytes of random data repeated to fill scratch files. What the pad holds
+# makes no difference to the speed of xoring it.
+_PATTERN_SIZE = 1024 * 1024
+
+class Error(Exception):
+  """Base error for the bench module."""
+
+class BadBaseline(Error):
+  """A baseline could not be read."""
+
+def _xorPython(alloc, infile, outfile, fs):
+  return xor.xorAllocation(alloc, infile, outfile, fs, impl="Python")
+
+def _xorC(alloc, infile, outfile, fs):
+  return xor.xorAllocation(alloc, infile, outfile, fs, impl="C")
+
+def _xorParallel(alloc, infile, outfile, fs):
+  return xor.xorAllocationParallel(alloc, infile, outfile, fs)
+
+# Engine name to (function, whether PyXOR.BUFFER_LENGTH applies to it). The
+# native engine's buffer is fixed when it is compiled, and the parallel engine
+# uses it when it is built.
+ENGINES = collections.OrderedDict([
+    ("Python", (_xorPython, True)),
+    ("C", (_xorC, False)),
+    ("parallel", (_xorParallel, xor._cxor is None)),
+])
+
+def availableEngines(roots):
+  """Returns the names of the engines that can run here, given the number
+     of scratch roots: C needs the extension and parallel more than one
+     root, as with one it is the same as Python."""
+  names = list(ENGINES)
+  if xor._cxor is None:
+    names.remove("C")
+  if roots < 2:
+    names.remove("parallel")
+  return names
+
+def _sizeList(text):
+  return [parseSize(part) for part in text.split(",")]
+
+def _intList(text):
+  try:
+    return [int(part) for part in text.split(",")]
+  except ValueError:
+    raise argparse.ArgumentTypeError("Bad list %r." % text)
+
+def _fill(path, size, pattern):
+  """Writes size bytes of the repeated pattern to path and syncs it, so the
+     page cache can later be dropped."""
+  with open(path, "wb") as fd:
+    while size > 0:
+      fd.write(pattern[:size])
+      size -= len(pattern)
+    fd.flush()
+    os.fsync(fd.fileno())
+
+_libc = None
+def _dropCache(paths):
+  """Asks the kernel to drop the given files from the page cache. Returns
+     False if it does not support that."""
+  global _libc
+  if _libc is None:
+    try:
+      _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+      _libc.posix_fadvise
+    except (OSError, AttributeError):
+      _libc = False
+  if not _libc or not sys.platform.startswith("linux"):
+    return False
+  POSIX_FADV_DONTNEED = 4
+  for path in paths:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      if _libc.posix_fadvise(fd, ctypes.c_longlong(0), ctypes.c_longlong(0),
+                             POSIX_FADV_DONTNEED) != 0:
+        return False
+    finally:
+      os.close(fd)
+  return True
+
+class Scratch(object):
+  """A payload and a striped pad over the given roots, with an allocation
+     of the payload's size split into fragments atoms. Atoms alternate
+     between the roots and are separated by gaps as long as themselves."""
+
+  def __init__(self, roots, size, fragments, pattern):
+    self.fs = StripedFilesystem(roots)
+    self.infile = os.path.join(roots[0], "payload")
+    self.outfile = os.path.join(roots[0], "output")
+    _fill(self.infile, size, pattern)
+
+    self.fragments = fragments = max(1, min(fragments, size))
+    atom = size // fragments
+    atoms = collections.defaultdict(list)
+    for i in xrange(fragments):
+      length = atom if i < fragments - 1 else size - atom * (fragments - 1)
+      root = i % len(roots)
+      atoms[root].append((2 * atom * (i // len(roots)), length))
+
+    self.alloc = Allocation()
+    self.padfiles = []
+    for (root, root_atoms) in sorted(atoms.iteritems()):
+      start, length = root_atoms[-1]
+      padfile = File("pad%i" % root, start + length, "current")
+      path = os.path.join(roots[root], "current", padfile.filename)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+      _fill(path, padfile.size, pattern)
+      self.padfiles.append(path)
+      self.alloc.unionUpdate(Allocation(padfile,
+                                        Interval.fromAtoms(root_atoms)))
+
+  def run(self, engine, cold):
+    """Runs the engine once and returns the seconds it took. If cold, the
+       inputs are dropped from the page cache first."""
+    if os.path.exists(self.outfile):
+      os.unlink(self.outfile)
+    if cold and not _dropCache([self.infile] + self.padfiles):
+      raise Error("Cannot drop the page cache here.")
+    start = time.time()
+    count = ENGINES[engine][0](self.alloc, self.infile, self.outfile, self.fs)
+    elapsed = time.time() - start
+    assert count == len(self.alloc)
+    return elapsed
+
+  def remove(self):
+    """Deletes the scratch files."""
+    for path in [self.infile, self.outfile] + self.padfiles:
+      if os.path.exists(path):
+        os.unlink(path)
+
+def hostInfo():
+  """Describes the host, so results from different ones are not confused."""
+  try:
+    cpus = multiprocessing.cpu_count()
+  except NotImplementedError:
+    cpus = None
+  return {"platform": platform.platform(), "machine": platform.machine(),
+          "python": platform.python_version(), "cpus": cpus,
+          "c_engine": xor._cxor is not None}
+
+def benchmark(roots, sizes, buffers, fragments, caches=("warm",), repeat=3,
+              engines=None, progress=None):
+  """Runs every combination of engine (default all available), payload
+     size, buffer size, fragments and cache state, each repeat times, with
+     scratch files in roots. Returns the results document. progress, if
+     given, is called with each result as it is produced."""
+  if engines is None:
+    engines = availableEngines(len(roots))
+  pattern = os.urandom(_PATTERN_SIZE)
+  results = []
+  saved_buffer = xor.PyXOR.BUFFER_LENGTH
+  try:
+    for size in sizes:
+      for count in fragments:
+        scratch = Scratch(roots, size, count, pattern)
+        try:
+          for engine in engines:
+            buffered = ENGINES[engine][1]
+            for buffer_size in (buffers if buffered else [None]):
+              if buffer_size is not None:
+                xor.PyXOR.BUFFER_LENGTH = buffer_size
+              for cache in caches:
+                if cache == "warm":
+                  scratch.run(engine, False)
+                best = min(scratch.run(engine, cache == "cold")
+                           for i in xrange(repeat))
+                result = {"engine": engine, "size": size,
+                          "buffer": buffer_size,
+                          "fragments": scratch.fragments,
+                          "cache": cache, "seconds": best,
+                          "throughput": size / best if best else None}
+                results.append(result)
+                if progress is not None:
+                  progress(result)
+        finally:
+          scratch.remove()
+  finally:
+    xor.PyXOR.BUFFER_LENGTH = saved_buffer
+  return {"version": RESULTS_VERSION, "host": hostInfo(), "results": results}
+
+def _key(result):
+  return tuple(result[name] for name in RESULT_KEY)
+
+def compare(document, baseline, tolerance=0.1):
+  """Compares the results of a benchmark with a baseline document. Each
+     result present in both gains the baseline throughput and its ratio to
+     it, and is a regression if it is more than tolerance (a fraction)
+     slower. Returns the regressions."""
+  if baseline.get("version") != RESULTS_VERSION:
+    raise BadBaseline("Unknown results version %r." % baseline.get("version"))
+  previous = dict((_key(result), result["throughput"])
+                  for result in baseline["results"])
+  regressions = []
+  for result in document["results"]:
+    old = previous.get(_key(result))
+    if not old or not result["throughput"]:
+      continue
+    result["baseline"] = old
+    result["ratio"] = result["throughput"] / old
+    result["regression"] = result["ratio"] < 1 - tolerance
+    if result["regression"]:
+      regressions.append(result)
+  return regressions
+
+def formatResult(result):
+  """Returns a line describing a result."""
+  line = "%-8s %12i bytes %10s buffer %6i atoms %4s %10.1f MB/s" % (
+      result["engine"], result["size"], result["buffer"] or "-",
+      result["fragments"], result["cache"],
+      (result["throughput"] or 0) / 1e6)
+  if "ratio" in result:
+    line += "  %5.2fx baseline%s" % (result["ratio"],
+                                      " REGRESSION" * result["regression"])
+  return line
+
+def makeParser():
+  parser = argparse.ArgumentParser(prog="python -m xor.bench",
+                                   description="Benchmark the XOR engines.")
+  parser.add_argument("--dir", action="append", dest="dirs",
+                      help="Directory for scratch files. Give it once per "
+                           "device to benchmark striped pads. Defaults to a "
+                           "temporary directory.")
+  parser.add_argument("--sizes", type=_sizeList, default="1K,1M,64M",
+                      help="Payload sizes, e.g. 1K,1M,1G,10G.")
+  parser.add_argument("--buffers", type=_sizeList, default="64K,1M,4M",
+                      help="Read buffer sizes for the Python engines.")
+  parser.add_argument("--fragments", type=_intList, default="1,64,4096",
+                      help="Numbers of atoms to split each allocation into.")
+  parser.add_argument("--cache", default="warm,cold",
+                      help="Page cache states to start from: warm, cold.")
+  parser.add_argument("--repeat", type=int, default=3,
+                      help="Runs of each case; the fastest is reported.")
+  parser.add_argument("--engines",
+                      help="Engines to run. Defaults to all available.")
+  parser.add_argument("--output", help="Write the results here, not stdout.")
+  parser.add_argument("--baseline",
+                      help="Compare with results saved from an earlier run.")
+  parser.add_argument("--tolerance", type=float, default=0.1,
+                      help="Fraction slower than the baseline that counts as "
+                           "a regression.")
+  parser.add_argument("-q", "--quiet", action="store_true",
+                      help="Do not report results on stderr as they come.")
+  return parser
+
+def main(argv=None):
+  """Runs the benchmark from the command line. Exits with status 1 if any
+     result regressed against the baseline."""
+  args = makeParser().parse_args(argv)
+  caches = [cache.strip() for cache in args.cache.split(",")]
+  if not set(caches) <= set(("warm", "cold")):
+    raise SystemExit("Cache states are warm and cold.")
+  if "cold" in caches and not _dropCache([]):
+    sys.stderr.write("Cannot drop the page cache here; skipping cold runs.\n")
+    caches.remove("cold")
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as fd:
+      baseline = json.load(fd)
+
+  engines = None
+  if args.engines:
+    engines = args.engines.split(",")
+    unknown = set(engines) - set(availableEngines(len(args.dirs or [None])))
+    if unknown:
+      raise SystemExit("Unavailable engines: %s." % ", ".join(sorted(unknown)))
+
+  tmpdir = None
+  dirs = args.dirs
+  if not dirs:
+    tmpdir = tempfile.mkdtemp()
+    dirs = [tmpdir]
+  report = None if args.quiet else \
+           lambda result: sys.stderr.write(formatResult(result) + "\n")
+  try:
+    document = benchmark(dirs, args.sizes, args.buffers, args.fragments,
+                         caches, args.repeat, engines, report)
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir)
+
+  regressions = []
+  if baseline is not None:
+    regressions = compare(document, baseline, args.tolerance)
+    for result in regressions:
+      sys.stderr.write("Regression: %s\n" % formatResult(result))
+
+  text = json.dumps(document, sort_keys=True, indent=2)
+  if args.output:
+    with open(args.output, "w") as fd:
+      fd.write(text + "\n")
+  else:
+    print text
+  return 1 if regressions else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -9,6 +9,21 @@
 
 #include "cxor.h"
 
+/* Where the compiler allows, the SIMD kernels are built whatever its default
+ * target, as select_xor only picks them if cpuid says they will run. This
+ * keeps them in builds (such as setup.py's) without -march=native. */
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define SSE_KERNEL __attribute__((target("sse")))
+#define AVX_KERNEL __attribute__((target("avx")))
+#else
+#ifdef __SSE__
+#define SSE_KERNEL
+#endif
+#ifdef __AVX__
+#define AVX_KERNEL
+#endif
+#endif
+
 static int close_file(FILE* file) {
   if (file && file != stdin && file != stdout) {
     return fclose(file);
@@ -17,9 +32,15 @@ static int close_file(FILE* file) {
   }
 }
 
+static int close_input(XorWorkUnit* work, int index) {
+  int rval = work->borrowed[index] ? 0 : close_file(work->inputs[index]);
+  work->inputs[index] = NULL;
+  work->borrowed[index] = 0;
+  return rval;
+}
+
 int execute_open_input(XorWorkUnit* work, int index, const char* filename) {
-  if (work->inputs[index] && work->inputs[index] != stdin &&
-      fclose(work->inputs[index])) {
+  if (close_input(work, index)) {
     execute_cleanup(work);
     /* Failed to close old one. */
     return -1;
@@ -42,6 +63,17 @@ int execute_open_input(XorWorkUnit* work, int index, const char* filename) {
   return 0;
 }
 
+int execute_borrow_input(XorWorkUnit* work, int index, FILE* file) {
+  if (close_input(work, index) || !file) {
+    execute_cleanup(work);
+    return -1;
+  }
+
+  work->inputs[index] = file;
+  work->borrowed[index] = 1;
+  return 0;
+}
+
 int execute_open_output(XorWorkUnit* work, const char* filename) {
   if (work->output && work->output != stdout && fclose(work->output)) {
     execute_cleanup(work);
@@ -86,8 +118,8 @@ static void xor_c  (char *out, const char *pad, size_t size) {
     }
 }
 
-#ifdef __SSE__
-static void xor_sse(char *out, const char *pad, size_t size) {
+#ifdef SSE_KERNEL
+SSE_KERNEL static void xor_sse(char *out, const char *pad, size_t size) {
     size_t i;
     size_t integral_size = size & ~(15u);
     for (i = 0; i < integral_size; i += 16u) {
@@ -108,8 +140,8 @@ static void xor_sse(char *out, const char *pad, size_t size) {
 }
 #endif
 
-#ifdef __AVX__
-static void xor_avx(char *out, const char *pad, size_t size) {
+#ifdef AVX_KERNEL
+AVX_KERNEL static void xor_avx(char *out, const char *pad, size_t size) {
     size_t i;
     size_t integral_size = size & ~(31u);
     for (i = 0; i < integral_size; i += 32u) {
@@ -132,7 +164,7 @@ static void xor_avx(char *out, const char *pad, size_t size) {
 
 typedef void (*xor_f)(char *, const char *, size_t);
 static xor_f f =
-#if defined(__SSE__) || defined(__AVX__)
+#if defined(SSE_KERNEL) || defined(AVX_KERNEL)
     /* We have something to check at runtime. */
     NULL
 #else
@@ -148,7 +180,7 @@ static xor_f f =
  * and consequently, it is safe to call concurrently (so long as f has a memory
  * type that supports atomic stores in light of parallel writers).
  */
-static void select_xor() {
+static void select_xor(void) {
     if (f) {
         return;
     }
@@ -159,7 +191,7 @@ static void select_xor() {
     __asm__("cpuid" :
         "=a"(flags_a), "=b"(flags_b), "=c"(flags_c), "=d"(flags_d) : "a"(1));
 
-    #ifdef __AVX__
+    #ifdef AVX_KERNEL
     const unsigned avx_osxsave = 0x18000000;
 
     if ((flags_c & avx_osxsave) == avx_osxsave) {
@@ -172,7 +204,7 @@ static void select_xor() {
     }
     #endif
 
-    #ifdef __SSE__
+    #ifdef SSE_KERNEL
     const unsigned sse = 0x01000000;
 
     if ((flags_d & sse) == sse) {
@@ -185,6 +217,11 @@ static void select_xor() {
     f = xor_c;
 }
 
+void xor_buffers(char* dest, const char* src, size_t length) {
+  select_xor();
+  f(dest, src, length);
+}
+
 int execute_xor(XorWorkUnit* work, size_t length) {
   /* Choose the xor algorithm. */
   select_xor();
@@ -212,8 +249,8 @@ int execute_xor(XorWorkUnit* work, size_t length) {
 }
 
 int execute_cleanup(XorWorkUnit* work) {
-  int success = (close_file(work->inputs[0]) || close_file(work->inputs[1]) ||
+  int success = (close_input(work, 0) | close_input(work, 1) |
                  close_file(work->output));
-  work->inputs[0] = work->inputs[1] = work->output = NULL;
+  work->output = NULL;
   return success;
 }
@@ -7,6 +7,9 @@
 typedef struct XorWorkUnit {
   FILE* output;
   FILE* inputs[2];
+  /* Nonzero if the caller owns the corresponding input and we must not
+   * close it. */
+  int borrowed[2];
   char buf[2][BUFFER_LENGTH] __attribute__((__aligned__(32)));
 } XorWorkUnit;
 
@@ -14,6 +17,13 @@ int execute_xor(XorWorkUnit* work, size_t length);
 
 int execute_open_input(XorWorkUnit* work, int index, const char* filename);
 
+/* REQUIRES: file is open for reading and outlives its use by work.
+ *
+ * EFFECTS:  Uses file as the given input without taking ownership, so it is
+ *           never closed by work. Lets callers keep files open across
+ *           work units.*/
+int execute_borrow_input(XorWorkUnit* work, int index, FILE* file);
+
 int execute_open_output(XorWorkUnit* work, const char* filename);
 
 int execute_seek_input(XorWorkUnit* work, int index, size_t pos);
@@ -30,5 +40,6 @@ int xor_files(FILE* input_files[2], char* buf[2], FILE* output_file,
               size_t length);
 
 /* REQUIRES: src and dest are valid buffers of at least given length.
- * EFFECTS:  dest contains src ^ dest for length*/
-void xor_buffers(char* dest, const char* src, int length);
+ * EFFECTS:  dest contains src ^ dest for length. Uses the fastest kernel the
+ *           CPU supports. Safe to call from any thread.*/
+void xor_buffers(char* dest, const char* src, size_t length);
@@ -56,6 +56,7 @@ int xor_test(char* inputs[2], size_t length) {
     XorWorkUnit* work = malloc(sizeof(*work));
     if (work) {
       work->output = work->inputs[0] = work->inputs[1] = 0;
+      work->borrowed[0] = work->borrowed[1] = 0;
     } else {
       fprintf(stderr, "Malloc failed.\n");
       rval = -1;
@@ -122,6 +123,34 @@ int xor_test(char* inputs[2], size_t length) {
   return rval;
 }
 
+/* Borrowed inputs must be left open by the work unit. */
+int borrow_test() {
+  int rval = 0;
+  FILE* file = tmpfile();
+  XorWorkUnit* work = calloc(1, sizeof(*work));
+  if (!file || !work) {
+    fprintf(stderr, "Setup failed.\n");
+    return -1;
+  }
+
+  if (execute_borrow_input(work, 0, file) || execute_cleanup(work) ||
+      execute_borrow_input(work, 1, file) ||
+      execute_open_input(work, 1, NULL) || work->inputs[1] != stdin ||
+      execute_cleanup(work) || fputc('x', file) == EOF) {
+    fprintf(stderr, "Borrowed input was not left alone.\n");
+    rval = -1;
+  }
+
+  if (!execute_borrow_input(work, 0, NULL)) {
+    fprintf(stderr, "Borrowed a NULL input.\n");
+    rval = -1;
+  }
+
+  fclose(file);
+  free(work);
+  return rval;
+}
+
 int main() {
   char input_buf[2][40] = {"Hello world how are you? I am good!",
                            "Bees!\0Bees!\1BEES!\0Bees!\3Bees!\0Bees!"};
@@ -130,5 +159,6 @@ int main() {
   for (i = 0; i < 25; ++i) {
     assert(!xor_test(inputs, 35));
   }
+  assert(!borrow_test());
   fprintf(stderr, "Test passed!\n");
 }
@@ -1,14 +1,21 @@
-import ctypes
-import cxorlib
+import binascii
+import collections
 import sys
 import os
+import threading
+import time
 
+# The native engine is an extension module built by setup.py (python
+# setup.py build_ext --inplace for a checkout). Without it the Python engine
+# is used for everything.
 try:
-  # TODO: this needs to be relative to application dir.
-  _xorlib=ctypes.cdll.LoadLibrary("/home/alexr/projects/justthisonce/xor/cxor.so")
-except Exception:
-  sys.stderr.write("Error loading C XOR library; falling back to (slow) Python.")
-  _xorlib = None
+  import _cxor
+except ImportError:
+  _cxor = None
+
+# The native engine is called for at most this many bytes at a time, so that
+# progress is reported and signals are handled while it works.
+NATIVE_STEP = 64 * 1024 * 1024
 
 class Error(Exception):
   pass
@@ -23,26 +30,129 @@ def execute(fxn, *args):
   if fxn(*args) != 0:
     raise CXORError()
 
+def xorStrings(a, b):
+  """Returns the bytewise xor of two equal-length strings (or other
+     buffers). Without the native engine, goes through long integers rather
+     than a per-byte loop so the work happens in C."""
+  assert len(a) == len(b)
+  if _cxor is not None:
+    return _cxor.xor_buffers(a, b)
+  if not a:
+    return ""
+  value = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+  return binascii.unhexlify("%0*x" % (2 * len(a), value))
+
+class PadfileCache(object):
+  """Bounded LRU cache of open padfiles, so that XOR calls reusing the same
+     padfiles do not reopen and close them every time. A file is checked out
+     for exclusive use and checked back in when done, so one cache may be
+     shared by threads and by both XOR engines. Paths must be invalidated
+     when padfiles move (see Pad.addMoveListener)."""
+
+  def __init__(self, capacity=16):
+    self.capacity = capacity
+    self._lock = threading.Lock()
+
+    # Mapping from path to an idle open file, least recently used first.
+    self._idle = collections.OrderedDict()
+
+    # Mapping from id of a checked out file to its path, and the ids of
+    # those invalidated while out.
+    self._lent = {}
+    self._stale = set()
+
+  def checkout(self, path):
+    """Returns an open file for path, for exclusive use until checkin."""
+    with self._lock:
+      padfile = self._idle.pop(path, None)
+    if padfile is None:
+      padfile = open(path, "rb")
+    with self._lock:
+      self._lent[id(padfile)] = path
+    return padfile
+
+  def checkin(self, padfile):
+    """Returns a file from checkout to the cache, evicting the least recently
+       used file if the cache is full."""
+    evicted = []
+    with self._lock:
+      path = self._lent.pop(id(padfile))
+      if id(padfile) in self._stale or path in self._idle:
+        self._stale.discard(id(padfile))
+        evicted.append(padfile)
+      else:
+        self._idle[path] = padfile
+        while len(self._idle) > self.capacity:
+          evicted.append(self._idle.popitem(last=False)[1])
+    for padfile in evicted:
+      padfile.close()
+
+  def discard(self, padfile):
+    """Closes a checked out file instead of returning it, e.g. because an
+       error left it in an unknown state."""
+    with self._lock:
+      del self._lent[id(padfile)]
+      self._stale.discard(id(padfile))
+    padfile.close()
+
+  def invalidate(self, path):
+    """Forgets any file open for path, e.g. because it is being moved."""
+    with self._lock:
+      padfile = self._idle.pop(path, None)
+      self._stale.update(key for (key, lent) in self._lent.iteritems()
+                         if lent == path)
+    if padfile is not None:
+      padfile.close()
+
+  def close(self):
+    """Closes all idle files. Checked out files are closed on checkin."""
+    with self._lock:
+      idle, self._idle = self._idle, collections.OrderedDict()
+      self._stale.update(self._lent)
+    for padfile in idle.itervalues():
+      padfile.close()
+
 class PyXOR(object):
-  """Pure Python implementation of the CXOR interface. Used both for testing and
-     as an option should the C implementation be unavailable."""
+  """Pure Python implementation of the work unit interface of cxor.h. Used
+     both for testing and as an option should the native engine be
+     unavailable."""
   BUFFER_LENGTH = 4 * 1024 * 1024
   class PyXORWorkUnit(object):
     def __init__(self):
       self.inputs = [None, None]
+      self.borrowed = [False, False]
       self.output = None
+      # Receives each buffer done, if set (see justthisonce.progress).
+      self.progress = None
 
   @staticmethod
-  def execute_open_input(work, index, filename):
-    if work.inputs[index] and work.inputs[index] != sys.stdin:
+  def _close_input(work, index):
+    if work.inputs[index] not in (None, sys.stdin) and \
+       not work.borrowed[index]:
       work.inputs[index].close()
+    work.inputs[index] = None
+    work.borrowed[index] = False
+
+  @staticmethod
+  def execute_open_input(work, index, filename):
+    PyXOR._close_input(work, index)
     if filename:
       work.inputs[index] = open(filename, "rb")
     elif work.inputs[0 if index == 1 else 1] != sys.stdin:
       work.inputs[index] = sys.stdin
     else:
-      execute_cleanup(work)
+      PyXOR.execute_cleanup(work)
+      return -1
+    return 0
+
+  @staticmethod
+  def execute_borrow_input(work, index, padfile):
+    PyXOR._close_input(work, index)
+    if padfile is None:
+      PyXOR.execute_cleanup(work)
       return -1
+    work.inputs[index] = padfile
+    work.borrowed[index] = True
     return 0
 
   @staticmethod
@@ -58,61 +168,275 @@ class PyXOR(object):
   @staticmethod
   def execute_seek_input(work, index, pos):
     if not work.inputs[index] or work.inputs[index] == sys.stdin:
-      execute_cleanup(work)
+      PyXOR.execute_cleanup(work)
       return -1
-    work.inputs[index].seek(ps, os.SEEK_SET)
+    work.inputs[index].seek(pos, os.SEEK_SET)
+    return 0
 
   @staticmethod
   def execute_xor(work, length):
     while length > 0:
-      size = min(length, BUFFER_LENGTH)
+      size = min(length, PyXOR.BUFFER_LENGTH)
       length -= size
 
-      data = zip(work.inputs[i].read(size) for i in xrange(2))
-      if len(data) != size:
-        execute_cleanup(work)
+      started = time.time()
+      data = [work.inputs[i].read(size) for i in xrange(2)]
+      if len(data[0]) != size or len(data[1]) != size:
+        PyXOR.execute_cleanup(work)
         return -1
-      work.output.write(chr(ord(a) ^ ord(b)) for (a, b) in data)
+      read = time.time()
+      data = xorStrings(*data)
+      xored = time.time()
+      work.output.write(data)
+      if work.progress is not None:
+        work.progress.update(size, read=read - started, xor=xored - read,
+                             write=time.time() - xored)
+    return 0
 
   @staticmethod
   def execute_cleanup(work):
-    for fd in [work.output] + work.inputs:
-      if fd not in (None, sys.stdin, sys.stdout):
-        fd.close()
-    work.output = work.inputs[0] = work.inputs[1] = None
+    for index in xrange(2):
+      PyXOR._close_input(work, index)
+    if work.output not in (None, sys.stdout):
+      work.output.close()
+    work.output = None
+    return 0
+
+def _checkSize(alloc, infile, inbase):
+  """Checks infile holds the input for the allocation: exactly, or from
+     inbase on if it is given."""
+  size = os.stat(infile).st_size
+  if inbase is None:
+    mismatch = size != len(alloc)
+  else:
+    mismatch = size < inbase + len(alloc)
+  if mismatch:
+    raise AllocationSizeMismatch(os.stat(infile), len(alloc))
 
-def xorAllocation(alloc, infile, outfile, impl="C"):
+def xorAllocation(alloc, infile, outfile, fs, impl="C", cache=None,
+                  lock=None, progress=None, inbase=None):
   """Given an allocation and an input file, xor the allocation with the input
      file and *append* the result to the specified output file. infile and/or
-     outfile should be None to indicate stdin/stdout."""
-  if impl == "Python" or _xorlib is None:
-    xor = PyXOR
-    work = PyXOR.PyXORWorkUnit()
-  elif impl == "C":
-    xor = _xorlib 
-    work = cxorlib.XorWorkUnit()
-  else:
+     outfile should be None to indicate stdin/stdout; stdin can't be checked
+     in advance, so CXORError is raised if it holds less than the allocation
+     (and any more is left unread). If inbase is given, the input is instead
+     the bytes of infile from inbase on, such as the payload of a message
+     container, and the file may hold more after them. Padfiles are found
+     through fs, the pad's Filesystem, and kept open in cache (a
+     PadfileCache) if given. If the pad may be committed to concurrently,
+     lock is the lock held while doing so, and is held while finding and
+     opening each padfile so that it cannot move in between. Each buffer
+     done is reported to progress (a justthisonce.progress.Progress) if
+     given. Returns the number of bytes xored."""
+  if lock is None:
+    lock = threading.Lock()
+  if impl not in ("Python", "C"):
     raise Error("Unknown encryption provider: %s" % impl)
 
   # Check the allocation is the correct length.
-  infile_size = os.stat(infile).st_size
-  if infile_size != len(alloc):
-    raise AllocationSizeMismatch(os.stat(infile), len(alloc))
+  assert infile is not None or inbase is None
+  if infile is not None:
+    _checkSize(alloc, infile, inbase)
 
-  work.output = None
-  work.inputs[0] = None
-  work.inputs[1] = None
+  if impl == "C" and _cxor is not None:
+    return _xorAllocationNative(alloc, infile, outfile, fs, cache, lock,
+                                progress, inbase)
 
+  work = PyXOR.PyXORWorkUnit()
+  work.progress = progress
   try:
-    execute(xor.execute_open_input, work, 1, infile)
-    execute(xor.execute_open_output, work, outfile)
+    execute(PyXOR.execute_open_input, work, 1, infile)
+    if inbase:
+      execute(PyXOR.execute_seek_input, work, 1, inbase)
+    execute(PyXOR.execute_open_output, work, outfile)
 
     # Encrypt the allocation one interval at a time.
-    for (pad_interval, pad_file) in alloc.iterValues():
-      execute(xor.execute_open_input, work, 0, pad_file)
-      for (start, length) in pad_interval.toAtoms():
-        execute(xor.execute_seek_input, work, 0, start)
-        execute(xor.execute_xor, work, length)
-    execute(xor.execute_cleanup, work)
+    for (pad_interval, pad_file) in alloc.iterFiles():
+      if cache is None:
+        with lock:
+          execute(PyXOR.execute_open_input, work, 0,
+                  fs.realpath(pad_file.path))
+        _xorAtoms(work, pad_interval)
+        continue
+
+      with lock:
+        padfile = cache.checkout(fs.realpath(pad_file.path))
+      try:
+        execute(PyXOR.execute_borrow_input, work, 0, padfile)
+        _xorAtoms(work, pad_interval)
+      except:
+        cache.discard(padfile)
+        raise
+      cache.checkin(padfile)
+    execute(PyXOR.execute_cleanup, work)
   except AssertionError:
     raise CXORError()
+  return len(alloc)
+
+def _xorAtoms(work, pad_interval):
+  """Helper for xorAllocation. Xors the atoms of pad_interval from the pad
+     input of work."""
+  for (start, length) in pad_interval.toAtoms():
+    execute(PyXOR.execute_seek_input, work, 0, start)
+    execute(PyXOR.execute_xor, work, length)
+
+def _xorNative(infd, padfd, outfd, start, length, in_offset, out_offset,
+               progress):
+  """Xors length bytes of input with the pad from start using the native
+     engine, reading the input from in_offset and writing at out_offset if
+     they are not negative (see _cxor.xor_fds)."""
+  while length > 0:
+    size = min(length, NATIVE_STEP)
+    try:
+      read, xored, written = _cxor.xor_fds(infd, padfd, outfd, start, size,
+                                           in_offset, out_offset)
+    except (EnvironmentError, EOFError), ex:
+      raise CXORError(ex)
+    if progress is not None:
+      progress.update(size, read=read, xor=xored, write=written)
+    length -= size
+    start += size
+    if in_offset >= 0:
+      in_offset += size
+    if out_offset >= 0:
+      out_offset += size
+
+def _xorAllocationNative(alloc, infile, outfile, fs, cache, lock, progress,
+                         inbase):
+  """Helper for xorAllocation using the native engine, which works on the
+     files' descriptors with the GIL released. Anything already buffered
+     from stdin by Python is not seen."""
+  if cache is None:
+    cache = PadfileCache(capacity=0)
+  inputs = sys.stdin if infile is None else open(infile, "rb")
+  if inbase:
+    inputs.seek(inbase)
+  output = sys.stdout if outfile is None else open(outfile, "ab")
+  output.flush()
+  try:
+    for (pad_interval, pad_file) in alloc.iterFiles():
+      with lock:
+        pad = cache.checkout(fs.realpath(pad_file.path))
+      try:
+        for (start, length) in pad_interval.toAtoms():
+          _xorNative(inputs.fileno(), pad.fileno(), output.fileno(), start,
+                     length, -1, -1, progress)
+      except:
+        cache.discard(pad)
+        raise
+      cache.checkin(pad)
+  finally:
+    if inputs is not sys.stdin:
+      inputs.close()
+    if output is not sys.stdout:
+      output.close()
+  return len(alloc)
+
+def _xorSegments(segments, infile, outfile, fs, base, cache, lock, progress,
+                 inbase):
+  """Worker for xorAllocationParallel. Xors each (offset, padfile, start,
+     length) segment of pad with infile at inbase + offset into outfile at
+     base + offset."""
+  if cache is None:
+    cache = PadfileCache(capacity=0)
+  inputs = open(infile, "rb")
+  output = open(outfile, "r+b")
+  pad, pad_file = None, None
+  try:
+    for (offset, padfile, start, length) in segments:
+      if padfile is not pad_file:
+        if pad is not None:
+          cache.checkin(pad)
+          pad = None
+        with lock:
+          path = fs.realpath(padfile.path)
+          pad = cache.checkout(path)
+        pad_file = padfile
+      if _cxor is not None:
+        _xorNative(inputs.fileno(), pad.fileno(), output.fileno(), start,
+                   length, inbase + offset, base + offset, progress)
+        continue
+      pad.seek(start, os.SEEK_SET)
+      inputs.seek(inbase + offset, os.SEEK_SET)
+      output.seek(base + offset, os.SEEK_SET)
+      while length > 0:
+        size = min(length, PyXOR.BUFFER_LENGTH)
+        length -= size
+        started = time.time()
+        data = inputs.read(size)
+        key = pad.read(size)
+        if len(data) != size or len(key) != size:
+          raise CXORError("Short read from %s." % path)
+        read = time.time()
+        data = xorStrings(data, key)
+        xored = time.time()
+        output.write(data)
+        if progress is not None:
+          progress.update(size, read=read - started, xor=xored - read,
+                          write=time.time() - xored)
+    if pad is not None:
+      cache.checkin(pad)
+      pad = None
+  finally:
+    if pad is not None:
+      cache.discard(pad)
+    inputs.close()
+    output.close()
+
+def xorAllocationParallel(alloc, infile, outfile, fs, cache=None, lock=None,
+                          progress=None, inbase=None):
+  """As xorAllocation, but the pad on each storage device (as reported by
+     fs.device) is read by its own thread, so an allocation striped across
+     several devices gets their combined bandwidth. With the native engine
+     the threads also xor concurrently. Both infile and outfile must be
+     regular files. Falls back to xorAllocation if the allocation lives on a
+     single device."""
+  _checkSize(alloc, infile, inbase)
+  if lock is None:
+    lock = threading.Lock()
+
+  # Lay the allocation out in payload order and group it by device.
+  by_device = collections.OrderedDict()
+  offset = 0
+  for (pad_interval, pad_file) in alloc.iterFiles():
+    with lock:
+      device = fs.device(pad_file.path)
+    segments = by_device.setdefault(device, [])
+    for (start, length) in pad_interval.toAtoms():
+      segments.append((offset, pad_file, start, length))
+      offset += length
+
+  if len(by_device) <= 1:
+    return xorAllocation(alloc, infile, outfile, fs, cache=cache, lock=lock,
+                         progress=progress, inbase=inbase)
+
+  # Output is appended, so grow the file up front and let each worker write
+  # its segments in place.
+  open(outfile, "ab").close()
+  base = os.stat(outfile).st_size
+  with open(outfile, "r+b") as output:
+    output.truncate(base + len(alloc))
+
+  # Anything a worker raises is kept, as a dead worker leaves its segments
+  # unwritten in the grown file.
+  errors = []
+  def worker(segments):
+    try:
+      _xorSegments(segments, infile, outfile, fs, base, cache, lock,
+                   progress, inbase or 0)
+    except BaseException:
+      errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=worker, args=(segments,))
+             for segments in by_device.itervalues()]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for (kind, ex, tb) in errors:
+    if not issubclass(kind, (IOError, OSError, Error)):
+      raise kind, ex, tb
+  if errors:
+    raise CXORError(*[ex for (kind, ex, tb) in errors])
+  return len(alloc)